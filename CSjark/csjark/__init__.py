@@ -29,7 +29,7 @@ for debugging C programs that communicates with strucs over the network.
 """
 
 __all__ = [
-    'config', 'cparser', 'cpp', 'csjark',
-    'dissector', 'field', 'platform',
+    'cache', 'config', 'cparser', 'cpp', 'csjark',
+    'dissector', 'field', 'manifest', 'platform',
 ]
 
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for caching output from the slow steps of the utility on disk.
+
+Entries are stored in Options.cache_dir under a hash of everything which
+was used to create them, and the least recently used entries are removed
+when the cache grows larger than Options.cache_size megabytes. Files in
+the directory which are not named like entries are never removed. The number
+of hits and misses for each kind of entry is counted in 'hits' and
+'misses', which are shared by every session in the process.
+"""
+import os
+import re
+import hashlib
+import tempfile
+
+from config import Options
+
+
+hits = {} # Map kind of entry to number of cache hits
+misses = {} # Map kind of entry to number of cache misses
+sizes = {} # Map cache directory to the total size of its entries
+
+# Names of the files stored by the cache, other files are never removed
+_entry_regex = re.compile(r'^[0-9a-f]{40}\.[a-z]+$')
+
+
+def create_key(*values):
+    """Create a cache key from a hash of 'values'."""
+    key = hashlib.sha1()
+    for value in values:
+        if isinstance(value, str):
+            value = bytes(value, 'utf-8')
+        elif not isinstance(value, bytes):
+            value = bytes(repr(value), 'utf-8')
+        key.update(hashlib.sha1(value).digest())
+    return key.hexdigest()
+
+
+class KeyWriter:
+    """A text stream which creates a cache key from what is written to it.
+
+    The key equals create_key() of all the text written, which is also
+    written to the stream 'out' if given.
+    """
+
+    def __init__(self, out=None):
+        """Create a new KeyWriter instance, writing to 'out'."""
+        self.out = out
+        self._hash = hashlib.sha1()
+
+    def write(self, text):
+        """Write 'text' to the stream and add it to the key."""
+        self._hash.update(bytes(text, 'utf-8'))
+        if self.out is not None:
+            self.out.write(text)
+        return len(text)
+
+    @property
+    def key(self):
+        """Get the cache key of the text written so far."""
+        return hashlib.sha1(self._hash.digest()).hexdigest()
+
+
+def read(key, kind, options=Options):
+    """Read the 'kind' entry stored under 'key', None if missing.
+
+    'options' is the Options with the cache_dir to read from.
+    """
+    path = os.path.join(options.cache_dir, '%s.%s' % (key, kind))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        misses[kind] = misses.get(kind, 0) + 1
+        return None
+    os.utime(path) # Mark as recently used
+    hits[kind] = hits.get(kind, 0) + 1
+    return data
+
+
+def write(key, kind, data, options=Options):
+    """Store 'data' as a 'kind' entry under 'key'.
+
+    'options' is the Options with the cache_dir to write to.
+    """
+    os.makedirs(options.cache_dir, exist_ok=True)
+    path = os.path.join(options.cache_dir, '%s.%s' % (key, kind))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=options.cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    try:
+        replaced = os.stat(path).st_size
+    except OSError:
+        replaced = 0
+    os.replace(tmp, path)
+
+    # The directory is only listed the first time it is written to,
+    # and when the total size of its entries grows past the limit
+    folder = os.path.abspath(options.cache_dir)
+    if folder not in sizes:
+        sizes[folder] = sum(size for mtime, size, name in _entries(folder))
+    else:
+        sizes[folder] += len(data) - replaced
+    if sizes[folder] > options.cache_size * 1024 * 1024:
+        _remove_least_recently_used(folder, options)
+
+
+def update_counts(other_hits, other_misses):
+    """Add hits and misses counted by another process."""
+    for counts, other in ((hits, other_hits), (misses, other_misses)):
+        for kind, count in other.items():
+            counts[kind] = counts.get(kind, 0) + count
+
+
+def print_counts():
+    """Print the number of hits and misses for each kind of entry."""
+    for kind in sorted(set(hits) | set(misses)):
+        print("Cache '%s': %i hit(s), %i miss(es)" % (
+                kind, hits.get(kind, 0), misses.get(kind, 0)))
+
+
+def _entries(folder):
+    """Get (mtime, size, name) of every cache entry stored in 'folder'."""
+    entries = []
+    for name in os.listdir(folder):
+        if not _entry_regex.match(name):
+            continue # Not an entry, or not yet written by another process
+        try:
+            stat = os.stat(os.path.join(folder, name))
+        except OSError:
+            continue # Removed by another process
+        entries.append((stat.st_mtime, stat.st_size, name))
+    return entries
+
+
+def _remove_least_recently_used(folder, options=Options):
+    """Remove the least recently used entries while the cache is too big.
+
+    Entries are removed until the cache is a quarter below its maximum
+    size, so the directory is not listed again on the next write.
+    """
+    limit = options.cache_size * 1024 * 1024
+    entries = _entries(folder)
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= limit * 3 // 4:
+            break
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass # Removed by another process
+        total -= size
+    sizes[folder] = total
@@ -63,6 +63,8 @@ class Config:
         self.members = {} # Rules for struct members
         self.types = {} # Rules for struct member types
         self.trailers = [] # Rules for protocol trailers
+        self.array_threshold = None # Element count for lazy arrays
+        self.yaml = [] # The yaml objects the configuration was read from
 
     def add_member_rule(self, member, rule):
         """Add a new rule for a specific member.
@@ -90,6 +92,13 @@ class Config:
         rules.extend(self.types.get(type, []))
         return rules
 
+    def get_array_threshold(self, member):
+        """Return the element count above which 'member' is lazy."""
+        for rule in self.members.get(member, []):
+            if isinstance(rule, Array):
+                return rule.threshold
+        return self.array_threshold
+
     def create_field(self, proto, name, ctype, size, alignment, endian):
         """Create a field depending on rules."""
         # Sort the rules
@@ -301,6 +310,21 @@ class Custom(BaseRule):
         return field
 
 
+class Array(BaseRule):
+    """Rule for specifying when elements of an array are lazily dissected."""
+
+    def __init__(self, conf, obj):
+        """Create a new Array rule instance."""
+        if 'member' not in obj:
+            raise ConfigError('Missing member declaration in array rule')
+        super().__init__(conf, obj)
+
+        # Arrays with more elements are only dissected if they are shown
+        self.threshold = obj.get('threshold', None)
+        if not isinstance(self.threshold, int) or self.threshold < 0:
+            raise ConfigError('Invalid array threshold for %s' % conf.name)
+
+
 class ConformanceFile:
     """A class for parsing a conformance file.
 
@@ -446,17 +470,27 @@ class FileConfig:
         for var in self.members:
             getattr(self, var).extend(getattr(parent, var))
 
+    def copy(self):
+        """Create a new FileConfig with the same variables."""
+        obj = FileConfig(self.filename)
+        obj.inherit(self)
+        return obj
+
     @classmethod
-    def add_include(cls, filename, include):
+    def add_include(cls, filename, include, options=None):
         """Add a new 'include' to 'filename' config.
 
         If the 'filename' has no FileConfig, creates one.
+        'options' is the Options to find the config in, Options if None.
         """
-        obj = Options.match_file(filename)
+        if options is None:
+            options = Options
+        obj = options.match_file(filename)
         if obj.filename != filename:
-            obj = FileConfig(filename)
-            Options.files[filename] = obj
-        if obj.filename != include:
+            parent, obj = obj, FileConfig(filename)
+            obj.inherit(parent)
+            options.files[filename] = obj
+        if obj.filename != include and include not in obj.includes:
             obj.includes.append(include)
 
 
@@ -476,14 +510,40 @@ class Options:
     use_cpp = True
     cpp_path = None
     excludes = []
+    jobs = 1
+    batch_cpp = False
+    cache_dir = None
+    cache_size = 64 # Megabytes
+    cache_ast = False
+    incremental = False
+    loop_arrays = False
+    stats = None
+    serve = False
+    watch = False
 
     # Utility options
+    inputs = [] # Header files and folders given through the CLI
     platforms = set() # Set of platforms to support in dissectors
     delegator = None # Used to create a delegator dissector
     configs = {} # Configuration for specific protocols
     files = {} # Cpp configuration for specific files
     default = FileConfig('default') # Default Cpp config for all files
 
+    @classmethod
+    def create(cls):
+        """Create a new set of options, with the values of these options.
+
+        The new options are a subclass, used the same way as Options, but
+        changing them does not change the options they were created from.
+        """
+        return type(cls.__name__, (cls, ), {
+            'excludes': list(cls.excludes),
+            'platforms': set(cls.platforms),
+            'configs': dict(cls.configs),
+            'files': {k: v.copy() for k, v in cls.files.items()},
+            'default': cls.default.copy(),
+        })
+
     @classmethod
     def match_file(cls, filename):
         """Find file config object for 'filename'."""
@@ -506,7 +566,9 @@ class Options:
 
         # Read and update options
         members = ('verbose', 'debug', 'strict', 'output_dir',
-                   'output_file', 'use_cpp', 'cpp_path')
+                   'output_file', 'use_cpp', 'cpp_path', 'jobs',
+                   'batch_cpp', 'cache_dir', 'cache_size', 'cache_ast',
+                   'incremental', 'loop_arrays')
         for member in members:
             value = obj.get(member, None)
             if value is not None:
@@ -559,6 +621,20 @@ class Options:
         # Delegator creates lua file which delegates messages to dissectors
         cls.delegator = Delegator(Platform.mappings)
 
+    @classmethod
+    def get_state(cls):
+        """Get the options needed for parsing, to send to a subprocess."""
+        members = ('use_cpp', 'cpp_path', 'cache_dir', 'cache_size',
+                   'cache_ast', 'loop_arrays', 'stats', 'excludes',
+                   'platforms', 'configs', 'files', 'default')
+        return {member: getattr(cls, member) for member in members}
+
+    @classmethod
+    def set_state(cls, state):
+        """Restore options previously retrieved by get_state()."""
+        for member, value in state.items():
+            setattr(cls, member, value)
+
     @classmethod
     def handle_protocol_config(cls, obj, filename=''):
         """Handle rules and configuration for a protocol."""
@@ -570,6 +646,7 @@ class Options:
         if name not in cls.configs:
             cls.configs[name] = Config(name)
         conf = cls.configs[name]
+        conf.yaml.append(repr(obj))
 
         # Protocol's optional message id or list of message ids
         ids = obj.get('id', None)
@@ -595,6 +672,13 @@ class Options:
         if size is not None:
             conf.size = size
 
+        # Protocol's optional element count threshold for lazy arrays
+        threshold = obj.get('array_threshold', None)
+        if threshold is not None:
+            if not isinstance(threshold, int) or threshold < 0:
+                raise ConfigError('Invalid array threshold for %s' % name)
+            conf.array_threshold = threshold
+
         # Protocol's optional conformance file
         cnf = obj.get('cnf', None)
         if cnf:
@@ -602,7 +686,7 @@ class Options:
 
         # Handle rules
         types = {'bitstrings': Bitstring, 'enums': Enum, 'ranges': Range,
-                 'trailers': Trailer, 'customs': Custom}
+                 'trailers': Trailer, 'customs': Custom, 'arrays': Array}
         for name, type_ in types.items():
             rules = obj.get(name, None)
             if rules is not None:
@@ -610,7 +694,7 @@ class Options:
                     type_(conf, rule)
 
 
-def generate_placeholders(protocols):
+def generate_placeholders(protocols, options=Options):
     """Generate placeholder config for unknown structs."""
     def placeholder(proto):
         return '  - name: %s #%s' % (proto.name, proto._file)
@@ -623,7 +707,7 @@ def generate_placeholders(protocols):
     trailers:'''
     protos = {p.name: p for key, p in protocols.items()}
     data = ['%s%s\n' % (placeholder(v), structs)
-            for k, v in protos.items() if k not in Options.configs]
+            for k, v in protos.items() if k not in options.configs]
     preample = '''\
 Options:
     platforms: []
@@ -647,8 +731,11 @@ Structs:
     return '%s%s' % (preample, '\n'.join(data)), len(data)
 
 
-def parse_file(filename, only_text=None):
-    """Parse a configuration file."""
+def parse_file(filename, only_text=None, options=Options):
+    """Parse a configuration file.
+
+    'options' is the Options to update with the configuration.
+    """
     if only_text is not None:
         obj = yaml.safe_load(only_text)
     else:
@@ -658,16 +745,16 @@ def parse_file(filename, only_text=None):
         return # Empty yaml file
 
     # Deal with utility options
-    options = obj.get('Options', None)
-    if options:
-        Options.update(options)
+    values = obj.get('Options', None)
+    if values:
+        options.update(values)
 
     # Deal with protocol configuration
     protocols = obj.get('Structs', None)
     if protocols:
         for proto in protocols:
-            Options.handle_protocol_config(proto, filename)
+            options.handle_protocol_config(proto, filename)
 
-    if Options.verbose:
+    if options.verbose:
         print("Parsed config file '%s' successfully." % filename)
 
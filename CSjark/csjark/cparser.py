@@ -21,25 +21,41 @@
 A module for parsing C files to find struct definitions.
 
 The parse() function asks pycparser to parse a piece of C code, and
-returns an Abstract Syntax Tree (AST). The find_structs() function
-walks the AST to find any struct defininition.
+returns an Abstract Syntax Tree (AST), and parse_many() does the same for
+a batch of code. The find_structs() function walks the AST to find any
+struct defininition, and creates dissectors for them for a platform.
+
+A PLY parser can only parse one text at a time, so each thread gets its
+own parser from the ParserPool in 'parsers', which it reuses for every
+text it parses.
+
+If both Options.cache_ast and Options.cache_dir is set, parse() stores
+the AST on disk and reuses it when given the same C code again.
 
 The StructVisitor class is used to traverse an AST generated by pycparser,
-and looks for structs, enums, unions and type definitions. When it finds
-a struct or a union it creates a Dissector instance from the dissector
-module, which can generate Lua dissectors for respective C code sections.
+and looks for structs, enums, unions and type definitions. The describe()
+function uses it to describe the structs and unions it finds, the same
+for every platform, and the Layout class from the layout module creates
+a Dissector instance from the dissector module for each of them for a
+platform, which can generate Lua dissectors for respective C code
+sections. The protocols and types found are stored in the Session given.
 
 This module requires PLY 3.4 and pycparser 2.07.
 """
 import os
 import operator
+import pickle
+import threading
+import multiprocessing
 
+import pycparser
 from pycparser import c_ast, c_parser, plyparser
 
+import cache
 from config import Options
+from session import Session
 from platform import Platform
-from dissector import Protocol
-from field import Field, ArrayField, ProtocolField
+from layout import Member, Struct, Declarations, Layout
 
 
 class ParseError(plyparser.ParseError):
@@ -47,19 +63,114 @@ class ParseError(plyparser.ParseError):
     pass
 
 
-def parse(text, filename='', parser=c_parser.CParser()):
-    """Parse C code and return an AST."""
-    return parser.parse(text, filename)
+class ParserPool:
+    """A pool of pycparser parsers, with one parser for each thread.
+
+    A thread's parser is created the first time it asks for one, and is
+    reused for every text it parses after that. The PLY parse tables are
+    loaded by the first parser created, and shared by all parsers.
+    """
+
+    def __init__(self):
+        """Create a new, empty ParserPool."""
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.created = 0 # Number of parsers created
+
+    @property
+    def parser(self):
+        """Get the parser of the current thread."""
+        parser = getattr(self._local, 'parser', None)
+        if parser is None:
+            with self._lock: # Only one thread loads the parse tables
+                parser = c_parser.CParser()
+                self.created += 1
+            self._local.parser = parser
+        return parser
+
+
+parsers = ParserPool()
 
 
-def find_structs(ast, platform=None):
-    """Walks the AST nodes to find structs."""
+def parse(text, filename='', parser=None, session=None):
+    """Parse C code and return an AST.
+
+    'parser' is the CParser to use, the current thread's parser in
+    'parsers' if None.
+    'session' is the Session with the options, the default if None.
+    """
+    if parser is None:
+        parser = parsers.parser
+    if session is None:
+        session = Session.default()
+    options = session.options
+
+    key = None
+    if options.cache_ast and options.cache_dir is not None:
+        key = cache.create_key(text, filename, pycparser.__version__)
+        data = cache.read(key, 'ast', options)
+        if data is not None:
+            return pickle.loads(data)
+
+    ast = parser.parse(text, filename)
+
+    if key is not None:
+        try:
+            data = pickle.dumps(ast, pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            pass # Too deeply nested to store
+        else:
+            cache.write(key, 'ast', data, options)
+    return ast
+
+
+def parse_many(texts, filenames=None, jobs=None, session=None):
+    """Parse a batch of C code and return a list of ASTs.
+
+    'texts' is a list of C code to parse
+    'filenames' is a list of the file each text came from
+    'jobs' is the number of processes to parse in, the session's
+    options.jobs if None
+    Every process creates a single parser, which it parses all its
+    texts with. Raises the ParseError of the first text which failed.
+    """
+    if session is None:
+        session = Session.default()
+    if filenames is None:
+        filenames = [''] * len(texts)
+    if jobs is None:
+        jobs = session.options.jobs
+    jobs = min(jobs, len(texts))
+    if jobs < 2:
+        return [parse(text, filename, session=session)
+                for text, filename in zip(texts, filenames)]
+
+    # The processes parse with the default session, given these options
+    with multiprocessing.Pool(jobs, Options.set_state,
+                              (session.options.get_state(), )) as pool:
+        return pool.starmap(parse, zip(texts, filenames))
+
+
+def find_structs(ast, platform=None, session=None):
+    """Walks the AST nodes to find structs.
+
+    'session' is the Session to store the structs in, the default if None
+    """
     if platform is None:
         platform = Platform.mappings['default']
 
-    visitor = StructVisitor(platform)
+    return Layout(platform, session).create(describe(ast))
+
+
+def describe(ast):
+    """Describe the structs and types in the AST for any platform.
+
+    Returns the Declarations, which layout.Layout creates the dissectors
+    of for each platform.
+    """
+    visitor = StructVisitor()
     visitor.visit(ast)
-    return list(StructVisitor.all_protocols.values())
+    return visitor.declarations
 
 
 class StructVisitor(c_ast.NodeVisitor):
@@ -68,34 +179,22 @@ class StructVisitor(c_ast.NodeVisitor):
     The Visitor traverse the Tree, and when it finds Struct, Enum, Union,
     Typedef or TypeDecl nodes it calls the respective methods in this class.
 
-    It will populate all_protocols class member with Dissector-instances
-    representing all the relevant C data structures it found.
+    It will describe all the relevant C data structures it found in its
+    declarations, with the names, C types and array dimensions of their
+    members, which do not depend on the platform.
 
-    The alll_know_types class member is used to discover which C file
-    should be included if we fail parsing because of unknown types.
+    The known types are used to discover which C file should be included
+    if we fail parsing because of unknown types.
     """
 
-    all_protocols = {} # Map struct name to Protocol instances
-    all_known_types = {} # Map type name to source filename
-
-    _last_visitor = None
-    _last_diss = None
-    _last_proto = None
-
-    def __init__(self, platform):
-        """Create a new instance to visit all nodes in the AST.
-
-        'platform' is the platform the header was parsed for
-        """
-        StructVisitor._last_visitor = self
-        self.platform = platform
-        self.map_type = platform.map_type
-        self.size_of = platform.size_of
-        self.alignment = platform.alignment
+    def __init__(self):
+        """Create a new instance to visit all nodes in the AST."""
+        self.declarations = Declarations()
 
         self.enums = {} # All enums encountered in this AST
         self.aliases = {} # Typedefs and their base type
         self.type_decl = [] # Queue of current type declaration
+        self.structs = [] # Stack of structs being described
 
     def visit_Struct(self, node):
         """Visit a Struct node in the AST."""
@@ -117,30 +216,38 @@ class StructVisitor(c_ast.NodeVisitor):
 
         self._register_type(node) # Register as known type
 
-        # Check if a protocol already exists for this node
-        if self._find_protocol(node) is not None:
-            return
+        struct = Struct(node.name, union, node.coord.file, node.coord.line)
+        if self.structs:
+            self.structs[-1].nested.append(struct)
+        else:
+            self.declarations.structs.append(struct)
+
+        # Structs declared inside this one, which are not members
+        declared = [decl for decl in node.children()
+                    if isinstance(decl.children()[0], (c_ast.Struct,
+                            c_ast.Union)) and decl.children()[0].name]
 
         # Visit children
+        self.structs.append(struct)
         c_ast.NodeVisitor.generic_visit(self, node)
-
-        # Create the protocol for the struct
-        proto = self._create_protocol(node, union)
-        if proto is None:
-            return # We have already created this protocol
+        self.structs.pop()
 
         # Find the member definitions
         for decl in node.children():
             child = decl.children()[0]
 
-            if isinstance(child, c_ast.TypeDecl):
-                self.handle_type_decl(child, proto)
+            if decl in declared:
+                continue # Described as a nested struct
+            elif isinstance(child, c_ast.TypeDecl):
+                member = self.handle_type_decl(child)
             elif isinstance(child, c_ast.ArrayDecl):
-                self.handle_array(proto, *self.handle_array_decl(child))
+                depth, member = self.handle_array_decl(child)
+                member = member._replace(depth=depth)
             elif isinstance(child, c_ast.PtrDecl):
-                self.handle_pointer(child, proto)
+                member = self.handle_pointer(child)
             else:
                 raise ParseError('Unknown struct member: %s' % repr(child))
+            struct.members.append(member)
 
     def visit_Enum(self, node):
         """Visit a Enum node in the AST."""
@@ -195,8 +302,8 @@ class StructVisitor(c_ast.NodeVisitor):
         c_ast.NodeVisitor.generic_visit(self, node)
         self.type_decl.pop()
 
-    def handle_type_decl(self, node, proto):
-        """Find member details in a type declaration."""
+    def handle_type_decl(self, node):
+        """Describe the member in a type declaration."""
         child = node.children()[0]
 
         # Identifier member, simple type or typedef type
@@ -207,29 +314,27 @@ class StructVisitor(c_ast.NodeVisitor):
             if ctype in self.aliases:
                 token, base = self.aliases[ctype]
                 if token in ('struct', 'union'):
-                    return self.handle_protocol(proto, node.declname, base)
+                    return Member(node.declname, 'protocol', base)
                 elif token == 'enum':
-                    return self.handle_enum(proto, node.declname, base)
+                    return self._create_enum(node.declname, base)
                 elif token == 'array':
-                    return self.handle_array(proto,
-                            base[0], base[1], name=node.declname)
+                    depth, member = base
+                    return member._replace(name=node.declname,
+                            alias=member.name, depth=list(depth))
                 else:
-                    # If any rules exists, use new type and not base
-                    if proto.conf and proto.conf.get_rules(None, ctype):
-                        base = ctype # Is this wise?
-                    return self.handle_field(proto, node.declname, base)
+                    return Member(node.declname, 'field', base, ctype)
             else:
-                return self.handle_field(proto, node.declname, ctype)
+                return Member(node.declname, 'field', ctype)
 
         # Enum member
         elif isinstance(child, c_ast.Enum):
-            return self.handle_enum(proto, node.declname, child.name)
+            return self._create_enum(node.declname, child.name)
         # Union member
         elif isinstance(child, c_ast.Union):
-            return self.handle_protocol(proto, node.declname, child.name)
+            return Member(node.declname, 'protocol', child.name)
         # Struct member
         elif isinstance(child, c_ast.Struct):
-            return self.handle_protocol(proto, node.declname, child.name)
+            return Member(node.declname, 'protocol', child.name)
         # Error
         else:
             raise ParseError('Unknown type declaration: %s' % repr(child))
@@ -240,7 +345,7 @@ class StructVisitor(c_ast.NodeVisitor):
         'node' is a pycparser.c_ast.ArrayDecl instance
         'depth' is a list of elements already traversed
         It returns a list with count of elements in in each level,
-        and a Field instance.
+        and a Member instance describing an element.
         """
         if depth is None:
             depth = []
@@ -252,8 +357,7 @@ class StructVisitor(c_ast.NodeVisitor):
         if (isinstance(child, c_ast.TypeDecl) and
                 hasattr(child.children()[0], 'names') and
                 child.children()[0].names[0] == 'char'): #hack
-            size *= self.size_of('char')
-            return depth, self._create_field(child.declname, 'string', size, 0)
+            return depth, Member(child.declname, 'string', 'char', count=size)
 
         # Multidimensional, handle recursively
         if isinstance(child, c_ast.ArrayDecl):
@@ -272,16 +376,15 @@ class StructVisitor(c_ast.NodeVisitor):
             if ctype in self.aliases:
                 token, base = self.aliases[ctype]
                 if token in ('struct', 'union'):
-                    return depth, self._create_protocol_field(
-                            child.declname, base)
+                    return depth, Member(child.declname, 'protocol', base)
                 elif token == 'enum':
                     return depth, self._create_enum(child.declname, base)
                 elif token == 'array':
                     return depth + base[0], base[1]
                 else:
-                    return depth, self._create_field(child.declname, base)
+                    return depth, Member(child.declname, 'plain', base)
             else:
-                return depth, self._create_field(child.declname, ctype)
+                return depth, Member(child.declname, 'plain', ctype)
 
         # Enum
         elif isinstance(sub_child, c_ast.Enum):
@@ -290,126 +393,25 @@ class StructVisitor(c_ast.NodeVisitor):
         # Union and struct
         elif (isinstance(sub_child, c_ast.Union) or
                 isinstance(sub_child, c_ast.Struct)):
-            return depth, self._create_protocol_field(
-                    child.declname, sub_child.name)
+            return depth, Member(child.declname, 'protocol', sub_child.name)
 
         # Pointer
         elif isinstance(child, c_ast.PtrDecl):
-            return depth, self._create_field(sub_child.declname, 'pointer')
+            return depth, Member(sub_child.declname, 'plain', 'pointer')
 
         # Error
         else:
             raise ParseError('Unknown type in array: %s' % repr(sub_child))
 
-    def handle_protocol(self, proto, name, proto_name):
-        """Add an protocol field or union field to the protocol."""
-        return proto.add_field(self._create_protocol_field(name, proto_name))
-
-    def handle_array(self, proto, depth, field, name=None):
-        """Add an ArrayField to the protocol."""
-        if name is not None:
-            field.name = name
-        if depth:
-            field = ArrayField.create(depth, field)
-        return proto.add_field(field)
-
-    def handle_pointer(self, node, proto):
-        """Find member details in a pointer declaration."""
-        return self.handle_field(proto, node.children()[0].declname, 'pointer')
-
-    def handle_enum(self, proto, name, enum):
-        """Add an EnumField to the protocol."""
-        return proto.add_field(self._create_enum(name, enum))
-
-    def handle_field(self, proto, name, ctype, size=None, alignment=None):
-        """Add a field representing the struct member to the protocol."""
-        if alignment is None:
-            try:
-                alignment = self.alignment(ctype)
-            except ValueError :
-                alignment = size # Assume that the alignment is the same as the size
-
-        endian = self.platform.endian
-        if proto.conf is None:
-            if size is None:
-                size = self.size_of(ctype)
-            if size is None:
-                raise ParseError('Unknown alignment for type %s' % ctype)
-            return proto.add_field(Field(
-                    name, self.map_type(ctype), size, alignment, endian))
-        else:
-            return proto.conf.create_field(proto, name,
-                    ctype, size, alignment, endian)
-
-    def _find_protocol(self, node):
-        """Check if the protocol already exists."""
-        if node.name not in StructVisitor.all_protocols:
-            return None
-
-        # Match platform
-        old = StructVisitor.all_protocols[node.name]
-        dissector = old.get_dissector(self.platform)
-        if dissector is None:
-            return None
-
-        # Disallow structs with same name
-        if (os.path.normpath(old._file) == os.path.normpath(node.coord.file)
-                and old._line == node.coord.line):
-            return dissector
-
-        raise ParseError('Two structs with same name %s: %s:%i & %s:%i' % (
-               node.name, old._file, old._line,
-               node.coord.file, node.coord.line))
-
-    def _create_protocol(self, node, union=False):
-        """Create a new protocol for 'node'."""
-        conf = Options.configs.get(node.name, None)
-        proto, diss = Protocol.create_dissector(
-                node.name, self.platform, conf, union=union)
-
-        # Add protocol to list of all protocols
-        proto._file = node.coord.file
-        proto._line = node.coord.line
-        StructVisitor.all_protocols[node.name] = proto
-        StructVisitor._last_diss = diss
-        StructVisitor._last_proto = proto
-        return diss
-
-    def _create_field(self, name, ctype, size=None, alignment=None):
-        """Create a new field representing the given 'ctype'."""
-        if size is None:
-            size = self.size_of(ctype)
-        if alignment is None:
-            alignment = self.alignment(ctype)
-        endian = self.platform.endian
-        return Field(name, self.map_type(ctype), size, alignment, endian)
+    def handle_pointer(self, node):
+        """Describe the member in a pointer declaration."""
+        return Member(node.children()[0].declname, 'field', 'pointer')
 
     def _create_enum(self, name, enum):
-        """Create a new enum field."""
+        """Describe a new enum member."""
         if enum not in self.enums.keys():
             raise ParseError('Unknown enum: %s' % enum)
-        type = self.map_type('enum')
-        size = self.size_of('enum')
-        alignment = self.alignment('enum')
-        field = Field(name, type, size, alignment, self.platform.endian)
-        field.set_list_validation(self.enums[enum])
-        return field
-
-    def _create_protocol_field(self, name, proto_name):
-        """Create a new protocol field."""
-        proto = StructVisitor.all_protocols.get(proto_name, None)
-        if proto is not None:
-            proto = proto.get_dissector(self.platform)
-
-        # Try to create a fake protocol if conf has size
-        if proto is None:
-            conf = Options.config.get(proto_name, None)
-            if conf is None or conf.size is None:
-                raise ParseError('Unknown protocol %s' % proto_name)
-            proto = ProtocolField.Fake(name=proto_name, size=conf.size,
-                    alignment=conf.size, endian=self.platform.endian)
-
-        return ProtocolField(name, proto)
+        return Member(name, 'enum', enum, values=self.enums[enum])
 
     def _get_type(self, node):
         """Get the C type from a node."""
@@ -436,8 +438,8 @@ class StructVisitor(c_ast.NodeVisitor):
         return size
 
     def _register_type(self, node, name=None):
-        """Register the type 'name' in the known types mapping."""
+        """Register the type 'name' in the known types."""
         if name is None:
             name = node.name
-        StructVisitor.all_known_types[name] = os.path.normpath(node.coord.file)
-
+        self.declarations.types.append(
+                (name, os.path.normpath(node.coord.file)))
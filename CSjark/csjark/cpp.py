@@ -22,35 +22,181 @@ Module for performing the C preprocessor step on C header files.
 
 The parse_file() function calls the external C preprocessor program,
 while post_cpp() function removes output from the preprocessor which
-pycparser does not support.
+pycparser does not support. The find_dependencies() function scans
+headers for the types they declare and use, to find which headers must
+be included before another can be parsed. If Options.cache_dir is set,
+the output is stored on disk and reused as long as the header and its
+includes are unchanged. The functions use the options of the Session
+they are given.
 """
 import sys
 import os
+import re
 from subprocess import Popen, PIPE
 
-from config import Options
+import cache
+import stats
+from session import Session
 
 
-def parse_file(filename, platform=None, folders=None, includes=None):
+# Maximum number of files parse_files() runs through one C preprocessor
+BATCH_SIZE = 64
+
+
+def parse_file(filename, platform=None, folders=None,
+               includes=None, session=None):
     """Run a C header or code file through C preprocessor program.
 
     'filename' is the file to feed CPP.
     'platform' is the platform to simulate.
     'folders' is directories to -Include.
     'includes' is a set of filename to #include.
+    'session' is the Session with the options, the default if None.
     """
+    if session is None:
+        session = Session.default()
+    options = session.options
+
     # Just read the content of the file if we don't want to use cpp
-    if not Options.use_cpp:
+    if not options.use_cpp:
         with open(filename, 'r') as f:
             return f.read()
 
-    if folders is None:
-        folders = set()
+    # Copy folders, as it is shared between all headers and platforms
+    folders = set(folders) if folders is not None else set()
     if includes is None:
         includes = []
 
-    config = Options.match_file(filename)
-    path_list = _get_cpp()
+    config = options.match_file(filename)
+    path_list = _arguments(filename, platform, folders, config, options)
+
+    if config.includes or includes:
+        # Find all includes and their dependencies
+        unprosess = [filename] + includes + config.includes
+        processed = set()
+        all_includes = []
+        while len(unprosess) > 0:
+            file = unprosess.pop(0)
+            processed.add(file)
+            if file in all_includes:
+                all_includes.remove(file) # Move it to the front
+            all_includes.insert(0, file)
+            unprosess.extend(i for i in options.match_file(file).includes
+                    if i not in processed)
+
+
+        feed = '\n'.join('#include "%s"' % i for i in all_includes) + '\n'
+    else:
+        path_list.append(filename)
+        feed = ''
+
+    # Reuse the output from an earlier run if nothing has changed
+    key = None
+    if options.cache_dir is not None:
+        search = [os.path.dirname(filename)] + sorted(folders)
+        key = _cache_key(path_list, feed, filename, search)
+        text = cache.read(key, 'i', options)
+        if text is not None:
+            return str(text, 'utf-8')
+
+    text, returncode = _run(path_list, feed, filename, platform)
+    with stats.measure('post_cpp', filename, platform) as measure:
+        text = '\n'.join(post_cpp(text.split('\n')))
+        measure.bytes = len(text)
+    if key is not None and returncode == 0:
+        cache.write(key, 'i', bytes(text, 'utf-8'), options)
+    return text
+
+
+def parse_files(filenames, platform=None, folders=None, session=None):
+    """Run several C header or code files through one C preprocessor.
+
+    'filenames' is the files to feed CPP.
+    'platform' is the platform to simulate.
+    'folders' is directories to -Include.
+    'session' is the Session with the options, the default if None.
+    Returns a dict mapping each filename to its output, as parse_file()
+    would return it.
+
+    Files with the same cpp arguments are preprocessed as one translation
+    unit, which #includes them all, and the output is split per file by
+    its line markers. Every macro a file and its includes #define or
+    #undef is #undef'ed after it, include guards too, so the next file
+    sees the macros given on the command line only, and gets the output
+    of all of its includes. Files which must be preprocessed on their
+    own, see _batch_macros(), or whose batch failed, are run through
+    parse_file().
+    """
+    if session is None:
+        session = Session.default()
+    options = session.options
+    if not options.use_cpp:
+        return {i: parse_file(i, platform, folders, None, session)
+                for i in filenames}
+
+    texts = {}
+    batches = {} # Map cpp arguments to files and their cache keys
+    for filename in filenames:
+        config = options.match_file(filename)
+        if config.includes:
+            texts[filename] = parse_file(
+                    filename, platform, folders, None, session)
+            continue
+
+        search = set(folders) if folders is not None else set()
+        path_list = _arguments(filename, platform, search, config, options)
+        key = None
+        if options.cache_dir is not None:
+            search = [os.path.dirname(filename)] + sorted(search)
+            key = _cache_key(path_list + [filename], '', filename, search)
+            text = cache.read(key, 'i', options)
+            if text is not None:
+                texts[filename] = str(text, 'utf-8')
+                continue
+        macros = _batch_macros(filename, path_list)
+        if macros is None:
+            texts[filename] = parse_file(
+                    filename, platform, folders, None, session)
+            continue
+        batches.setdefault(tuple(path_list), []).append(
+                (filename, key, macros))
+
+    for path_list, batch in batches.items():
+        if len(batch) == 1:
+            (filename, key, macros), = batch
+            text, returncode = _run(list(path_list) + [filename], '',
+                                    filename, platform)
+            outputs = {filename: text.split('\n')}
+        else:
+            feed = ''.join('#include "%s"\n' % filename +
+                           ''.join('#undef %s\n' % i for i in sorted(macros))
+                           for filename, key, macros in batch)
+            text, returncode = _run(list(path_list), feed, None, platform)
+            if returncode != 0:
+                for filename, key, macros in batch:
+                    texts[filename] = parse_file(
+                            filename, platform, folders, None, session)
+                continue
+            with stats.measure('post_cpp', None, platform):
+                outputs = _split_output(text, [i for i, j, k in batch])
+
+        for filename, key, macros in batch:
+            with stats.measure('post_cpp', filename, platform) as measure:
+                text = '\n'.join(post_cpp(outputs[filename]))
+                measure.bytes = len(text)
+            if key is not None and returncode == 0:
+                cache.write(key, 'i', bytes(text, 'utf-8'), options)
+            texts[filename] = text
+    return texts
+
+
+def _arguments(filename, platform, folders, config, options):
+    """Find the cpp program and its arguments for preprocessing 'filename'.
+
+    'folders' is a set of directories to -Include, which is extended
+    with the folder of the file and the include_dirs of 'config'.
+    """
+    path_list = _get_cpp(options)
 
     # Add fake includes and includes from configuration
     path_list.append(r'-I../utils/fake_libc_include')
@@ -62,7 +208,7 @@ def parse_file(filename, platform=None, folders=None, includes=None):
     # Add all -Include cpp arguments
     if folders or config.include_dirs:
         folders |= set(config.include_dirs)
-        path_list.extend('-I%s' % i for i in folders)
+        path_list.extend('-I%s' % i for i in sorted(folders))
 
     # Define macros
     if platform is not None:
@@ -73,39 +219,94 @@ def parse_file(filename, platform=None, folders=None, includes=None):
     path_list.extend('-D%s' % i for i in config.defines)
     path_list.extend('-U%s' % i for i in config.undefines)
     path_list.extend(config.arguments)
+    return path_list
 
-    if config.includes or includes:
-        # Find all includes and their dependencies
-        unprosess = [filename] + includes + config.includes
-        processed = set()
-        all_includes = []
-        while len(unprosess) > 0:
-            file = unprosess.pop(0)
-            processed.add(file)
-            if file in all_includes:
-                all_includes.remove(file) # Move it to the front
-            all_includes.insert(0, file)
-            unprosess.extend(i for i in Options.match_file(file).includes
-                    if i not in processed)
 
+def _run(path_list, feed, filename=None, platform=None):
+    """Run the C preprocessor, returns its output and return code.
 
-        feed = '\n'.join('#include "%s"' % i for i in all_includes) + '\n'
-    else:
-        path_list.append(filename)
-        feed = ''
-
+    'filename' and 'platform' is what it is run for, to measure in stats.
+    """
     # Missing universal newlines forces input to expect bytes
     if not sys.platform.startswith('win'):
         feed = bytes(feed, 'ascii')
 
     # Call C preprocessor with args and file
-    with Popen(path_list, stdin=PIPE, stdout=PIPE,
-            stderr=PIPE, universal_newlines=True) as proc:
-        text, warnings = proc.communicate(input=feed)
+    with stats.measure('cpp', filename, platform) as measure:
+        with Popen(path_list, stdin=PIPE, stdout=PIPE,
+                stderr=PIPE, universal_newlines=True) as proc:
+            text, warnings = proc.communicate(input=feed)
+        measure.bytes = len(text)
     if warnings:
         print(warnings.strip(), file=sys.stderr)
+    return text, proc.returncode
+
 
-    return '\n'.join(post_cpp(text.split('\n')))
+def _batch_macros(filename, path_list):
+    """Find the macros 'filename' and its includes #define or #undef.
+
+    'path_list' is the cpp program and its arguments.
+    Returns None if the file can not share a translation unit with other
+    files: if it changes a macro given by 'path_list' or predefined by
+    cpp, like __STDC__, or includes a file with #pragma once, which is
+    not included again for the next file.
+    """
+    folders = [i[2:] for i in path_list if i.startswith('-I')]
+    arguments = {re.split('[=(]', i[2:])[0]
+                 for i in path_list if i[:2] in ('-D', '-U')}
+    macros = set()
+    for name, content in find_includes([filename], folders):
+        content = content.decode('latin-1')
+        if _pragma_once_regex.search(content):
+            return None
+        macros.update(_macro_regex.findall(content))
+    if macros & arguments or any(i.startswith('__') and i.endswith('__')
+                                 for i in macros):
+        return None
+    return macros
+
+
+def _split_output(text, filenames):
+    """Split the output of a batch of files into the output of each file.
+
+    The output is cut into chunks at every line marker, and each chunk
+    belongs to the file of the batch which was being included when it
+    was output. A file gets its own chunks and the chunks outside all
+    of the files, like the output of the predefined macros.
+    Returns a dict mapping each filename to a list of lines.
+    """
+    chunks = [] # File of the batch being included and lines
+    stack = []
+    lines = []
+    chunks.append((None, lines))
+    for line in text.split('\n'):
+        match = _line_marker_regex.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+
+        name = os.path.normpath(re.sub(r'\\(.)', r'\1', match.group(2)))
+        flags = match.group(3).split()
+        if '1' in flags:
+            stack.append(name) # Entering an included file
+        elif '2' in flags:
+            while stack and stack[-1] != name:
+                stack.pop() # Returning to the file which included it
+        elif stack:
+            stack[-1] = name
+        else:
+            stack.append(name)
+        lines = [line]
+        chunks.append((stack[1] if len(stack) > 1 else None, lines))
+
+    outputs = {os.path.normpath(i): [] for i in filenames}
+    for owner, chunk in chunks:
+        if owner in outputs:
+            outputs[owner].extend(chunk)
+        else:
+            for lines in outputs.values():
+                lines.extend(chunk)
+    return {i: outputs[os.path.normpath(i)] for i in filenames}
 
 
 def post_cpp(lines):
@@ -119,10 +320,10 @@ def post_cpp(lines):
     return lines
 
 
-def _get_cpp():
+def _get_cpp(options):
     """Find the path and args to the C preprocessor."""
-    if Options.cpp_path is not None:
-        return Options.cpp_path
+    if options.cpp_path is not None:
+        return list(options.cpp_path) # Extended by the caller
     path = ['cpp']
     if sys.platform == 'win32':
         path = ['../utils/cpp.exe'] # Windows don't come with a CPP
@@ -130,3 +331,205 @@ def _get_cpp():
         path = ['gcc', '-E'] # Fix for a bug in Mac GCC 4.2.1
     return path
 
+
+# Matches the line markers in the output of the C preprocessor
+_line_marker_regex = re.compile(r'^#\s*(\d+)\s+"((?:\\.|[^"\\])*)"(.*)$')
+
+# Matches the filename in #include "file" and #include <file> directives
+_include_regex = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.M)
+
+# Matches the name in #define and #undef directives, and #pragma once
+_macro_regex = re.compile(r'^\s*#\s*(?:define|undef)\s+(\w+)', re.M)
+_pragma_once_regex = re.compile(r'^\s*#\s*pragma\s+once\b', re.M)
+
+# Regular expressions for finding declared and used types in C code
+_comment_regex = re.compile(
+        r'/\*.*?\*/|//[^\n]*|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.S)
+_directive_regex = re.compile(r'^[ \t]*#(?:[^\n]*\\\n)*[^\n]*', re.M)
+_define_regex = re.compile(r'^\s*define\s+(\w+)')
+_tag_regex = re.compile(r'\b(struct|union|enum)\s+(\w+)\s*(\{)?')
+_enum_regex = re.compile(r'\benum\b[^{;]*\{([^}]*)\}')
+_typedef_regex = re.compile(r'(\w+)\s*(?:\)\s*\([^()]*\)\s*)?(?:\[[^\]]*\]\s*)*$')
+_type_use_regex = re.compile(r'\b([A-Za-z_]\w*)\s*[*\s]\s*(?=[A-Za-z_(])')
+_word_regex = re.compile(r'\b[A-Za-z_]\w*\b')
+
+# C keywords and basic types, which are never declared in a header
+C_KEYWORDS = frozenset([
+    'auto', 'break', 'case', 'char', 'const', 'continue', 'default', 'do',
+    'double', 'else', 'enum', 'extern', 'float', 'for', 'goto', 'if',
+    'inline', 'int', 'long', 'register', 'restrict', 'return', 'short',
+    'signed', 'sizeof', 'static', 'struct', 'switch', 'typedef', 'union',
+    'unsigned', 'void', 'volatile', 'while', '_Bool', 'defined',
+])
+
+
+def find_includes(filenames, folders=()):
+    """Find 'filenames' and all the files they #include, recursively.
+
+    'filenames' is a list of files to start from.
+    'folders' is the directories to search for includes.
+    Returns a list of (filename, content) pairs, with content as bytes.
+    Macros are not evaluated, so includes inside #if's are found too.
+    """
+    folders = list(folders) + ['../utils/fake_libc_include']
+    unprocessed = list(filenames)
+    processed = set()
+    files = []
+    while unprocessed:
+        filename = os.path.normpath(unprocessed.pop(0))
+        if filename in processed or not os.path.isfile(filename):
+            continue
+        processed.add(filename)
+        with open(filename, 'rb') as f:
+            content = f.read()
+        files.append((filename, content))
+
+        # Search the folder of the file first
+        local = [os.path.dirname(filename)]
+        for name in _include_regex.findall(content.decode('latin-1')):
+            for folder in local + folders:
+                path = os.path.join(folder, name)
+                if os.path.isfile(path):
+                    unprocessed.append(path)
+                    break
+    return files
+
+
+def _cache_key(path_list, feed, filename, folders):
+    """Create a key for the cache from all input to the C preprocessor.
+
+    'path_list' is the cpp program and its arguments.
+    'feed' is the text given to cpp on stdin.
+    'filename' is the file to feed CPP.
+    'folders' is the directories to search for includes.
+    """
+    values = [path_list, feed]
+    filenames = [filename] + _include_regex.findall(feed)
+    for filename, content in find_includes(filenames, folders):
+        values.extend([filename, content])
+    return cache.create_key(*values)
+
+
+def find_dependencies(headers, folders=(), session=None):
+    """Find which of the other 'headers' each header must include.
+
+    'headers' is a list of all headers to parse.
+    'folders' is the directories to search for includes.
+    'session' is the Session with the options, the default if None.
+    Returns a dict mapping each header to a list of headers declaring
+    the types and macros it uses, which it does not #include itself.
+    Types no header declares are looked up in the known types of the
+    session, which holds the types of headers parsed earlier.
+    """
+    if session is None:
+        session = Session.default()
+    scanned = {} # Map filename to declared and used names
+    def scan(filename, content):
+        if filename not in scanned:
+            scanned[filename] = scan_declarations(content.decode('latin-1'))
+        return scanned[filename]
+
+    # Find which headers declare each name
+    declared_by = {}
+    closures = {}
+    for filename in headers:
+        config = session.options.match_file(filename)
+        search = [os.path.dirname(filename)] + list(folders)
+        files = find_includes([filename] + config.includes,
+                              search + config.include_dirs)
+        closures[filename] = files
+        declared, used = scan(*files[0]) if files else (set(), set())
+        for name in declared:
+            declared_by.setdefault(name, []).append(filename)
+
+    dependencies = {}
+    for filename in headers:
+        files = closures[filename]
+        if not files:
+            continue
+
+        # Names used by the header or the headers it includes, which are
+        # not declared by the header or any file it includes
+        declared = set()
+        used = set()
+        for include in files:
+            declared |= scan(*include)[0]
+            if include is files[0] or include[0] in closures:
+                used |= scan(*include)[1]
+
+        # Prefer headers in the same folder, then the first found
+        folder = os.path.dirname(filename)
+        includes = []
+        for name in sorted(used - declared):
+            candidates = [i for i in declared_by.get(name, [])
+                          if i != filename]
+            if name not in declared_by and session.known_types.get(
+                    name, filename) != filename:
+                candidates = [session.known_types[name]]
+            local = [i for i in candidates if os.path.dirname(i) == folder]
+            for include in (local or candidates)[:1]:
+                if include not in includes:
+                    includes.append(include)
+        dependencies[filename] = [i for i in headers if i in includes] + [
+                i for i in includes if i not in closures]
+
+    return dependencies
+
+
+def scan_declarations(text):
+    """Find the names declared and used in C code, without a preprocessor.
+
+    Returns two sets, the names of types, enum constants and macros
+    declared by 'text', and the names of types and macros it uses.
+    """
+    declared = set()
+    used = set()
+    text = _comment_regex.sub(' ', text)
+
+    # Macros defined. Names tested in #if's are not used, as defining
+    # them in another header would change what the header declares
+    for directive in _directive_regex.findall(text):
+        directive = directive.lstrip()[1:].replace('\\\n', ' ')
+        match = _define_regex.match(directive)
+        if match:
+            declared.add(match.group(1))
+    code = _directive_regex.sub(' ', text)
+
+    # Struct, union and enum tags
+    for keyword, name, body in _tag_regex.findall(code):
+        if body:
+            declared.add(name)
+        else:
+            used.add(name)
+
+    # Enum constants
+    for body in _enum_regex.findall(code):
+        for member in body.split(','):
+            declared.update(_word_regex.findall(member)[:1])
+
+    # Typedef names, the last name in each typedef declaration
+    depth = 0
+    start = 0
+    for i, char in enumerate(code):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif char == ';' and depth == 0:
+            statement = code[start:i].strip()
+            start = i + 1
+            if not statement.startswith('typedef'):
+                continue
+            for declarator in statement.rsplit('}', 1)[-1].split(','):
+                match = _typedef_regex.search(declarator.strip())
+                if match:
+                    declared.add(match.group(1))
+
+    # Names used as a type, and names used in array sizes
+    used.update(_type_use_regex.findall(code))
+    for size in re.findall(r'\[([^\]]*)\]', code):
+        used.update(_word_regex.findall(size))
+
+    declared -= C_KEYWORDS
+    used -= C_KEYWORDS
+    return declared, used - declared
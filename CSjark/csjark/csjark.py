@@ -28,6 +28,9 @@ usage: csjark.py [-h] [-v] [-d] [-s] [-f [header [header ...]]]
                  [-I [directory [directory ...]]]
                  [-D [name=definition [name=definition ...]]]
                  [-U [name [name ...]]] [-A [argument [argument ...]]]
+                 [--cache-dir directory] [--cache-ast] [--incremental]
+                 [-j N] [--batch-cpp] [--loop-arrays] [--stats file]
+                 [--serve | --watch]
                  [header] [config]
 
 Generate Wireshark dissectors from C structs.
@@ -53,19 +56,41 @@ optional arguments:
   -D, --Define          predefine name as a Cpp macro
   -U, --Undefine        cancel any previous Cpp definition of name
   -A, --Additional      any additional C preprocessor arguments
+  --cache-dir           cache C preprocessor output in directory
+  --cache-ast           cache the parsed C code in the cache directory
+  --incremental         only regenerate dissectors whose input changed
+  -j, --jobs            parse headers using N processes
+  --batch-cpp           run many headers through one C preprocessor call
+  --loop-arrays         dissect array elements in a loop instead of unrolled
+  --stats               write the time spent in each stage, for each header
+                        and platform, to file as JSON
+  --serve               answer JSON-RPC requests on stdin to regenerate
+                        dissectors, keeping parsed headers in memory
+  --watch               regenerate dissectors when headers or configs change
 
 Example:
 "python csjark.py -v --nocpp headerfile.h configfile.yml"
 """
 import sys
 import os
+import time
 import argparse
+import contextlib
+import multiprocessing
+from operator import attrgetter
 
 import cpp
 import cparser
 import config
+import cache
+import stats
 from config import Options, FileConfig
 from field import ProtocolField
+from platform import Platform
+from session import Session
+from layout import Layout
+from scanner import Excludes, find_files
+from manifest import Manifest
 
 
 def parse_args(args=None):
@@ -144,6 +169,47 @@ def parse_args(args=None):
     parser.add_argument('-A', '--Additional', metavar='argument', default=[],
             nargs='*', help='any additional C preprocessor arguments')
 
+    # Directory to cache C preprocessor output in
+    parser.add_argument('--cache-dir', metavar='directory',
+            help='cache C preprocessor output in directory')
+
+    # Cache the parsed AST as well
+    parser.add_argument('--cache-ast', action='store_true',
+            default=Options.cache_ast,
+            help='cache the parsed C code in the cache directory')
+
+    # Only regenerate dissectors whose input changed
+    parser.add_argument('--incremental', action='store_true',
+            default=Options.incremental,
+            help='only regenerate dissectors whose input changed')
+
+    # Number of processes to parse headers with
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+            default=Options.jobs, help='parse headers using N processes')
+
+    # Preprocess many headers with one call to the C preprocessor
+    parser.add_argument('--batch-cpp', action='store_true',
+            default=Options.batch_cpp,
+            help='run many headers through one C preprocessor call')
+
+    # Dissect arrays in Lua loops instead of unrolling them
+    parser.add_argument('--loop-arrays', action='store_true',
+            default=Options.loop_arrays,
+            help='dissect array elements in a loop instead of unrolled')
+
+    # Measure the time spent in each stage of generating dissectors
+    parser.add_argument('--stats', metavar='file', default=Options.stats,
+            help='write the time spent in each stage, for each header '
+                 'and platform, to file as JSON')
+
+    # Keep running, regenerating dissectors when asked or files change
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--serve', action='store_true', default=Options.serve,
+            help='answer JSON-RPC requests on stdin to regenerate '
+                 'dissectors, keeping parsed headers in memory')
+    modes.add_argument('--watch', action='store_true', default=Options.watch,
+            help='regenerate dissectors when headers or configs change')
+
     # Parse arguments
     if args is None:
         namespace = parser.parse_args()
@@ -163,6 +229,17 @@ def parse_args(args=None):
     Options.default.defines = namespace.Define
     Options.default.undefines = namespace.Undefine
     Options.default.args = namespace.Additional
+    Options.jobs = max(1, namespace.jobs)
+    Options.batch_cpp = namespace.batch_cpp
+    if namespace.cache_dir:
+        Options.cache_dir = namespace.cache_dir
+    Options.cache_ast = namespace.cache_ast
+    Options.incremental = namespace.incremental
+    Options.loop_arrays = namespace.loop_arrays
+    Options.stats = namespace.stats
+    stats.enabled = Options.stats is not None
+    Options.serve = namespace.serve
+    Options.watch = namespace.watch
 
     headers = namespace.file
     if namespace.header:
@@ -194,23 +271,10 @@ def parse_args(args=None):
         sys.exit(2)
 
     # Recursively search folders for C header and config files
-    def files_in_folder(var, file_extensions):
-        folders = [folder for folder in var if os.path.isdir(folder)]
-        while len(folders):
-            folder = folders.pop()
-            if folder in var:
-                var.remove(folder)
-            for path in os.listdir(folder):
-                full_path = os.path.normpath(os.path.join(folder, path))
-                if full_path in Options.excludes:
-                    continue
-                if os.path.isdir(full_path):
-                    folders.append(full_path)
-                elif os.path.splitext(path)[1] in file_extensions:
-                    var.append(full_path)
-
-    files_in_folder(headers, ('.h', '.hpp'))
-    files_in_folder(configs, ('.yml', ))
+    Options.inputs = list(headers)
+    excludes = Excludes(Options.excludes)
+    headers = find_files(headers, ('.h', '.hpp'), excludes)
+    configs = find_files(configs, ('.yml', ), excludes)
 
     # Normalize all header paths
     headers = [os.path.normpath(i) for i in headers]
@@ -218,143 +282,210 @@ def parse_args(args=None):
     return headers, configs
 
 
-def parse_headers(headers):
-    """Parse 'headers' to create a Wireshark protocol dissector."""
-    folders = {os.path.dirname(i) for i in headers} # Folders to -Include
-    failed = [] # Filenames, platforms pairs we have failed to parse so far
-
-    def include_heuristics(filename, platform, error):
-        """Try to find missing includes from error message."""
-        include = None
-        msg = str(error)
-        if 'before: ' in msg:
-            key = msg.rsplit('before: ', 1)[1].strip()
-            include = cparser.StructVisitor.all_known_types.get(key, None)
-        if include is None:
-            return False, None
-
-        # Problem with typedef, TODO: improve this error handling
-        if filename == include:
-            return False, None
-
-        new_error = create_dissector(filename, platform, folders, [include])
-        if new_error != error:
-            FileConfig.add_include(filename, include)
-            if new_error is None:
-                return True, None # Worked
-            return False, new_error # Try more
-        return False, None # Give up
-
-    def print_status(tries=[]):
-        """Print a status message with how many headers failed to parse."""
-        if tries and tries[-1] == 0:
-            return
-        tries.append(len({i for i, j, k in failed}))
-        if tries[-1] == 0:
-            msg = 'Successfully parsed all %i' % len(headers)
-        else:
-            msg = 'Failed to parse %i out of %i' % (tries[-1], len(headers))
-        print('[%i] %s header files' % (len(tries), msg))
+def parse_headers(headers, folders=None, session=None):
+    """Parse 'headers' to create a Wireshark protocol dissector.
+
+    'folders' is a set of all folders to -Include, defaults to the
+    folders of 'headers'.
+    'session' is the Session to store the protocols in, the default
+    session if None.
+    Returns the number of headers which failed to parse.
+    """
+    return len(_parse_headers(headers, folders, session))
 
-    def filenames_have_shared_path(f1, f2):
-        p1 = os.path.dirname(f1)
-        p2 = os.path.dirname(f2)
-        c = os.path.commonprefix([p1, p2])
-        return c == p1 or c == p2
+
+def _parse_headers(headers, folders=None, session=None, scanned=None):
+    """Parse 'headers', returns a set of the headers which failed.
+
+    'scanned' is a list of all headers which may declare the types and
+    macros used by 'headers', defaults to 'headers'.
+    """
+    if session is None:
+        session = Session.default()
+    options = session.options
+    if folders is None:
+        folders = {os.path.dirname(i) for i in headers} # Folders to -Include
+    if scanned is None:
+        scanned = headers
+
+    # Include headers declaring types used by other headers up front,
+    # so every header is parsed once for each platform
+    if options.use_cpp:
+        dependencies = cpp.find_dependencies(
+                scanned, sorted(folders), session)
+        for filename in headers:
+            for include in dependencies.get(filename, []):
+                FileConfig.add_include(filename, include, options)
 
     print('[0] Attempting to parse %i header files' % len(headers))
 
-    # First try, in the order given through the CLI
+    # In the order given through the CLI
+    platforms = sorted(options.platforms, key=attrgetter('flag'))
+    if options.jobs > 1:
+        errors = parse_in_parallel(headers, platforms, folders, session)
+    else:
+        errors = _parse_serially(headers, platforms, folders, session)
+    failed = [] # Filenames, platforms pairs we failed to parse
     for filename in headers:
-        for platform in Options.platforms:
-            error = create_dissector(filename, platform, folders)
+        for platform in platforms:
+            error = next(errors)
             if error is not None:
                 failed.append([filename, platform, error])
-    print_status()
-
-    # Try to include files based on decoding the error messages
-    work_list = failed[:]
-    for tmp in range(2, 4):
-        for i in reversed(range(len(work_list))):
-            status, new_error = include_heuristics(*work_list[i])
-            if not status and new_error is not None:
-                work_list[i][2] = new_error
-            else:
-                if status:
-                    failed.remove(work_list[i])
-                work_list.pop(i)
-        print_status()
-
-    # Try to include all who worked as it might help
-    failed_names = [filename for filename, platform, error in failed]
-    includes = [f for f in headers if f not in failed_names and
-                            filenames_have_shared_path(filename, f)]
-
-    for i in reversed(range(len(failed))):
-        filename, platform, tmp = failed.pop(i)
-        error = create_dissector(filename, platform, folders, includes)
-        if error is None:
-            # Worked, record it in case anyone else needs this file
-            for inc in includes:
-                FileConfig.add_include(filename, inc)
-            includes.append(filename)
-        else:
-            failed.append([filename, platform, error])
-    print_status()
-
-    # Try to include files based on decoding the error messages
-    work_list = failed[:]
-    for tmp in range(5, 7):
-        for i in reversed(range(len(work_list))):
-            status, new_error = include_heuristics(*work_list[i])
-            if not status and new_error is not None:
-                work_list[i][2] = new_error
-            else:
-                if status:
-                    failed.remove(work_list[i])
-                work_list.pop(i)
-        print_status()
+
+    count = len({i for i, j, k in failed})
+    if count == 0:
+        msg = 'Successfully parsed all %i' % len(headers)
+    else:
+        msg = 'Failed to parse %i out of %i' % (count, len(headers))
+    print('[1] %s header files' % msg)
 
     # Give up!
     for filename, platform, error in failed:
         print('Skipped "%s":%s as it raised %s' % (
                 filename, platform.name, repr(error)))
 
-    return len({i for i, j, k in failed})
+    return {i for i, j, k in failed}
+
+def parse_in_parallel(headers, platforms, folders, session=None):
+    """Parse every header for every platform in a pool of processes.
+
+    Yields the error for each header and platform pair, in the same order
+    as when parsing them one after another, None if parsing succeeded.
+    Protocols found by the processes are merged into 'session' in that
+    order, so the result is the same as parsing them in this process.
+    """
+    if session is None:
+        session = Session.default()
+    options = session.options
+    units = [(filename, platform.name, folders)
+             for filename in headers for platform in platforms]
+    with multiprocessing.Pool(options.jobs, _init_worker,
+                              (options.get_state(), )) as pool:
+        results = pool.imap(_parse_unit, units)
+        for (filename, name, tmp), result in zip(units, results):
+            protocols, types, (hits, misses, records) = result
+            cache.update_counts(hits, misses)
+            stats.update(records)
+            platform = Platform.mappings[name]
+            if protocols is not None and session.merge(
+                    protocols, types, platform):
+                if options.verbose:
+                    print("Parsed header file '%s':%s successfully." % (
+                            filename, platform.name))
+                yield None
+            else:
+                # Parse again here, to get the same error as a serial run
+                yield create_dissector(
+                        filename, platform, folders, None, session)
+
+
+def _parse_serially(headers, platforms, folders, session=None):
+    """Parse every header for every platform in this process.
 
-def create_dissector(filename, platform, folders=None, includes=None):
+    Yields the error for each header and platform pair, in header order,
+    None if parsing succeeded.
+    The C preprocessor output of a header is parsed and described once
+    for all the platforms it is the same for, and only laid out for each
+    platform. With the batch_cpp option, up to cpp.BATCH_SIZE headers are
+    run through the C preprocessor at once for each platform.
+    """
+    if session is None:
+        session = Session.default()
+    options = session.options
+    size = 1
+    if options.batch_cpp and options.use_cpp:
+        size = cpp.BATCH_SIZE
+    for i in range(0, len(headers), size):
+        batch = headers[i:i + size]
+        texts = {platform: cpp.parse_files(batch, platform, folders, session)
+                 for platform in platforms}
+        for filename in batch:
+            found = {} # Map preprocessed text to its declarations
+            for platform in platforms:
+                text = texts[platform][filename]
+                if text not in found:
+                    try:
+                        with stats.measure('parse', filename) as measure:
+                            ast = cparser.parse(text, filename,
+                                                session=session)
+                            measure.bytes = len(text)
+                        with stats.measure('visit', filename):
+                            found[text] = cparser.describe(ast)
+                    except Exception:
+                        found[text] = None # Parse again to report the error
+                yield create_dissector(filename, platform, folders, None,
+                                       session, text, found[text])
+
+
+def _init_worker(state):
+    """Set up the options of a process in the parse_in_parallel pool."""
+    Options.set_state(state)
+    Options.verbose = Options.debug = False # Failures are parsed again
+    stats.enabled = Options.stats is not None
+
+
+def _parse_unit(unit):
+    """Parse a header for a platform in a parse_in_parallel process.
+
+    Returns the protocols and known types found, or None if parsing failed,
+    and the cache hits and misses and the stats records.
+    """
+    filename, name, folders = unit
+    session = Session(Options) # Nothing is shared with the previous unit
+    cache.hits.clear()
+    cache.misses.clear()
+    stats.records.clear()
+    platform = Platform.mappings[name]
+    counts = cache.hits, cache.misses, stats.records
+    if create_dissector(filename, platform, folders, None, session) is not None:
+        return None, None, counts
+    return session.protocols, session.known_types, counts
+
+
+def create_dissector(filename, platform, folders=None,
+                     includes=None, session=None, text=None,
+                     declarations=None):
     """Parse 'filename' to create a Wireshark protocol dissector.
 
     'filename' is the C header/code file to parse.
     'platform' is the platform we should simulate.
     'folders' is a set of all folders to -Include.
     'includes' is a set of filenames to #include.
+    'session' is the Session to store the protocols in, the default
+    session if None. Nothing is stored if parsing fails.
+    'text' is the output of the C preprocessor for 'filename', if it has
+    already been run.
+    'declarations' is the structs described from 'text', if it has
+    already been parsed.
     Returns the error if parsing failed, None if succeeded.
     """
+    if session is None:
+        session = Session.default()
+    options = session.options
     try:
-        text = cpp.parse_file(filename, platform, folders, includes)
-        ast = cparser.parse(text, filename)
-        cparser.find_structs(ast, platform)
+        with session.transaction():
+            if text is None:
+                text = cpp.parse_file(filename, platform, folders,
+                                      includes, session)
+            if declarations is None:
+                with stats.measure('parse', filename, platform) as measure:
+                    ast = cparser.parse(text, filename, session=session)
+                    measure.bytes = len(text)
+                with stats.measure('visit', filename, platform):
+                    declarations = cparser.describe(ast)
+            with stats.measure('layout', filename, platform):
+                Layout(platform, session).create(declarations)
     except OSError:
         raise
     except Exception as err:
-        # Clean up a bit
-        try:
-            del cparser.StructVisitor._last_proto.dissectors[platform]
-            del cparser.StructVisitor._last_visitor
-            del cparser.StructVisitor._last_diss
-            del cparser.StructVisitor._last_proto
-        except Exception:
-            pass
-
-        if Options.verbose:
+        if options.verbose:
             print('Failed "%s":%s which raised %s' % (
                     filename, platform.name, repr(err)))
-        if Options.debug:
+        if options.debug:
             sys.excepthook(*sys.exc_info())
         return err
 
-    if Options.verbose:
+    if options.verbose:
         print("Parsed header file '%s':%s successfully." % (
                 filename, platform.name))
 
@@ -362,34 +493,69 @@ def create_dissector(filename, platform, folders=None, includes=None):
     #    ast.show()
 
 
-def _write_dissector(name, proto):
-    """Write a single dissector to file."""
+def _write_dissector(name, proto, manifest=None, options=Options):
+    """Write a single dissector to file.
+
+    Returns False if 'manifest' shows that the file is unchanged.
+    """
     path = '%s.lua' % name
     flag = 'w'
-    if Options.output_dir:
-        path = '%s/%s' % (Options.output_dir, path)
-    elif Options.output_file:
-        path = Options.output_file
+    if options.output_dir:
+        path = '%s/%s' % (options.output_dir, path)
+    elif options.output_file:
+        path = options.output_file
         flag = 'a'
 
-    code = proto.generate()
-    with open(path, flag) as f:
-        f.write(code)
-
-    if Options.verbose:
+    if manifest is None:
+        with open(path, flag) as f:
+            _write_protocol(proto, f)
+    else:
+        # Stream to a new file, which replaces the old one only if changed
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, flag) as f:
+            writer = cache.KeyWriter(f)
+            _write_protocol(proto, writer)
+        if not manifest.update_protocol(proto, path, writer.key):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+
+    if options.verbose:
         print("Wrote %s to '%s' (%i platform(s))" %
                 (name, path, len(proto.dissectors)))
+    return True
+
+
+def _write_protocol(proto, out):
+    """Write the code of 'proto' to 'out', measuring it if stats are on."""
+    if not stats.enabled:
+        return proto.write(out)
+    writer = stats.Writer(out, getattr(proto, '_file', None))
+    proto.write(writer)
+    writer.close()
 
 
-def write_dissectors_to_file(all_protocols):
-    """Write lua dissectors to file(s)."""
+def write_dissectors_to_file(all_protocols, manifest=None,
+                             session=None, names=None):
+    """Write lua dissectors to file(s).
+
+    'manifest' is used to skip writing dissectors which are unchanged.
+    'session' is the Session with the options, the default if None.
+    'names' is the names of the protocols to write, all if None, it
+    must be None when all dissectors are written to a single file.
+    Returns the number of dissectors written.
+    """
+    if session is None:
+        session = Session.default()
+    options = session.options
+
     # Delete output_file if it already exists
-    if Options.output_file and os.path.isfile(Options.output_file):
-        os.remove(Options.output_file)
+    if options.output_file and os.path.isfile(options.output_file):
+        os.remove(options.output_file)
 
     # Sort which dissectors to write out
     protocols = all_protocols
-    if Options.strict:
+    if options.strict:
         def find_proto(proto):
             found = []
             # Possible endless loop?
@@ -401,74 +567,126 @@ def write_dissectors_to_file(all_protocols):
 
         protocols = {p.name: p for p in protocols.values() if p.id}
         for proto in list(protocols.values()):
-            names = find_proto(proto.dissectors.values())
-            protocols.update({name: all_protocols[name] for name in names})
+            found = find_proto(proto.dissectors.values())
+            protocols.update({name: all_protocols[name] for name in found})
+    if names is not None:
+        protocols = {k: v for k, v in protocols.items() if k in names}
 
     # Generate and write lua dissectors
+    wrote = 0
     for name, proto in protocols.items():
-        _write_dissector(name, proto)
+        wrote += _write_dissector(name, proto, manifest, options)
 
-    return len(protocols)
+    return wrote
 
 
-def write_delegator_to_file():
+def write_delegator_to_file(session=None):
     """Write the lua file which delegates dissecting to dissectors."""
+    if session is None:
+        session = Session.default()
+    options = session.options
     filename = 'luastructs.lua'
-    if Options.output_dir:
-        filename = '%s/%s' % (Options.output_dir, filename)
+    if options.output_dir:
+        filename = '%s/%s' % (options.output_dir, filename)
 
     with open(filename, 'w') as f:
-        f.write(Options.delegator.generate())
+        options.delegator.write(f)
 
-    if Options.verbose:
+    if options.verbose:
         print("Wrote delegator file to '%s'" % filename)
 
 
-def write_placeholders_to_file(protocols):
+def write_placeholders_to_file(protocols, session=None):
     """Write a placeholder file for 'protocols' with no configuration."""
-    if not protocols or not Options.generate_placeholders:
+    if session is None:
+        session = Session.default()
+    options = session.options
+    if not protocols or not options.generate_placeholders:
         return
 
-    text, count = config.generate_placeholders(protocols)
+    text, count = config.generate_placeholders(protocols, options)
     filename = 'placeholders.yml'
     with open(filename, 'w') as f:
         f.write(text)
 
-    if Options.verbose:
+    if options.verbose:
         print("Wrote %i config placeholders to '%s'" % (count, filename))
 
 
 def main():
     """Run the CSjark program."""
+    start = time.perf_counter()
     headers, configs = parse_args()
 
+    # Regenerate dissectors when the files they are built from change
+    if Options.watch:
+        from watcher import Watcher # Which imports this module
+        Watcher(Options.inputs, configs, Options.create()).run()
+        return
+
     # Parse config files
     for filename in configs:
         config.parse_file(filename)
     Options.prepare_for_parsing()
 
     # Remove excluded headers
-    for path in set(Options.excludes):
-        for filename in [i for i in headers if i.startswith(path)]:
-            headers.remove(filename)
+    headers = Excludes(Options.excludes).filter(headers)
+
+    # Keep the parsed headers in memory, and answer requests until shut down
+    if Options.serve:
+        from server import Server # Which imports this module
+        server = Server(headers)
+        with contextlib.redirect_stdout(sys.stderr):
+            server.parse()
+        server.serve()
+        return
+
+    # Only parse headers which changed since the previous run
+    folders = {os.path.dirname(i) for i in headers} # Folders to -Include
+    scanned = headers
+    manifest = None
+    if Options.incremental and not Options.output_file:
+        manifest = Manifest(Session.default())
+        rewrite_all = manifest.is_new
+        manifest.restore(headers)
+        changed = manifest.changed_headers(headers, folders)
+        if Options.verbose:
+            print('%i of %i header files changed since the previous run' % (
+                    len(changed), len(headers)))
+        if not Options.generate_placeholders:
+            headers = changed
 
     # Parse all headers to create protocols
-    failed = parse_headers(headers)
+    failed = _parse_headers(headers, folders, scanned=scanned)
 
     # Write dissectors to disk
-    protocols = cparser.StructVisitor.all_protocols
-    wrote = write_dissectors_to_file(protocols)
-    write_delegator_to_file()
+    protocols = Session.default().protocols
+    wrote = write_dissectors_to_file(protocols, manifest)
+    if manifest is None or rewrite_all:
+        write_delegator_to_file()
     write_placeholders_to_file(protocols)
 
+    # Remember what the dissectors were built from
+    if manifest is not None:
+        manifest.update_headers(headers, failed)
+        for path in manifest.remove_stale(
+                [i for i in headers if i not in failed], protocols):
+            print("Removed '%s' as its struct no longer exists" % path)
+        manifest.save()
+
     # Write out a status message
     if failed:
-        count = len(headers) - failed
+        count = len(headers) - len(failed)
         msg = 'Successfully parsed %i out of %i files' % (count, len(headers))
     else:
         msg = 'Successfully parsed all %i files' % len(headers)
     print("%s for %i platforms, created %i dissectors" % (
             msg, len(Options.platforms), wrote))
+    if Options.verbose and Options.cache_dir is not None:
+        cache.print_counts()
+    if Options.stats is not None:
+        stats.write_report(Options.stats, time.perf_counter() - start)
+        print("Wrote statistics to '%s'" % Options.stats)
 
 
 if __name__ == "__main__":
@@ -28,6 +28,8 @@ which decides which Wireshark dissector to call from each message id.
 """
 from platform import Platform
 from field import create_lua_var, create_lua_valuestring, BaseField, Field
+from field import RANGE_VAR
+from field import ArrayField, ProtocolField
 
 
 class Dissector(BaseField):
@@ -37,12 +39,13 @@ class Dissector(BaseField):
     dissecting a packet into a set of fields with values.
     """
 
-    def __init__(self, name, platform, conf=None):
+    def __init__(self, name, platform, conf=None, platforms=None):
         """Create a new dissector instance.
 
         'name' is the protocol name
         'platform' is the platform dissecting messages from
         'conf' is an optional config object
+        'platforms' is all platforms supported, Options.platforms if None
         """
         self.name = name
         self.platform = platform
@@ -50,8 +53,10 @@ class Dissector(BaseField):
         self.conf = conf
 
         self.field_var = 'f.'
-        from config import Options
-        if len(Options.platforms) > 1:
+        if platforms is None:
+            from config import Options
+            platforms = Options.platforms
+        if len(platforms) > 1:
             self.field_var += create_lua_var(platform.name)
 
         self.children = [] # List of all child fields
@@ -59,14 +64,27 @@ class Dissector(BaseField):
         self._pushed = False
         self._increase_offset = True
 
+        # Layout of the fields, found when needed until a field is added
+        self._size = None
+        self._alignment = None
+        self._offsets = {} # Map start offset to offsets of the fields
+
     @property
     def alignment(self):
         """Find the alignment size of the fields in the protocol."""
-        return max([0] + [f.alignment for f in self.children])
+        if self._alignment is None:
+            self._alignment = max([0] + [f.alignment for f in self.children])
+        return self._alignment
 
     @property
     def size(self):
         """Find the size of the fields in the protocol."""
+        if self._size is None:
+            self._size = self._find_size()
+        return self._size
+
+    def _find_size(self):
+        """Find the size of the fields, with padding."""
         size = 0
         for field in self.children:
             if field.size:
@@ -77,8 +95,28 @@ class Dissector(BaseField):
     def add_field(self, field):
         """Add a field to the dissectors list of field."""
         self.children.append(field)
+        self._size = self._alignment = None
+        self._offsets.clear()
         return field
 
+    def get_offsets(self, offset=0):
+        """Get the offset of every field, with padding.
+
+        'offset' is the offset the first field starts at.
+        Returns a list with the offset of each field, followed by the
+        offset after the last field.
+        """
+        offsets = self._offsets.get(offset, None)
+        if offsets is None:
+            offsets = self._offsets[offset] = []
+            for field in self.children:
+                offset = self.get_padding(field, offset)
+                offsets.append(offset)
+                if self._increase_offset:
+                    offset += field.size
+            offsets.append(offset)
+        return offsets
+
     def push_modifiers(self):
         """Push prefixes and postfixes down to child fields."""
         if self._pushed:
@@ -91,47 +129,69 @@ class Dissector(BaseField):
 
     def get_definition(self):
         """Get the ProtoField definition for this field."""
-        data = []
+        return '\n'.join(self.iter_definition())
 
+    def iter_definition(self):
+        """Generate the ProtoField definitions in chunks of code."""
         for field in self.children:
-            code = field.get_definition()
-
             if self.conf and self.conf.cnf: # Conformance file code
-                code = self.conf.cnf.match(field.name, code, definition=True)
-            data.append(code)
+                code = self.conf.cnf.match(
+                        field.name, field.get_definition(), definition=True)
+                if code is not None:
+                    yield code
+            else:
+                yield from field.iter_definition()
 
         # Conformance file definition code extra
         if self.conf and self.conf.cnf:
-            data.append(self.conf.cnf.match(None, None, definition=True))
-
-        return '\n'.join(i for i in data if i is not None)
+            code = self.conf.cnf.match(None, None, definition=True)
+            if code is not None:
+                yield code
 
     def get_code(self, offset, store=None, tree='subtree'):
         """Get the code for dissecting this field."""
-        self.offset = offset
-        data = []
+        return '\n'.join(self.iter_code(offset, store, tree))
 
-        for field in self.children:
-            offset = self.get_padding(field, offset)
-            code = field.get_code(offset, store=store, tree=tree)
+    def iter_code(self, offset, store=None, tree='subtree'):
+        """Generate the code for dissecting this field in chunks.
 
+        A conformance file can only modify the code of a field as a whole,
+        so with one the code is generated a field at a time.
+        """
+        self.offset = offset
+        offsets = self.get_offsets(offset)
+
+        for field, offset in zip(self.children, offsets):
             # Conformance file code
             if self.conf and self.conf.cnf:
-                code = self.conf.cnf.match(field.name, code, False, field)
-            data.append(code)
-
-            if self._increase_offset:
-                offset += field.size
+                code = self.conf.cnf.match(field.name, field.get_code(
+                        offset, store=store, tree=tree), False, field)
+                if code is not None:
+                    yield code
+            else:
+                yield from field.iter_code(offset, store=store, tree=tree)
 
         # Conformance file dissection function code extra
         if self.conf and self.conf.cnf:
-            data.append(self.conf.cnf.match(None, None, definition=False))
+            code = self.conf.cnf.match(None, None, definition=False)
+            if code is not None:
+                yield code
 
         # Delegate rest of buffer to any trailing protocols
         if self.conf and self.conf.trailers:
-            data.append(self._trailers(self.conf.trailers, offset))
+            yield self._trailers(self.conf.trailers, offsets[-1])
 
-        return '\n'.join(i for i in data if i is not None)
+    @property
+    def calls_dissectors(self):
+        """True if the code calls other dissectors, by fields or trailers."""
+        def traverse(children):
+            for field in children:
+                while isinstance(field, ArrayField):
+                    field = field.element
+                if isinstance(field, ProtocolField) or traverse(field.children):
+                    return True
+            return False
+        return bool(self.conf and self.conf.trailers) or traverse(self.children)
 
     def get_padding(self, field, offset):
         """Get padding for correct alignment."""
@@ -178,11 +238,11 @@ class Dissector(BaseField):
                 data.append('\tfor i = 1, {count} do'.format(count=count))
                 tabs += '\t'
 
-            t1 = '{tabs}local trailer = Dissector.get("{name}")'
-            t2 = '{tabs}trailer:call(buffer({off}{size}):tvb(), pinfo, tree)'
+            t1 = '{tabs}dissectors["{name}"]:call(buffer({off}{size}):tvb(), '\
+                 'pinfo, tree)'
             t3 = '{tabs}{var} = {var} + {size}'
-            data.append(t1.format(tabs=tabs, name=rule.name))
-            data.append(t2.format(tabs=tabs, off=off_var, size=size_str))
+            data.append(t1.format(tabs=tabs, name=rule.name,
+                                  off=off_var, size=size_str))
 
             # Update offset after all but last trailer
             if i < len(rules)-1:
@@ -203,13 +263,37 @@ class UnionDissector(Dissector):
         super().__init__(*args, **vargs)
         self._increase_offset = False
 
-    @property
-    def size(self):
-        """Find the size of the fields in the protocol."""
+    def _find_size(self):
+        """Find the size of the largest field, with padding."""
         return self.get_padding(self, max(
                 [0] + [field.size for field in self.children]))
 
 
+def _any_field(fields, test):
+    """True if 'test' is true for any of 'fields', or the fields inside."""
+    for field in fields:
+        if test(field):
+            return True
+        if isinstance(field, ArrayField):
+            children = [field.element] # Every element is the same
+        else:
+            children = field.children
+        if _any_field(children, test):
+            return True
+    return False
+
+
+def _has_lazy_arrays(fields):
+    """True if any of 'fields', or the fields inside them, is lazy."""
+    return _any_field(fields, lambda field: getattr(field, 'lazy', False))
+
+
+def _declare_range(fields):
+    """Generate the code declaring RANGE_VAR, if any of 'fields' use it."""
+    if _any_field(fields, lambda field: getattr(field, 'uses_range', False)):
+        yield '\tlocal %s' % RANGE_VAR
+
+
 class Protocol:
     """A Protocol is a collection of platform specific dissectors.
 
@@ -219,8 +303,6 @@ class Protocol:
 
     REGISTER_FUNC = 'delegator_register_proto'
 
-    protocols = {} # Map protocol name to instance
-
     def __init__(self, name, id=None, description=None):
         """Create a Protocol, for generating a dissector.
 
@@ -241,44 +323,68 @@ class Protocol:
         return self.dissectors.get(platform.name, None)
 
     @classmethod
-    def create_dissector(cls, name, platform=None, conf=None, union=False):
-        """Create a new dissector and protocol if needed."""
+    def create_dissector(cls, name, platform=None, conf=None,
+                         union=False, session=None):
+        """Create a new dissector and protocol if needed.
+
+        'session' is the Session which holds the protocols, the default
+        session if None.
+        """
         if platform is None:
             platform = Platform.mappings['default']
+        if session is None:
+            from session import Session
+            session = Session.default()
 
         # Create a new Protocol if one does not already exists
         try:
-            proto = cls.protocols[name]
+            proto = session.protocols[name]
         except KeyError:
             vargs = {}
             if conf is not None:
                 vargs['id'] = conf.id
                 vargs['description'] = conf.description
             proto = Protocol(name, **vargs)
-            cls.protocols[name] = proto
+            session.set(session.protocols, name, proto)
 
         # Create the actual dissector or union dissector
+        platforms = session.options.platforms
         if not union:
-            dissector = Dissector(name, platform, conf)
+            dissector = Dissector(name, platform, conf, platforms)
         else:
-            dissector = UnionDissector(name, platform, conf)
-        proto.dissectors[platform.name] = dissector
+            dissector = UnionDissector(name, platform, conf, platforms)
+        session.set(proto.dissectors, platform.name, dissector)
 
         return proto, dissector
 
     def generate(self):
         """Returns all the code for dissecting this protocol."""
+        return '\n'.join(self.generate_chunks())
+
+    def write(self, out):
+        """Write all the code for dissecting this protocol to 'out'.
+
+        The code is written in chunks as it is generated, so it is never
+        held in memory as a whole. 'out' is a file-like object.
+        """
+        chunks = self.generate_chunks()
+        out.write(next(chunks, ''))
+        for chunk in chunks:
+            out.write('\n')
+            out.write(chunk)
+
+    def generate_chunks(self):
+        """Generate all the code for dissecting this protocol in chunks."""
         for child in self.dissectors.values():
             child.push_modifiers()
 
         # Create dissector content
-        data = []
-        data.append(self._legal_header())
-        data.append(self._header_defintion())
-        data.append(self._fields_definition())
-        data.append(self._dissector_func())
-        data.append(self._register_dissector())
-        return '\n'.join(i for i in data if i is not None)
+        for code in (self._legal_header(), self._header_defintion()):
+            if code is not None:
+                yield code
+        yield from self._fields_definition()
+        yield from self._dissector_func()
+        yield self._register_dissector()
 
     def _legal_header(self):
         """Add the legal header with license info."""
@@ -299,46 +405,61 @@ class Protocol:
 
     def _fields_definition(self):
         """Add code for defining the ProtoField's in the protocol."""
-        data = ['-- ProtoField defintions for: %s' % self.name]
+        yield '-- ProtoField defintions for: %s' % self.name
         decl = 'local {field_var} = {var}.fields'
-        data.append(decl.format(field_var='f', var=self.var))
+        yield decl.format(field_var='f', var=self.var)
+
+        # Dissectors called by this protocol, looked up once on first use
+        if any(child.calls_dissectors for child in self.dissectors.values()):
+            yield ('local dissectors = setmetatable({}, {__index = '
+                    'function(t, name)\n\tt[name] = Dissector.get(name)\n'
+                    '\treturn t[name]\nend})')
+
+        # Preference for dissecting large arrays when the tree is hidden
+        if any(_has_lazy_arrays(child.children)
+               for child in self.dissectors.values()):
+            yield 'local prefs = {var}.prefs'.format(var=self.var)
+            yield ('prefs.decode_arrays = Pref.bool("Decode large '
+                    'arrays", false, "Dissect the elements of arrays above '
+                    'the threshold even when the tree is not visible")')
+
         for child in self.dissectors.values():
-            data.append(child.get_definition())
-        data.append('')
-        return '\n'.join(i for i in data if i is not None)
+            yield from child.iter_definition()
+        yield ''
 
     def _dissector_func(self):
         """Add the code for the dissector function for the protocol."""
-        data = ['-- Dissector function for: %s' % self.name]
+        yield '-- Dissector function for: %s' % self.name
 
         def retrieve_pinfo():
-            data.append('\tif pinfo.private.field_name then')
+            yield '\tif pinfo.private.field_name then'
             t = '\t\tsubtree:set_text(pinfo.private.field_name .. ": {name}")'
-            data.append(t.format(name=child.name))
-            data.append('\t\tpinfo.private.field_name = nil\n\telse')
+            yield t.format(name=child.name)
+            yield '\t\tpinfo.private.field_name = nil\n\telse'
             t = '\t\tpinfo.cols.info:append("({desc})")'
-            data.append(t.format(desc=self.description))
-            data.append('\tend')
+            yield t.format(desc=self.description)
+            yield '\tend'
 
         # Dissector function
         func_diss = 'function {var}.dissector(buffer, pinfo, tree)'
-        data.append(func_diss.format(var=self.var))
+        yield func_diss.format(var=self.var)
 
         # Retrieve flag value from private info table
         flag_var = create_lua_var('flag')
         flag = '\tlocal {var} = tonumber(pinfo.private.platform_flag)'
-        data.append(flag.format(var=flag_var))
+        yield flag.format(var=flag_var)
 
         # If only 1 or less dissectors, insert dissector code directly
         if len(self.dissectors) < 2:
             if self.dissectors:
                 child = list(self.dissectors.values())[0]
                 sub_tree = '\tlocal subtree = tree:{add}({var}, buffer())'
-                data.append(sub_tree.format(add=child.add_var, var=self.var))
-                retrieve_pinfo()
-                data.append(child.get_code(0))
-            data.extend(['end', ''])
-            return '\n'.join(i for i in data if i is not None)
+                yield sub_tree.format(add=child.add_var, var=self.var)
+                yield from retrieve_pinfo()
+                yield from _declare_range(child.children)
+                yield from child.iter_code(0)
+            yield from ['end', '']
+            return
 
         # Get flags and call the platform specific function
         table = {}
@@ -347,36 +468,35 @@ class Protocol:
                     '%s_%s' % (self.var, child.platform.name))
             table[child.platform.flag] = child._func_name
         table = create_lua_valuestring(table, wrap=False)
-        data.append('\tlocal func_mapping = {table}'.format(table=table))
-        data.append('\tif func_mapping[{var}] then'.format(var=flag_var))
+        yield '\tlocal func_mapping = {table}'.format(table=table)
+        yield '\tif func_mapping[{var}] then'.format(var=flag_var)
         call = '\t\t func_mapping[{var}](buffer, pinfo, tree)'
-        data.append(call.format(var=flag_var))
-        data.extend(['\tend', 'end', ''])
+        yield call.format(var=flag_var)
+        yield from ['\tend', 'end', '']
 
         # Modify name if sub-dissector
         pinfo_func = create_lua_var('%s_pinfo_magic' % self.var)
-        data.append('-- Function for retrieving parent dissector name')
-        data.append('function {func}(pinfo, subtree)'.format(func=pinfo_func))
-        retrieve_pinfo()
-        data.extend(['end', ''])
+        yield '-- Function for retrieving parent dissector name'
+        yield 'function {func}(pinfo, subtree)'.format(func=pinfo_func)
+        yield from retrieve_pinfo()
+        yield from ['end', '']
 
         # Create dissector function for each dissector
         for child in self.dissectors.values():
-            data.append('-- Dissector function for: %s (platform: %s)' % (
-                    child.name, child.platform.name))
+            yield '-- Dissector function for: %s (platform: %s)' % (
+                    child.name, child.platform.name)
             func = 'function {name}(buffer, pinfo, tree)'
-            data.append(func.format(name=child._func_name))
+            yield func.format(name=child._func_name)
 
             # Add subtree
             sub_tree = '\tlocal subtree = tree:{add}({var}, buffer())'
-            data.append(sub_tree.format(add=child.add_var, var=self.var))
-            data.append('\t{func}(pinfo, subtree)'.format(func=pinfo_func))
+            yield sub_tree.format(add=child.add_var, var=self.var)
+            yield '\t{func}(pinfo, subtree)'.format(func=pinfo_func)
+            yield from _declare_range(child.children)
 
             # Add the actual field code for each field
-            data.append(child.get_code(0))
-            data.extend(['end', ''])
-
-        return '\n'.join(i for i in data if i is not None)
+            yield from child.iter_code(0)
+            yield from ['end', '']
 
     def _register_dissector(self):
         """Add code for registering the dissector in the dissector table."""
@@ -425,7 +545,8 @@ class Delegator(Dissector, Protocol):
         self.var = create_lua_var('delegator')
         self.table_var = create_lua_var('dissector_table')
         self.id_table = create_lua_var('message_ids')
-        self.sizes_table = create_lua_var('dissector_sizes')
+        self.func_table = create_lua_var('dissector_funcs')
+        self.guess_table = create_lua_var('dissector_guesses')
         self.msg_var = create_lua_var('msg_node')
 
         # Add fields, don't change sizes!
@@ -440,17 +561,16 @@ class Delegator(Dissector, Protocol):
 
         self.version, self.flags, self.msg_id, self.length = self.children
 
-    def generate(self):
-        """Returns all the code for dissecting this protocol."""
+    def generate_chunks(self):
+        """Generate all the code for dissecting this protocol in chunks."""
         self.push_modifiers()
 
-        data = []
-        data.append(self._legal_header())
-        data.append(self._header_defintion())
-        data.append(self._fields_definition())
-        data.append(self._register_function())
-        data.append(self._dissector_func())
-        return '\n'.join(i for i in data if i is not None)
+        for code in (self._legal_header(), self._header_defintion()):
+            if code is not None:
+                yield code
+        yield from self._fields_definition()
+        yield self._register_function()
+        yield from self._dissector_func()
 
     def _header_defintion(self):
         """Add the code for the header of the protocol."""
@@ -465,9 +585,10 @@ class Delegator(Dissector, Protocol):
         data.append(proto.format(var=self.var, name=self.name,
                                       description=self.description))
 
-        # Add the message id and dissector sizes tables
+        # Add the tables mapping message ids and sizes to dissectors
         data.append('local {var} = {{}}'.format(var=self.id_table))
-        data.append('local {var} = {{}}\n'.format(var=self.sizes_table))
+        data.append('local {var} = {{}}'.format(var=self.func_table))
+        data.append('local {var} = {{}}\n'.format(var=self.guess_table))
         return '\n'.join(i for i in data if i is not None)
 
     def _register_function(self):
@@ -476,20 +597,24 @@ class Delegator(Dissector, Protocol):
 -- Register struct dissectors
 function {func}(proto, name, id, sizes)
     {table}:add(name, proto)
-    if id ~= nil then {ids}[id] = name end
+    local entry = {{name = name, id = id, dissector = proto.dissector}}
+    if id ~= nil then {ids}[id] = entry end
     if sizes ~= nil then
 	for flag, size in pairs(sizes) do
-	    if {sizes}[flag] == nil then
-                {sizes}[flag] = {{}}
+	    if id ~= nil then
+		{funcs}[flag * 65536 + id] = entry
 	    end
-	    if {sizes}[flag][size] == nil then
-		{sizes}[flag][size] = {{}}
+	    -- Guess the dissector without id, then by name, for unknown ids
+	    local key = flag * 4294967296 + size
+	    local guess = {guesses}[key]
+	    if guess == nil or (guess.id ~= nil and id == nil) or
+		    ((guess.id == nil) == (id == nil) and name < guess.name) then
+		{guesses}[key] = entry
 	    end
-	    table.insert({sizes}[flag][size], name)
 	end
     end
-end\n""".format(func=self.REGISTER_FUNC,
-        table=self.table_var, ids=self.id_table, sizes=self.sizes_table)
+end\n""".format(func=self.REGISTER_FUNC, table=self.table_var,
+        ids=self.id_table, funcs=self.func_table, guesses=self.guess_table)
 
     def _dissector_func(self):
         """Add the code for the dissector function for the protocol."""
@@ -502,36 +627,39 @@ end\n""".format(func=self.REGISTER_FUNC,
         data.append('\tpinfo.cols.info = delegator.description\n')
 
         # Fields code
+        data.extend(_declare_range([self.version, self.flags]))
         data.append(self.version.get_code(0))
         data.append(self.flags.get_code(1))
         t = '\tpinfo.private.platform_flag = {flag}'
         data.append(t.format(flag=self.flags._value_var))
-        data.append(self.msg_id.get_code(2, store=self.msg_var))
+        msg_range = create_lua_var('message_range')
+        data.append('\tlocal {var} = buffer(2, 2)'.format(var=msg_range))
+        data.append(self.msg_id.get_code(2, store=self.msg_var,
+                                         range=msg_range))
         t = '\tsubtree:add(f.messagelength, buffer(4):len()):set_generated()'
         data.extend([t, ''])
 
         # Find message id and flag
         msg_var = create_lua_var('id_value')
-        data.append(self.msg_id._store_value(msg_var))
+        data.append(self.msg_id._store_value(msg_var, range=msg_range))
         data.append(self.length._store_value('length_value', offset=4))
         data.append('')
 
         # Call the right dissector
-        data.append('\t-- Call the correct dissector, or try and guess which')
+        data.append('\t-- Call the correct dissector, or guess which')
         data.append('''\
-    if {ids}[{msg}] then
-        {node}:append_text(" (" .. {ids}[{msg}] ..")")
-        {table}:try({ids}[{msg}], buffer(4):tvb(), pinfo, tree)
+    local entry = {funcs}[{flag} * 65536 + {msg}] or {ids}[{msg}]
+    if entry then
+        {node}:append_text(" (" .. entry.name ..")")
     else
         {node}:add_expert_info(PI_MALFORMED, PI_WARN, "Unknown message id")
-        if {sizes}[{flag}] and {sizes}[{flag}][{length}] then
-            for key, value in pairs({sizes}[{flag}][{length}]) do
-                {table}:try(value, buffer(4):tvb(), pinfo, tree)
-            end
-        end
+        entry = {guesses}[{flag} * 4294967296 + {length}]
+    end
+    if entry then
+        entry.dissector:call(buffer(4):tvb(), pinfo, tree)
     end\nend\n\n'''.format(ids=self.id_table, msg=msg_var, node=self.msg_var,
-                sizes=self.sizes_table, flag=self.flags._value_var,
-                table=self.table_var, length=self.length._value_var))
+                funcs=self.func_table, guesses=self.guess_table,
+                flag=self.flags._value_var, length=self.length._value_var))
 
-        return '\n'.join(i for i in data if i is not None)
+        yield from (i for i in data if i is not None)
 
@@ -24,9 +24,12 @@ Field class and its subclasses represent a value or a list of values in
 packets to be dissected by Wireshark. They represent Wireshark's
 ProtoField instances.
 """
+import re
 import string
 import copy
+import functools
 from collections import namedtuple
+from collections.abc import Sequence
 
 from platform import Platform
 
@@ -38,24 +41,36 @@ LUA_KEYWORDS = [
     'return', 'then', 'true', 'until', 'while'
 ]
 
+# Local of each dissector function holding the buffer range of the field
+# being dissected, so fields do not need a local each for their range
+RANGE_VAR = 'range'
 
+
+_invalid_regex = re.compile(r'[^a-zA-Z0-9_]')
+_lua_keywords = frozenset(LUA_KEYWORDS)
+
+
+@functools.lru_cache(maxsize=8192)
 def create_lua_var(var, length=None):
-    """Return a valid lua variable name."""
-    valid = string.ascii_letters + string.digits + '_'
+    """Return a valid lua variable name.
+
+    Invalid characters and leading digits are removed. If 'length' is
+    given, only characters up to the 'length' first valid ones are checked.
+    """
     if length is None:
-        length = len(var)
-    var.replace(' ', '_')
-
-    i = 0
-    while i < len(var) and i < length:
-        if var[i] not in valid:
-            var = var[:i] + var[i+1:]
-        elif i == 0 and var[i] in string.digits:
-            var = var[:i] + var[i+1:]
-        else:
+        var = _invalid_regex.sub('', var).lstrip(string.digits)
+    else:
+        valid = []
+        i = 0
+        while i < len(var) and len(valid) < length:
+            char = var[i]
+            if not _invalid_regex.match(char) and (
+                    valid or char not in string.digits):
+                valid.append(char)
             i += 1
+        var = ''.join(valid) + var[i:]
 
-    if var in LUA_KEYWORDS:
+    if var in _lua_keywords:
         var = '_%s' % var
 
     return var.lower()
@@ -69,9 +84,17 @@ def create_lua_valuestring(dict_, wrap=True):
     return '{%s}' % ', '.join('[%i]=%s' % (i, j) for i, j in items)
 
 
+@functools.lru_cache(maxsize=None)
+def _slots(cls):
+    """Get the names of all slots of the class 'cls'."""
+    return tuple(i for c in cls.__mro__ for i in getattr(c, '__slots__', ()))
+
+
 class BaseField:
     """Interface for Fields and list of Fields."""
 
+    __slots__ = ()
+
     def __init__(self, size, alignment, endian):
         """Create a new Wireshark ProtoField instance.
 
@@ -103,9 +126,25 @@ class BaseField:
         """Get the code for dissecting this field."""
         pass
 
+    def iter_definition(self):
+        """Generate the ProtoField definition in chunks of code."""
+        code = self.get_definition()
+        if code is not None:
+            yield code
+
+    def iter_code(self, offset, store=None, tree='subtree'):
+        """Generate the code for dissecting this field in chunks."""
+        yield self.get_code(offset, store=store, tree=tree)
+
 
 class Field(BaseField):
-    """Represents Wireshark's ProtoFields which stores a specific value."""
+    """Represents Wireshark's ProtoFields which stores a specific value.
+
+    A field only holds its own prefixes and postfixes. When modifiers are
+    pushed down a subtree, the children keep a reference to their parent
+    instead of a copy of its lists, and the full name, abbr and variable
+    are frozen once they can no longer change.
+    """
 
     # Members this fields holds, used when testing equality and more
     prefixes = ['var_prefix', 'abbr_prefix', 'name_prefix']
@@ -116,6 +155,9 @@ class Field(BaseField):
             'base', 'values', 'mask', 'desc',
             'offset', 'range_validation', 'list_validation',
     ] + prefixes + postfixes + infixes
+    __slots__ = tuple(members) + (
+            'children', '_label', '_node_var', '_value_var', '_valuestring_values',
+            '_parent', '_frozen')
 
     def __init__(self, name, type, size, alignment, endian):
         """Create a new Wireshark ProtoField instance.
@@ -131,17 +173,41 @@ class Field(BaseField):
         for member in self.prefixes + self.postfixes:
             setattr(self, member, [])
         super().__init__(size, alignment, endian)
+        self._parent = None # Subtree whose modifiers are prepended
+        self._frozen = None # Tuple of name, abbr and variable when pushed
         self.type = type
         self.name = name
+        self._label = None # Lua expression for a label set at runtime
+
+    def __copy__(self):
+        """Create a shallow copy of the field, which shares its members."""
+        field = object.__new__(type(self))
+        for member in _slots(type(self)):
+            try:
+                setattr(field, member, getattr(self, member))
+            except AttributeError:
+                pass # Member is not set
+        return field
+
+    def _modifiers(self, member):
+        """Get the list 'member' prefixed with those of all parents."""
+        values = getattr(self, member)
+        if self._parent is None:
+            return values
+        return self._parent._modifiers(member) + values
 
     @property
     def name(self):
         """Get the name of the field."""
+        if self._frozen is not None:
+            return self._frozen[0]
         name = self._name
-        if self.name_prefix:
-            name = '%s%s' % (''.join(self.name_prefix), name)
-        if self.name_postfix:
-            name = '%s%s' % (name, ''.join(self.name_postfix))
+        prefix = self._modifiers('name_prefix')
+        if prefix:
+            name = '%s%s' % (''.join(prefix), name)
+        postfix = self._modifiers('name_postfix')
+        if postfix:
+            name = '%s%s' % (name, ''.join(postfix))
         return name
 
     @name.setter
@@ -150,27 +216,41 @@ class Field(BaseField):
         self._name = value
         self._var = create_lua_var(self._name)
         self._abbr = self._name.replace(' ', '_')
+        self._frozen = None
 
     @property
     def abbr(self):
         """Get the fields abbr."""
+        if self._frozen is not None:
+            return self._frozen[1]
         abbr = self._abbr
-        if self.abbr_prefix:
-            abbr = '%s.%s' % ('.'.join(self.abbr_prefix), abbr)
-        if self.abbr_postfix:
-            abbr = '%s.%s' % (abbr, '.'.join(self.abbr_postfix))
+        prefix = self._modifiers('abbr_prefix')
+        if prefix:
+            abbr = '%s.%s' % ('.'.join(prefix), abbr)
+        postfix = self._modifiers('abbr_postfix')
+        if postfix:
+            abbr = '%s.%s' % (abbr, '.'.join(postfix))
         return abbr
 
     @property
     def variable(self):
         """Get the variable to store the field in."""
+        if self._frozen is not None:
+            return self._frozen[2]
         var = self._var
-        if self.var_prefix:
-            var = '%s_%s' % ('_'.join(self.var_prefix), var)
-        if self.var_postfix:
-            var = '%s_%s' % (var, '_'.join(self.var_postfix))
+        prefix = self._modifiers('var_prefix')
+        if prefix:
+            var = '%s_%s' % ('_'.join(prefix), var)
+        postfix = self._modifiers('var_postfix')
+        if postfix:
+            var = '%s_%s' % (var, '_'.join(postfix))
         return var.replace('._', '.')
 
+    def push_modifiers(self):
+        """Freeze the name, abbr and variable, as all modifiers are pushed."""
+        self._frozen = None
+        self._frozen = (self.name, self.abbr, self.variable)
+
     @property
     def func_type(self):
         """Get the lua function to read values from buffers."""
@@ -206,6 +286,8 @@ class Field(BaseField):
         template = '{var} = ProtoField.{type}("{abbr}", "{name}"{rest})'
         args = {'var': self.variable, 'type': self.type,
                 'abbr': self.abbr, 'name': self.name}
+        if self._label is not None:
+            args['name'] = '' # The label is prepended at runtime
 
         # Add other parameters if applicable
         desc = '"%s"' % self.desc if self.desc is not None else None
@@ -225,18 +307,20 @@ class Field(BaseField):
         data.append(template.format(**args))
         return '\n'.join(data)
 
-    def get_code(self, offset, store=None, tree='subtree'):
+    def get_code(self, offset, store=None, tree='subtree', range=None):
         """Get the code for dissecting this field.
 
         'offset' is the buffer offset the value is stored at
         'store' is the lua variable to store the tree node in
         'tree' is the tree we are adding the node to
+        'range' is an optional lua variable holding the buffer range
         """
         self.offset = offset
         data = []
+        validate = self.range_validation or self.list_validation
 
         # Store the subtree node in a lua variable
-        if not store and (self.range_validation or self.list_validation):
+        if not store and validate:
             store = '%s_node' % self._name
         if store:
             self._node_var = create_lua_var(store)
@@ -244,34 +328,53 @@ class Field(BaseField):
         else:
             store = ''
 
+        # Read the buffer range once, if the value is read as well
+        if range is None and validate:
+            range = RANGE_VAR
+            data.append('\t{var} = buffer({offset}, {size})'.format(
+                    var=range, offset=offset, size=self.size))
+        if range is None:
+            range = 'buffer({offset}, {size})'.format(
+                    offset=offset, size=self.size)
+
         # Add the field to the Wireshark tree
-        t = '\t{store}{tree}:{add}({var}, buffer({offset}, {size}))'
+        t = '\t{store}{tree}:{add}({var}, {range})'
         data.append(t.format(store=store, tree=tree, add=self.add_var,
-                var=self.variable, offset=offset, size=self.size))
+                var=self.variable, range=range))
 
         # Add misc validations
-        if self.range_validation or self.list_validation:
-            data.append(self._store_value()) # Store value first
+        if validate:
+            data.append(self._store_value(range=range)) # Store value first
         if self.range_validation is not None:
             data.append(self._create_range_validation())
         if self.list_validation is not None:
             data.append(self._create_list_validation())
         return '\n'.join(data)
 
-    def _store_value(self, var=None, offset=None):
+    @property
+    def uses_range(self):
+        """True if the code of this field stores its buffer range in the
+        RANGE_VAR local, which the dissector function must declare."""
+        return bool(self.range_validation or self.list_validation)
+
+    def _store_value(self, var=None, offset=None, range=None):
         """Create code which stores the field value in 'var'.
 
-        If 'offset' is not provided, must be run after get_code().
+        If neither 'offset' nor 'range' is provided, must be run after
+        get_code(). 'range' is a lua variable holding the buffer range.
         """
         if var is None:
             var = '%s_value' % self._name
         if offset is None:
             offset = self.offset
+        if range is None:
+            range = 'buffer({offset}, {size})'.format(
+                    offset=offset, size=self.size)
         self._value_var = create_lua_var(var)
 
-        store = '\tlocal {var} = buffer({offset}, {size}):{type}()'
-        return store.format(var=self._value_var, offset=offset,
-                            size=self.size, type=self.func_type)
+        store = '\tlocal {var} = {range}:{type}()'
+        return store.format(var=self._value_var,
+                            range=range, type=self.func_type)
 
     def set_range_validation(self, min_value=None, max_value=None):
         """Set validation that field value is between a given range."""
@@ -314,6 +417,8 @@ class Field(BaseField):
 class Subtree(Field):
     """A Subtree is a Field with a list of fields as children."""
 
+    __slots__ = ('tree', 'parent', '_increase_offset')
+
     def __init__(self, tree, *args, **vargs):
         """Create a new subtree of ProtoField's."""
         super().__init__(*args, **vargs)
@@ -334,19 +439,21 @@ class Subtree(Field):
 
     def push_modifiers(self, push_children=True):
         """Push prefixes and postfixes down to child fields."""
+        super().push_modifiers()
         for field in self.children:
-            for member in self.prefixes + self.postfixes:
-                setattr(field, member,
-                        getattr(self, member) + getattr(field, member))
+            field._parent = self
             if push_children:
                 field.push_modifiers()
 
     def get_definition(self):
         """Get the ProtoField definition for this field."""
-        data = [super().get_definition()]
+        return '\n'.join(self.iter_definition())
+
+    def iter_definition(self):
+        """Generate the ProtoField definitions, one chunk per field."""
+        yield super().get_definition()
         for field in self.children:
-            data.append(field.get_definition())
-        return '\n'.join(i for i in data if i is not None)
+            yield from field.iter_definition()
 
     def get_code(self, offset, store=None, tree=None):
         """Get the code for dissecting this field.
@@ -355,47 +462,156 @@ class Subtree(Field):
         'store' is the lua variable to store the tree node in
         'tree' is the tree we are adding the node to
         """
+        return '\n'.join(self.iter_code(offset, store, tree))
+
+    def iter_code(self, offset, store=None, tree=None):
+        """Generate the code for dissecting this field in chunks.
+
+        The chunks are the code of the subtree and its children, so the
+        code of a large subtree is never held in memory as a whole.
+        """
         parent = self.parent if tree is None else tree
         tree = self.tree if store is None else store
-        data = [super().get_code(offset, store=tree, tree=parent)]
+        yield super().get_code(offset, store=tree, tree=parent)
         for field in self.children:
-            data.append(field.get_code(offset, tree=tree))
+            yield from field.iter_code(offset, tree=tree)
             if self._increase_offset:
                 offset += field.size
-        return '\n'.join(data)
+
+
+class ArrayElements(Sequence):
+    """The elements of an ArrayField, one for each index.
+
+    All elements share a single template field, and an element is only
+    created when it is accessed, as a shallow copy of the template with
+    the index appended to its postfixes.
+    """
+
+    __slots__ = ('array', 'template')
+
+    def __init__(self, array, template):
+        """Create the elements of 'array' from the field 'template'."""
+        self.array = array
+        self.template = template
+
+    def __len__(self):
+        """Get the number of elements in the array."""
+        return self.array.count
+
+    def __getitem__(self, index):
+        """Create the element at 'index'."""
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('array index out of range')
+
+        field = copy.copy(self.template)
+        field._parent = self.array
+        field._frozen = None
+        field.var_postfix = field.var_postfix + [str(index)]
+        field.abbr_postfix = field.abbr_postfix + [str(index)]
+        field.name_postfix = field.name_postfix + ['[%i]' % index]
+        if isinstance(field, ArrayField) and not field.loop:
+            field.children = ArrayElements(field, field.element)
+
+        # Elements of a pushed array are created pushed
+        if self.array._frozen is not None:
+            field.push_modifiers()
+        return field
+
+    def __eq__(self, other):
+        """Compare if two arrays have equal elements."""
+        if not isinstance(other, ArrayElements):
+            return list(self) == other
+        return len(self) == len(other) and self.template == other.template
 
 
 class ArrayField(Subtree):
-    """ArrayField is a Subtree with visible indices."""
+    """ArrayField is a Subtree with visible indices.
+
+    An ArrayField either has an element for every index, created on
+    demand from a shared template, or if created with 'loop' a single
+    element which is dissected by a Lua for loop, so the generated code
+    does not grow with the array size. If it has more elements than
+    'threshold', the elements are only dissected when the tree is visible
+    or the 'decode_arrays' preference of the protocol is enabled, and
+    always with Wireshark versions which cannot tell if it is visible.
+    """
+
+    __slots__ = ('count', 'loop', 'element', 'threshold')
 
-    def __init__(self, children, tree='arrtree', parent='subtree'):
+    def __init__(self, element, count, tree='arrtree',
+                 parent='subtree', loop=False):
         """Create a new ArrayField instance.
 
-        'children' is a list of child fields
+        'element' is the field every index of the array holds
+        'count' is the number of elements in the array
         'tree' is the variable name of the tree node
         'parent' is the variable name of the parent node
+        'loop' is True if the elements are dissected in a loop
         """
-        field = children[0]
-        type = field.type
+        type = element.type
         if type not in ('string', 'stringz'):
             type = 'bytes'
-        size = len(children) * field.size
-        super().__init__(tree, field.name, type,
-                size, field.alignment, field.endian)
+        super().__init__(tree, element.name, type,
+                count * element.size, element.alignment, element.endian)
         self.parent = parent
-        self.children = children
+        self.count = count
+        self.loop = loop
+        self.element = element
+        if loop:
+            self.children = [element]
+        else:
+            self.children = ArrayElements(self, element)
+        self.threshold = None
 
     def push_modifiers(self):
         """Push prefixes and postfixes down to child fields."""
+        if not self.loop:
+            # Elements are pushed when they are created
+            return Field.push_modifiers(self)
         super().push_modifiers(push_children=False)
-        for i, field in enumerate(self.children):
-            field.var_postfix.append(str(i))
-            field.abbr_postfix.append(str(i))
-            field.name_postfix.append('[%i]' % i)
-            field.push_modifiers()
 
-    def get_code(self, offset, store=None, tree=None):
-        """Get the code for dissecting this field.
+        label = self._label
+        if label is None:
+            label = '"%s"' % self.name
+        field = self.element
+        field.var_postfix.append('element')
+        field.abbr_postfix.append('element')
+        field._label = '%s[" .. %s .. "]"' % (label[:-1], self._index)
+        field.push_modifiers()
+
+    @property
+    def lazy(self):
+        """True if the elements are only dissected when needed."""
+        return self.threshold is not None and self.elements[0] > self.threshold
+
+    @property
+    def elements(self):
+        """Get the count and type of the leaf elements in the array."""
+        def traverse(field):
+            if not field.children:
+                return 1, field.type
+            if isinstance(field, ArrayField):
+                i, type_ = traverse(field.element)
+                return i * field.count, type_
+            i = 0
+            type_ = None
+            for child in field.children:
+                j, type_ = traverse(child)
+                i += j
+            return i, type_
+        return traverse(self)
+
+    @property
+    def _index(self):
+        """Get the Lua variable holding the index of the loop."""
+        return create_lua_var('%s_index' % self.tree)
+
+    def iter_code(self, offset, store=None, tree=None):
+        """Generate the code for dissecting this field in chunks.
 
         'offset' is the buffer offset the value is stored at
         'store' is the lua variable to store the tree node in
@@ -403,49 +619,87 @@ class ArrayField(Subtree):
         """
         parent = self.parent if tree is None else tree
         tree = self.tree if store is None else store
-        data = [super(Subtree, self).get_code(offset, store=tree, tree=parent)]
+        yield super(Subtree, self).get_code(offset, store=tree, tree=parent)
 
         # Fix the display of non-leaf nodes
         if self.type == 'bytes' and self.children:
-            def traverse(children):
-                i = 0
-                type_ = None
-                for child in children:
-                    if child.children:
-                        j, type_ = traverse(child.children)
-                        i += j
-                    else:
-                        i += 1
-                        type_ = child.type
-                return i, type_
-
-            size, type_ = traverse(self.children)
-            text = '\t{tree}:set_text("{name} ({size} x {type})")'
-            data.append(text.format(tree=tree, name=self.name,
-                                    type=type_, size=size))
+            size, type_ = self.elements
+            label = self._label
+            if label is None:
+                label = '"%s"' % self.name
+            text = '\t{tree}:set_text({label} ({size} x {type})")'
+            yield text.format(tree=tree, label=label[:-1],
+                              type=type_, size=size)
+
+        if self.loop:
+            elements = [self._get_loop_code(offset, tree)]
+        else:
+            elements = self._iter_elements(offset, tree)
+
+        # Only dissect the elements of large arrays when needed
+        if self.lazy:
+            # Older Wireshark versions do not have tree.visible
+            yield '\tif tree.visible ~= false or prefs.decode_arrays then'
+            for code in elements:
+                yield '\n'.join('\t%s' % line for line in code.split('\n'))
+            yield '\tend'
+        else:
+            yield from elements
 
+    def _iter_elements(self, offset, tree):
+        """Generate the code for dissecting each element in chunks."""
         for field in self.children:
-            data.append(field.get_code(offset, tree=tree))
+            yield from field.iter_code(offset, tree=tree)
             if self._increase_offset:
                 offset += field.size
+
+    def _get_loop_code(self, offset, tree):
+        """Get the code for dissecting the elements in a Lua for loop."""
+        field = self.element
+        index = self._index
+        offset = '{offset} + {index} * {size}'.format(
+                offset=offset, index=index, size=field.size)
+
+        # Add the element, and prepend the label to it if it is a leaf
+        if isinstance(field, (ArrayField, ProtocolField)):
+            code = field.get_code(offset, tree=tree)
+            node = None
+        elif isinstance(field, Subtree):
+            code = field.get_code(offset, tree=tree)
+            node = field.tree
+        else:
+            code = field.get_code(offset,
+                    store='%s_node' % field._name, tree=tree)
+            node = field._node_var
+
+        data = ['\tfor {index} = 0, {last} do'.format(
+                index=index, last=self.count - 1)]
+        data.extend('\t%s' % line for line in code.split('\n'))
+        if node is not None:
+            data.append('\t\t{node}:prepend_text({label})'.format(
+                    node=node, label=field._label))
+        data.append('\tend')
         return '\n'.join(data)
 
     @classmethod
-    def create(cls, depth, field, name='array'):
-        """Recursively create a tree of arrays of 'depth'."""
+    def create(cls, depth, field, name='array', loop=False):
+        """Recursively create a tree of arrays of 'depth'.
+
+        If 'loop' is True each level holds a single element which is
+        dissected in a Lua for loop, instead of one for every index.
+        """
         depth = depth[:]
-        children = []
-        for i in range(depth.pop(0)):
-            if not len(depth):
-                children.append(copy.deepcopy(field))
-            else:
-                children.append(cls.create(depth, field, 'sub%s' % name))
-        return ArrayField(children, tree=name)
+        count = depth.pop(0)
+        if depth:
+            field = cls.create(depth, field, 'sub%s' % name, loop)
+        return ArrayField(field, count, tree=name, loop=loop)
 
 
 class BitField(Subtree):
     """BitField is a Subtree with field for each relevant bit."""
 
+    __slots__ = ()
+
     def __init__(self, bits, name, type, size, alignment, endian):
         """Create a new BitField instance.
 
@@ -477,6 +731,29 @@ class BitField(Subtree):
         self._name = '%s (bitstring)' % self.name
         self._increase_offset = False
 
+    def iter_code(self, offset, store=None, tree=None):
+        """Generate the code for dissecting this field in chunks.
+
+        The bitstring and all its bit fields share a single buffer range.
+        'offset' is the buffer offset the value is stored at
+        'store' is the lua variable to store the tree node in
+        'tree' is the tree we are adding the node to
+        """
+        parent = self.parent if tree is None else tree
+        tree = self.tree if store is None else store
+        range = RANGE_VAR
+        yield '\t{var} = buffer({offset}, {size})'.format(
+                var=range, offset=offset, size=self.size)
+        yield super(Subtree, self).get_code(
+                offset, store=tree, tree=parent, range=range)
+        for field in self.children:
+            yield field.get_code(offset, tree=tree, range=range)
+
+    @property
+    def uses_range(self):
+        """True, as the bitstring stores its buffer range in RANGE_VAR."""
+        return True
+
 
 class ProtocolField(Field):
     """A ProtocolField is a field for a protocol.
@@ -486,6 +763,7 @@ class ProtocolField(Field):
     """
 
     Fake = namedtuple('FakeProto', ['name', 'size', 'alignment', 'endian'])
+    __slots__ = ('proto', )
 
     def __init__(self, name, proto):
         """Create a new ProtocolField instance.
@@ -509,9 +787,12 @@ class ProtocolField(Field):
         'tree' is the tree we are adding the node to
         """
         self.offset = offset
-        t = '\tpinfo.private.field_name = "{name}"\n'\
-            '\tDissector.get("{proto}"):call(buffer({offset}, '\
+        name = self._label
+        if name is None:
+            name = '"%s"' % self.name
+        t = '\tpinfo.private.field_name = {name}\n'\
+            '\tdissectors["{proto}"]:call(buffer({offset}, '\
             '{size}):tvb(), pinfo, {tree})'
-        return t.format(name=self.name, size=self.size, offset=offset,
+        return t.format(name=name, size=self.size, offset=offset,
                 tree=tree, proto=self.proto.name.lower().replace(' ', '_'))
 
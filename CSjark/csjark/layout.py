@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for describing C structs independently of any platform.
+
+The cparser module describes the structs, unions, enums and typedefs it
+finds in an AST as Declarations, which hold a Struct for every struct
+and union, with a Member for each of its members. These only hold the
+names, C types and array dimensions as written in the C code, so the
+same Declarations are used for every platform the AST is parsed for.
+
+The Layout class lays out Declarations for one platform. It looks up
+the sizes, alignments and byte order of the C types on the platform,
+applies the rules from the configuration, and creates the Dissector
+and Field instances for the structs, which pad the fields as required
+by the platform.
+"""
+import os
+from collections import namedtuple
+
+from session import Session
+from dissector import Protocol
+from field import Field, ArrayField, ProtocolField
+
+
+class Member(namedtuple('Member', ['name', 'kind', 'ctype',
+                                   'alias', 'depth', 'count', 'values'],
+                        defaults=(None, None, None, None))):
+    """A member of a struct, as it is declared in the C code.
+
+    'name' is the name of the member
+    'kind' is how the member is dissected:
+        'field' a value of 'ctype', which configuration rules apply to
+        'plain' a value of 'ctype', without configuration rules
+        'string' a char array with 'count' characters
+        'enum' a value of the enum 'ctype', with 'values'
+        'protocol' a struct or union named 'ctype'
+    'alias' is the typedef name 'ctype' was declared with, or the name
+    of the array typedef the member was declared with, if any
+    'depth' is a list of the dimensions if the member is an array,
+    which is empty for a single string or an array typedef
+    """
+    __slots__ = ()
+
+
+class Struct:
+    """A struct or union, as it is declared in the C code."""
+
+    def __init__(self, name, union, file, line):
+        """Create a new Struct description.
+
+        'name' is the name of the struct or union
+        'union' is True if it is a union
+        'file' and 'line' is where the struct is defined
+        """
+        self.name = name
+        self.union = union
+        self.file = file
+        self.line = line
+        self.members = [] # List of Member instances
+        self.nested = [] # Structs defined inside this one
+
+
+class Declarations:
+    """The structs and types declared in an AST."""
+
+    def __init__(self):
+        """Create an empty collection of declarations."""
+        self.structs = [] # Structs not defined inside other structs
+        self.types = [] # List of (name, filename) of all declared types
+
+
+class Layout:
+    """Lays out platform-neutral Declarations for a platform.
+
+    The dissectors created are stored as protocols in the session, and
+    the types declared as its known types.
+    """
+
+    def __init__(self, platform, session=None):
+        """Create a new layout of declarations for a platform.
+
+        'platform' is the platform to lay out the structs for
+        'session' is the Session to store protocols and types in, the
+        default session if None
+        """
+        if session is None:
+            session = Session.default()
+        self.session = session
+        self.platform = platform
+        self.map_type = platform.map_type
+        self.size_of = platform.size_of
+        self.alignment = platform.alignment
+
+    def create(self, declarations):
+        """Create the dissectors for all structs in 'declarations'.
+
+        Returns all the protocols in the session.
+        """
+        for name, filename in declarations.types:
+            self.session.set(self.session.known_types, name, filename)
+        for struct in declarations.structs:
+            self.create_dissector(struct)
+        return list(self.session.protocols.values())
+
+    def create_dissector(self, struct):
+        """Create the dissector for 'struct' and the structs inside it."""
+        # Check if a protocol already exists for this struct
+        if self._find_protocol(struct) is not None:
+            return
+
+        for nested in struct.nested:
+            self.create_dissector(nested)
+
+        proto = self._create_protocol(struct)
+        for member in struct.members:
+            self.add_member(proto, member)
+        return proto
+
+    def add_member(self, proto, member):
+        """Add a field representing 'member' to the protocol."""
+        if member.depth is None:
+            if member.kind == 'field':
+                return self._add_field(proto, member)
+            return proto.add_field(self.create_field(member))
+
+        if member.alias is None:
+            field = self.create_field(member)
+        else:
+            # Elements of array typedefs are named after the typedef
+            field = self.create_field(member._replace(name=member.alias))
+            field.name = member.name
+        if member.depth:
+            field = ArrayField.create(member.depth, field,
+                                      loop=self.session.options.loop_arrays)
+            if proto.conf is not None:
+                field.threshold = proto.conf.get_array_threshold(field.name)
+        return proto.add_field(field)
+
+    def create_field(self, member):
+        """Create a new field for a single value of 'member'."""
+        endian = self.platform.endian
+        if member.kind == 'string':
+            size = member.count * self.size_of('char')
+            return Field(member.name, self.map_type('string'),
+                         size, 0, endian)
+        elif member.kind == 'enum':
+            field = Field(member.name, self.map_type('enum'),
+                    self.size_of('enum'), self.alignment('enum'), endian)
+            field.set_list_validation(member.values)
+            return field
+        elif member.kind == 'protocol':
+            return self._create_protocol_field(member.name, member.ctype)
+        return Field(member.name, self.map_type(member.ctype),
+                self.size_of(member.ctype), self.alignment(member.ctype),
+                endian)
+
+    def _add_field(self, proto, member):
+        """Add a field for 'member', applying any configuration rules."""
+        ctype = member.ctype
+        # If any rules exists, use new type and not base
+        if (member.alias is not None and proto.conf and
+                proto.conf.get_rules(None, member.alias)):
+            ctype = member.alias
+
+        try:
+            alignment = self.alignment(ctype)
+        except ValueError:
+            alignment = None # Assume the alignment is the same as the size
+
+        endian = self.platform.endian
+        if proto.conf is None:
+            return proto.add_field(Field(member.name, self.map_type(ctype),
+                    self.size_of(ctype), alignment, endian))
+        return proto.conf.create_field(proto, member.name,
+                ctype, None, alignment, endian)
+
+    def _find_protocol(self, struct):
+        """Check if the protocol already exists."""
+        old = self.session.protocols.get(struct.name, None)
+        if old is None:
+            return None
+
+        # Match platform
+        dissector = old.get_dissector(self.platform)
+        if dissector is None:
+            return None
+
+        # Disallow structs with same name
+        if (os.path.normpath(old._file) == os.path.normpath(struct.file)
+                and old._line == struct.line):
+            return dissector
+
+        from cparser import ParseError # Which imports this module
+        raise ParseError('Two structs with same name %s: %s:%i & %s:%i' % (
+               struct.name, old._file, old._line, struct.file, struct.line))
+
+    def _create_protocol(self, struct):
+        """Create a new protocol for 'struct'."""
+        conf = self.session.options.configs.get(struct.name, None)
+        proto, diss = Protocol.create_dissector(struct.name,
+                self.platform, conf, union=struct.union, session=self.session)
+
+        # Remember where the struct was defined
+        self.session.set(vars(proto), '_file', struct.file)
+        self.session.set(vars(proto), '_line', struct.line)
+        return diss
+
+    def _create_protocol_field(self, name, proto_name):
+        """Create a new protocol field."""
+        proto = self.session.protocols.get(proto_name, None)
+        if proto is not None:
+            proto = proto.get_dissector(self.platform)
+
+        # Try to create a fake protocol if conf has size
+        if proto is None:
+            conf = self.session.options.configs.get(proto_name, None)
+            if conf is None or conf.size is None:
+                from cparser import ParseError # Which imports this module
+                raise ParseError('Unknown protocol %s' % proto_name)
+            proto = ProtocolField.Fake(name=proto_name, size=conf.size,
+                    alignment=conf.size, endian=self.platform.endian)
+
+        return ProtocolField(name, proto)
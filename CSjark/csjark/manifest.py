@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for keeping track of what the generated dissectors were built from.
+
+The Manifest class records the hashes of all the input used to generate
+the dissectors: the header files and the files they include, the struct
+configuration, conformance files, platforms and the utility itself. It is
+used by incremental runs to only parse the headers, and only write the
+dissectors, whose input changed since the previous run. The includes found
+for each header and the types it declared are recorded as well, so the
+headers which are parsed again can still use the ones which are not.
+"""
+import os
+import glob
+import json
+
+import cpp
+import cache
+from config import FileConfig
+from session import Session
+
+
+class Manifest:
+    """Holds the hashes of the input to a previous run."""
+
+    filename = '.csjark_manifest.json'
+    version = 2
+
+    def __init__(self, session=None):
+        """Create a manifest stored in the output folder of 'session'.
+
+        'session' is the Session to generate dissectors in, the default
+        if None. Reads the manifest of the previous run, if there is any.
+        """
+        if session is None:
+            session = Session.default()
+        self.session = session
+        self.options = session.options
+        folder = self.options.output_dir or '.'
+        self.path = os.path.join(folder, self.filename)
+        self.options_hash = self._options_hash()
+        self.headers = {} # Map header to its hash and includes
+        self.protocols = {} # Map protocol name to its hashes and output
+
+        try:
+            with open(self.path, 'r') as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        # Everything needs regeneration if the utility or options changed
+        if (obj.get('version') == self.version and
+                obj.get('options') == self.options_hash):
+            self.headers = obj.get('headers', {})
+            self.protocols = obj.get('protocols', {})
+
+    @property
+    def is_new(self):
+        """True if there was no usable manifest from a previous run."""
+        return not self.headers
+
+    def save(self):
+        """Write the manifest to disk."""
+        obj = {'version': self.version, 'options': self.options_hash,
+               'headers': self.headers, 'protocols': self.protocols}
+        with open(self.path, 'w') as f:
+            json.dump(obj, f, indent=1, sort_keys=True)
+
+    def changed_headers(self, headers, folders):
+        """Find which of 'headers' changed since the previous run.
+
+        'headers' is a list of all headers to parse
+        'folders' is a set of all folders to -Include
+        Headers which include a changed header are changed as well.
+        """
+        self._folders = folders
+        self._hashes = {}
+        changed = set()
+        for filename in headers:
+            old = self.headers.get(filename, {})
+            new = self._header_hash(filename, folders, old.get('includes', []))
+            self._hashes[filename] = new
+            if new['hash'] != old.get('hash', None):
+                changed.add(filename)
+
+        # Headers which contain a protocol whose configuration changed
+        for name, proto in self.protocols.items():
+            if proto['config'] == self._config_hash(name):
+                continue
+            for filename in headers:
+                if proto['file'] in self._hashes[filename]['files']:
+                    changed.add(filename)
+
+        # Headers which include a changed header, directly or not
+        while True:
+            dependents = {i for i in headers if i not in changed and
+                          changed.intersection(self._hashes[i]['files'])}
+            if not dependents:
+                break
+            changed |= dependents
+
+        return [i for i in headers if i in changed]
+
+    def restore(self, headers):
+        """Restore what the previous run found about 'headers'.
+
+        'headers' is a list of all headers
+        The includes found for each header are added to its FileConfig,
+        and the types each header declared are added to the known types
+        of the session, so the headers which are parsed again can use the
+        ones which are not. Must be done before changed_headers() hashes
+        the headers.
+        """
+        session = self.session
+        for filename in headers:
+            old = self.headers.get(filename, {})
+            for include in old.get('includes', []):
+                FileConfig.add_include(filename, include, self.options)
+            for name, source in old.get('types', {}).items():
+                session.set(session.known_types, name, source)
+
+    def update_headers(self, headers, failed):
+        """Record the hashes of 'headers' which were parsed.
+
+        'failed' is a set of headers which failed to parse, and must
+        be parsed again next time.
+        The known types of the session declared by each header are
+        recorded as well.
+        """
+        session = self.session
+        for filename in headers:
+            if filename in failed:
+                self.headers.pop(filename, None)
+                continue
+            new = self._hashes[filename]
+            includes = self.options.match_file(filename).includes
+            if includes != new['includes']:
+                # Includes found by parse_headers, hash them as well
+                new = self._header_hash(filename, self._folders, includes)
+            # Anonymous types are known by None, which JSON can't store
+            files = set(new['files'])
+            new['types'] = {name: source for name, source
+                            in session.known_types.items()
+                            if source in files and name is not None}
+            self.headers[filename] = new
+
+    def update_protocol(self, proto, path, code_hash):
+        """Record the output of a protocol, True if it must be written.
+
+        'code_hash' is the cache.create_key() of the generated code.
+        """
+        old = self.protocols.get(proto.name, {})
+        self.protocols[proto.name] = {
+            'file': os.path.normpath(proto._file), 'output': path,
+            'config': self._config_hash(proto.name), 'code': code_hash,
+        }
+        return old.get('code') != code_hash or not os.path.isfile(path)
+
+    def remove_stale(self, headers, protocols):
+        """Remove the output of protocols which no longer exists.
+
+        'headers' is a list of headers which were parsed successfully
+        'protocols' is all protocols found while parsing them
+        Returns the output filenames that were removed.
+        """
+        files = set()
+        for filename in headers:
+            files.update(self.headers[filename]['files'])
+
+        removed = []
+        for name, proto in list(self.protocols.items()):
+            if name not in protocols and proto['file'] in files:
+                del self.protocols[name]
+                if os.path.isfile(proto['output']):
+                    os.remove(proto['output'])
+                    removed.append(proto['output'])
+        return removed
+
+    def _header_hash(self, filename, folders, includes):
+        """Hash a header, the files it includes and its cpp options."""
+        config = self.options.match_file(filename)
+        search = [os.path.dirname(filename)] + sorted(
+                set(folders) | set(config.include_dirs))
+        files = sorted(cpp.find_includes(
+                [filename] + includes + config.includes, search))
+        values = [[getattr(config, i) for i in config.members]]
+        for name, content in files:
+            values.extend([name, content])
+        return {'hash': cache.create_key(*values), 'includes': list(includes),
+                'files': [name for name, content in files]}
+
+    def _config_hash(self, name):
+        """Hash the configuration and conformance file of a protocol."""
+        conf = self.options.configs.get(name, None)
+        if conf is None:
+            return None
+        values = list(conf.yaml)
+        if conf.cnf is not None:
+            values.extend(conf.cnf._lines)
+        return cache.create_key(*values)
+
+    def _options_hash(self):
+        """Hash the utility and the options which affect all dissectors."""
+        options = self.options
+        values = [
+            sorted(p.name for p in options.platforms), options.strict,
+            options.use_cpp, options.cpp_path, options.output_file,
+            options.loop_arrays,
+        ]
+        for conf in [options.default] + sorted(
+                options.files.values(), key=lambda conf: conf.filename):
+            values.append([getattr(conf, i) for i in conf.members])
+
+        # Source code of the utility itself
+        folder = os.path.dirname(os.path.abspath(__file__))
+        for filename in sorted(glob.glob(os.path.join(folder, '*.py'))):
+            with open(filename, 'rb') as f:
+                values.append(f.read())
+        return cache.create_key(*values)
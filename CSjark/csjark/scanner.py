@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for finding the header and configuration files to parse.
+
+The find_files() function searches folders recursively with os.scandir,
+which tells if an entry is a folder without another system call. It
+skips excluded files, and does not descend into excluded folders. The
+Excludes class matches paths against the excluded paths in a trie of
+path components, and against excluded glob patterns in one regular
+expression, so the time to match does not grow with the number of
+excludes.
+
+If Options.cache_dir is set, the listing of every folder is stored in
+the cache with the modification time of the folder, and reused while
+the folder is unchanged. This saves most of the time spent scanning
+large trees on network file systems.
+"""
+import os
+import re
+import json
+import time
+import fnmatch
+
+import cache
+from config import Options
+
+
+# Matches paths which are glob patterns
+_glob_regex = re.compile(r'[*?[]')
+
+
+class Excludes:
+    """A set of excluded paths and glob patterns.
+
+    A path is excluded if it, or any folder above it, equals an excluded
+    path or matches an excluded glob pattern.
+    """
+
+    def __init__(self, paths=()):
+        """Create a set of excluded 'paths'."""
+        self._trie = {} # Nested dicts of path components, None marks the end
+        globs = []
+        for path in paths:
+            path = os.path.normpath(path)
+            if _glob_regex.search(path):
+                globs.append(fnmatch.translate(os.path.normcase(path)))
+                continue
+            node = self._trie
+            for part in path.split(os.sep):
+                node = node.setdefault(part, {})
+            node[None] = True
+        self._glob = re.compile('|'.join(globs)) if globs else None
+
+    def __bool__(self):
+        """True if anything is excluded."""
+        return bool(self._trie) or self._glob is not None
+
+    def match(self, path):
+        """Check if 'path' is excluded."""
+        parts = os.path.normpath(path).split(os.sep)
+        node = self._trie
+        for part in parts:
+            node = node.get(part, None)
+            if node is None:
+                break
+            if None in node:
+                return True
+
+        if self._glob is not None:
+            parts = os.path.normcase(os.sep.join(parts)).split(os.sep)
+            for i in range(len(parts)):
+                if self._glob.match(os.sep.join(parts[:i + 1])):
+                    return True
+        return False
+
+    def filter(self, paths):
+        """Return the 'paths' which are not excluded."""
+        if not self:
+            return list(paths)
+        return [path for path in paths if not self.match(path)]
+
+
+def find_files(paths, extensions, excludes=None, options=Options):
+    """Find files ending with one of 'extensions' in 'paths'.
+
+    'paths' is a list of files and folders, files are kept as they are,
+    while folders are searched recursively and replaced by the files
+    found in them.
+    'excludes' is an Excludes instance of paths to skip.
+    'options' is the Options with the cache_dir to store listings in.
+    """
+    files = [path for path in paths if not os.path.isdir(path)]
+    folders = [path for path in paths if os.path.isdir(path)]
+    if excludes is None:
+        excludes = Excludes()
+    listings = _Listings(folders, options)
+
+    while folders:
+        folder = folders.pop()
+        for name, is_dir in listings.list(folder):
+            path = os.path.normpath(os.path.join(folder, name))
+            if excludes and excludes.match(path):
+                continue
+            if is_dir:
+                folders.append(path)
+            elif os.path.splitext(name)[1] in extensions:
+                files.append(path)
+
+    listings.save()
+    return files
+
+
+class _Listings:
+    """Folder listings, cached under the modification time of each folder."""
+
+    # Listings of folders changed this recently are not cached, as another
+    # change within the resolution of the file system's clock is not seen
+    min_age = 2 * 10**9 # Nanoseconds
+
+    def __init__(self, roots, options):
+        """Read the listings stored by an earlier search of 'roots'."""
+        self.options = options
+        self.old = {}
+        self.new = {}
+        self.key = None
+        if options.cache_dir is None or not roots:
+            return
+        self.key = cache.create_key(
+                'listings', sorted(os.path.abspath(i) for i in roots))
+        data = cache.read(self.key, 'dirs', options)
+        if data is not None:
+            self.old = json.loads(str(data, 'utf-8'))
+
+    def list(self, folder):
+        """List the names of the entries in 'folder', and if they are folders."""
+        if self.key is None:
+            return self._scan(folder)
+
+        path = os.path.abspath(folder)
+        mtime = os.stat(path).st_mtime_ns
+        old = self.old.get(path, None)
+        if old is not None and old[0] == mtime:
+            listing = old[1]
+        else:
+            listing = self._scan(folder)
+        if time.time() * 10**9 - mtime > self.min_age:
+            self.new[path] = [mtime, listing]
+        return listing
+
+    def save(self):
+        """Store the listings in the cache, if any changed."""
+        if self.key is not None and self.new != self.old:
+            data = json.dumps(self.new, sort_keys=True)
+            cache.write(self.key, 'dirs', bytes(data, 'utf-8'), self.options)
+
+    def _scan(self, folder):
+        """List the entries in 'folder' from the file system."""
+        with os.scandir(folder) as entries:
+            return [[entry.name, entry.is_dir()] for entry in entries]
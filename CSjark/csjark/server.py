@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for running CSjark as a long-running server.
+
+Starting CSjark means importing the parser, building the platforms and
+reading all configuration files, before anything is parsed. The Server
+class does this once, and then answers JSON-RPC 2.0 requests read from
+stdin, one request per line, with one response per line on stdout. The
+protocols parsed stay in memory, so a request only parses the headers
+which changed since they were parsed, before writing the dissectors.
+
+The methods a client can call are:
+
+ parse(headers=None)     Parse new or changed headers, all if None
+ generate(structs=None)  Write the dissectors for 'structs', parsing
+                         changed headers first, all and the delegator
+                         if None
+ structs()               Map the name of each struct to its header
+ shutdown()              Stop the server after answering
+"""
+import sys
+import os
+import json
+import inspect
+import contextlib
+
+import cpp
+import cache
+import csjark
+from session import Session
+
+
+# Error codes defined by JSON-RPC 2.0
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+# Error code for requests we understood, but failed to carry out
+SERVER_ERROR = -32000
+
+
+class ServerError(Exception):
+    """Exception raised by requests which the server failed to carry out."""
+    pass
+
+
+class Server:
+    """Answers requests to regenerate dissectors, with a warm session."""
+
+    def __init__(self, headers, folders=None, session=None):
+        """Create a server for generating dissectors for 'headers'.
+
+        'folders' is a set of all folders to -Include, defaults to the
+        folders of 'headers'.
+        'session' is the Session to keep warm, the default if None.
+        """
+        if folders is None:
+            folders = {os.path.dirname(i) for i in headers}
+        if session is None:
+            session = Session.default()
+        self.headers = list(headers)
+        self.folders = folders
+        self.session = session
+        self.running = False
+
+        self._hashes = {} # Map header to the hash of it and its includes
+        self._files = {} # Map header to the files it includes
+        self.methods = {'parse': self.parse, 'generate': self.generate,
+                        'structs': self.structs, 'shutdown': self.shutdown}
+
+    def serve(self, stdin=None, stdout=None):
+        """Answer requests from 'stdin' until shut down or end of file."""
+        if stdin is None:
+            stdin = sys.stdin
+        if stdout is None:
+            stdout = sys.stdout
+
+        self.running = True
+        for line in stdin:
+            if not line.strip():
+                continue
+            response = self.handle(line)
+            if response is not None:
+                stdout.write('%s\n' % json.dumps(response, sort_keys=True))
+                stdout.flush()
+            if not self.running:
+                break
+        self.running = False
+
+    def handle(self, line):
+        """Handle a single JSON-RPC request, returns the response.
+
+        Returns None for notifications, which have no id, unless the
+        request could not be read at all.
+        """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return _error(None, PARSE_ERROR, 'Parse error')
+        if (not isinstance(request, dict) or
+                not isinstance(request.get('method', None), str)):
+            return _error(None, INVALID_REQUEST, 'Invalid Request')
+
+        # Notifications are never answered, not even when they fail
+        notification = 'id' not in request
+        response = self._dispatch(request.get('id', None), request['method'],
+                                  request.get('params', {}))
+        return None if notification else response
+
+    def _dispatch(self, id, name, params):
+        """Call the method 'name' with 'params', returns the response."""
+        method = self.methods.get(name, None)
+        if method is None:
+            return _error(id, METHOD_NOT_FOUND, 'Method not found: %s' % name)
+        try:
+            if isinstance(params, list):
+                args = inspect.signature(method).bind(*params)
+            elif isinstance(params, dict):
+                args = inspect.signature(method).bind(**params)
+            else:
+                raise TypeError('params must be an array or object')
+        except TypeError as err:
+            return _error(id, INVALID_PARAMS, 'Invalid params: %s' % err)
+
+        # The parameters of every method are arrays of file or struct names
+        for param, value in args.arguments.items():
+            if value is not None and (not isinstance(value, list) or
+                    not all(isinstance(i, str) for i in value)):
+                return _error(id, INVALID_PARAMS,
+                              'Invalid params: %s must be an array of '
+                              'strings' % param)
+
+        # Anything printed while parsing must not end up in the responses
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                result = method(*args.args, **args.kwargs)
+        except ServerError as err:
+            return _error(id, SERVER_ERROR, str(err))
+        except Exception as err:
+            return _error(id, INTERNAL_ERROR, repr(err))
+        return {'jsonrpc': '2.0', 'id': id, 'result': result}
+
+    def parse(self, headers=None):
+        """Parse 'headers' which are new or changed since they were parsed.
+
+        'headers' defaults to all headers served, new headers are added,
+        and served headers which were deleted are removed.
+        Returns the headers which failed to parse.
+        """
+        if headers is None:
+            for filename in [i for i in self.headers if not os.path.isfile(i)]:
+                self.headers.remove(filename)
+                self._hashes.pop(filename, None)
+                self._forget(self._files.pop(filename, ()))
+            headers = self.headers
+        headers = [os.path.normpath(i) for i in headers]
+        missing = [i for i in headers if not os.path.isfile(i)]
+        if missing:
+            raise ServerError('Unknown file(s): %s' % ', '.join(missing))
+
+        stale = []
+        for filename in headers:
+            if filename not in self.headers:
+                self.headers.append(filename)
+                self.folders.add(os.path.dirname(filename))
+            files, key = self._hash(filename)
+            if self._hashes.get(filename, None) != key:
+                self._forget(self._files.get(filename, ()))
+                self._files[filename] = files
+                self._hashes[filename] = key
+                stale.append(filename)
+        if not stale:
+            return []
+
+        failed = csjark._parse_headers(stale, self.folders, self.session,
+                                       scanned=self.headers)
+        for filename in stale:
+            if filename in failed:
+                del self._hashes[filename] # Parse it again next time
+            else:
+                # Hash again, with the includes found while parsing
+                files, key = self._hash(filename)
+                self._files[filename] = files
+                self._hashes[filename] = key
+        return sorted(failed)
+
+    def generate(self, structs=None):
+        """Write the dissectors for 'structs', all if None.
+
+        Headers which changed are parsed first. Writing all dissectors
+        writes the delegator as well. Returns the number of dissectors
+        written and the headers which failed to parse.
+        """
+        failed = self.parse()
+        protocols = self.session.protocols
+        if structs is None:
+            wrote = csjark.write_dissectors_to_file(
+                    protocols, session=self.session)
+            csjark.write_delegator_to_file(self.session)
+        else:
+            unknown = [i for i in structs if i not in protocols]
+            if unknown:
+                raise ServerError('Unknown struct(s): %s' % ', '.join(unknown))
+            wrote = 0
+            for name in structs:
+                wrote += csjark._write_dissector(
+                        name, protocols[name], None, self.session.options)
+        return {'written': wrote, 'failed': failed}
+
+    def structs(self):
+        """Map the name of each struct parsed to the file defining it."""
+        return {name: os.path.normpath(proto._file)
+                for name, proto in self.session.protocols.items()}
+
+    def shutdown(self):
+        """Stop serving after answering this request."""
+        self.running = False
+
+    @property
+    def files(self):
+        """Get all the files included by the headers parsed."""
+        files = set()
+        for included in self._files.values():
+            files |= included
+        return files
+
+    def _hash(self, filename):
+        """Find the files 'filename' includes and hash their content."""
+        options = self.session.options
+        config = options.match_file(filename)
+        search = [os.path.dirname(filename)] + sorted(
+                set(self.folders) | set(config.include_dirs))
+        files = cpp.find_includes([filename] + config.includes, search)
+        values = []
+        for name, content in files:
+            values.extend([name, content])
+        names = {os.path.normpath(name) for name, content in files}
+        return names, cache.create_key(*values)
+
+    def _forget(self, files):
+        """Remove the protocols defined in 'files' from the session."""
+        protocols = self.session.protocols
+        for name, proto in list(protocols.items()):
+            if os.path.normpath(proto._file) in files:
+                del protocols[name]
+
+
+def _error(id, code, message):
+    """Create a JSON-RPC error response."""
+    return {'jsonrpc': '2.0', 'id': id,
+            'error': {'code': code, 'message': message}}
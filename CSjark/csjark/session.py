@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for holding the state of a generation of dissectors.
+
+A Session holds the options, and the protocols and types found in the
+headers parsed, which the cpp, cparser, dissector and config modules
+used to share through class members. Each session has state of its own,
+so several generations can run at the same time in one process, like in
+a build server. The command line utility uses the default session, which
+holds the options in config.Options.
+
+Changes made to the protocols and types inside a transaction() are
+undone if parsing fails, so a failed header leaves nothing behind.
+"""
+import os
+import contextlib
+
+from config import Options
+
+
+_MISSING = object() # Marks a key which was not in a mapping
+
+
+class Session:
+    """Holds the options, protocols and types of a generation."""
+
+    _default = None # The session of the command line utility
+
+    def __init__(self, options=None):
+        """Create a new session.
+
+        'options' is the Options to use, a copy of Options if None
+        """
+        if options is None:
+            options = Options.create()
+        self.options = options
+        self.protocols = {} # Map struct name to Protocol instances
+        self.known_types = {} # Map type name to source filename
+        self._journal = None # Changes to undo if the transaction fails
+
+    @classmethod
+    def default(cls):
+        """Get the default session, which uses config.Options."""
+        if cls._default is None:
+            cls._default = cls(Options)
+        return cls._default
+
+    def reset(self):
+        """Forget all protocols and types found."""
+        self.protocols = {}
+        self.known_types = {}
+
+    def set(self, mapping, key, value):
+        """Set 'key' in 'mapping' to 'value', undone if the transaction fails.
+
+        'mapping' is a dict owned by this session, or by a protocol in it
+        """
+        if self._journal is not None:
+            self._journal.append((mapping, key, mapping.get(key, _MISSING)))
+        mapping[key] = value
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Undo all changes made with set() if the block raises an error.
+
+        Transactions can be nested, the changes of a successful inner
+        transaction are undone if the outer transaction fails.
+        """
+        outer, journal = self._journal, []
+        self._journal = journal
+        try:
+            yield self
+        except BaseException:
+            self._journal = outer
+            for mapping, key, value in reversed(journal):
+                if value is _MISSING:
+                    mapping.pop(key, None)
+                else:
+                    mapping[key] = value
+            raise
+        self._journal = outer
+        if outer is not None:
+            outer.extend(journal)
+
+    def merge(self, protocols, known_types, platform):
+        """Merge protocols and types found for 'platform' in another session.
+
+        'protocols' maps struct names to Protocol instances
+        'known_types' maps type names to source filenames
+        Returns False without merging anything if any protocol conflicts
+        with a protocol found earlier, the caller must then parse again.
+        """
+        new = []
+        for name, proto in protocols.items():
+            diss = proto.get_dissector(platform)
+            if diss is None:
+                continue
+            old = self.protocols.get(name, None)
+            if old is None or old.get_dissector(platform) is None:
+                new.append((name, proto, diss))
+            elif (os.path.normpath(old._file) != os.path.normpath(proto._file)
+                    or old._line != proto._line):
+                return False # Two structs with same name
+
+        for name, proto, diss in new:
+            diss.platform = platform
+            old = self.protocols.get(name, None)
+            if old is None:
+                proto.dissectors = {platform.name: diss}
+                self.set(self.protocols, name, proto)
+            else:
+                self.set(old.dissectors, platform.name, diss)
+                self.set(vars(old), '_file', proto._file)
+                self.set(vars(old), '_line', proto._line)
+
+        for name, filename in known_types.items():
+            self.set(self.known_types, name, filename)
+        return True
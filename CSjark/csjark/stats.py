@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for measuring where the utility spends its time.
+
+When 'enabled', the wall time, number of calls and bytes produced by each
+stage of generating dissectors is added up in 'records', for each header
+and platform. The stages are:
+
+    cpp         running the C preprocessor program
+    post_cpp    cleaning up the output of the C preprocessor
+    parse       parsing the C code with pycparser
+    visit       describing the structs found in the AST
+    layout      creating the dissectors of the structs for a platform
+    generate    generating the Lua code of a dissector
+    write       writing the Lua code to file
+
+Work shared by several headers or platforms, like a batch of headers
+preprocessed together, or a header parsed once for every platform, is
+recorded under ALL. Like the cache counts, 'records' is shared by every
+session in the process, and processes add theirs with update().
+"""
+import time
+import json
+
+import cache
+
+
+STAGES = ('cpp', 'post_cpp', 'parse', 'visit', 'layout', 'generate', 'write')
+ALL = '*' # Header or platform name of work shared by several of them
+TOP = 10 # Number of slowest headers to list in the report
+
+enabled = False # Measure nothing unless enabled
+records = {} # Map (stage, header, platform) to [seconds, calls, bytes]
+
+
+def add(stage, header, platform, seconds, size=0):
+    """Add a call of 'seconds', producing 'size' bytes, to a stage."""
+    if header is None:
+        header = ALL
+    if platform is None:
+        platform = ALL
+    elif not isinstance(platform, str):
+        platform = platform.name
+    record = records.setdefault((stage, header, platform), [0.0, 0, 0])
+    record[0] += seconds
+    record[1] += 1
+    record[2] += size
+
+
+def measure(stage, header=None, platform=None):
+    """Measure the time spent in a with block as a call of 'stage'.
+
+    'header' and 'platform' is what the work was done for, None if it
+    was done for several of them. The number of bytes produced can be
+    set in the 'bytes' attribute of the object the with statement gives.
+    """
+    return Measurement(stage, header, platform)
+
+
+class Measurement:
+    """A context manager which adds the time of its block to a stage."""
+
+    __slots__ = ('stage', 'header', 'platform', 'bytes', 'start')
+
+    def __init__(self, stage, header=None, platform=None):
+        """Create a measurement of 'stage' for 'header' and 'platform'."""
+        self.stage = stage
+        self.header = header
+        self.platform = platform
+        self.bytes = 0
+
+    def __enter__(self):
+        """Start timing the block."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Add the time of the block to the stage, if stats are enabled."""
+        if enabled:
+            add(self.stage, self.header, self.platform,
+                time.perf_counter() - self.start, self.bytes)
+
+
+class Writer:
+    """A text stream which measures generating and writing code to 'out'.
+
+    The time spent writing to 'out' is added to the stage 'write', and
+    the rest of the time until close() to the stage 'generate'.
+    """
+
+    def __init__(self, out, header=None):
+        """Create a new Writer instance, writing code for 'header'."""
+        self.out = out
+        self.header = header
+        self.bytes = 0
+        self.seconds = 0.0
+        self.start = time.perf_counter()
+
+    def write(self, text):
+        """Write 'text' to the stream."""
+        start = time.perf_counter()
+        self.out.write(text)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(text)
+
+    def close(self):
+        """Add the time spent generating and writing to the stages."""
+        total = time.perf_counter() - self.start
+        if enabled:
+            add('generate', self.header, None, total - self.seconds,
+                self.bytes)
+            add('write', self.header, None, self.seconds, self.bytes)
+
+
+def update(other):
+    """Add records measured by another process."""
+    for key, (seconds, calls, size) in other.items():
+        record = records.setdefault(key, [0.0, 0, 0])
+        record[0] += seconds
+        record[1] += calls
+        record[2] += size
+
+
+def report(seconds=None, top=TOP):
+    """Summarize the records, returns a dict which can be stored as JSON.
+
+    'seconds' is the wall time of the whole run, if known.
+    'top' is the number of slowest headers to list.
+    The dict holds the totals of each stage, the totals of each stage
+    for each platform, the stages of each header for each platform,
+    and the headers which took the most time.
+    """
+    def total(mapping, stage, seconds, calls, size):
+        counts = mapping.setdefault(stage, {
+                'seconds': 0.0, 'calls': 0, 'bytes': 0})
+        counts['seconds'] += seconds
+        counts['calls'] += calls
+        counts['bytes'] += size
+
+    stages = {i: {'seconds': 0.0, 'calls': 0, 'bytes': 0} for i in STAGES}
+    platforms, headers = {}, {}
+    for (stage, header, platform), record in sorted(records.items()):
+        total(stages, stage, *record)
+        total(platforms.setdefault(platform, {}), stage, *record)
+        entry = headers.setdefault(header, {'seconds': 0.0, 'platforms': {}})
+        entry['seconds'] += record[0]
+        total(entry['platforms'].setdefault(platform, {}), stage, *record)
+
+    slowest = sorted((i for i in headers if i != ALL),
+                     key=lambda i: headers[i]['seconds'], reverse=True)
+    return {
+        'seconds': seconds,
+        'stages': stages,
+        'platforms': platforms,
+        'headers': headers,
+        'slowest': [{'header': i, 'seconds': headers[i]['seconds']}
+                    for i in slowest[:top]],
+        'cache': {'hits': cache.hits, 'misses': cache.misses},
+    }
+
+
+def write_report(filename, seconds=None, top=TOP):
+    """Write the report() of the records to 'filename' as JSON."""
+    with open(filename, 'w') as f:
+        json.dump(report(seconds, top), f, indent=2, sort_keys=True)
@@ -21,8 +21,21 @@
 Modules for unit testing the CSjark utility.
 """
 
+import shutil
+import tempfile
+
 __all__ = [
-    'black_box', 'requirements', 'test_config',
-    'test_csjark', 'test_dissector',
+    'black_box', 'requirements', 'test_config', 'test_cparser',
+    'test_csjark', 'test_dissector', 'test_manifest', 'test_scanner',
+    'test_server', 'test_stats', 'test_watcher',
 ]
 
+
+def tempdir():
+    """Create a temporary folder for a test, as a context for Tests."""
+    folder = tempfile.mkdtemp()
+    try:
+        yield folder
+    finally:
+        shutil.rmtree(folder)
+
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for benchmarking parts of our program.
+
+Not run by attest, run it from the csjark folder with:
+"python -m test.benchmark"
+
+Besides timing single functions, it generates a tree of synthetic header
+files of a configurable size, and times each stage of generating
+dissectors for them: the C preprocessor, parsing, finding structs,
+generating Lua code and writing it to file. The peak memory use is
+measured in a separate run, as tracing memory slows everything down.
+With "--output results.json" the results are stored as JSON, which a
+later run given "--compare results.json" prints the changes against,
+so regressions between commits are visible.
+"""
+import sys
+import os
+import json
+import time
+import timeit
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+
+import cpp
+import cparser
+import field
+from config import Options
+from platform import Platform
+from session import Session
+
+
+# The stages of the generator pipeline, in the order they run
+STAGES = ('cpp', 'parse', 'find_structs', 'generate', 'write')
+
+
+def bench_create_lua_var(number=4000):
+    """Time field.create_lua_var for names of increasing length.
+
+    Returns a list of (length, cold, warm) tuples, where cold is the time
+    in microseconds per call with an empty memo cache, and warm is the
+    time per call when the name is already cached.
+    """
+    results = []
+    for length in (8, 64, 512, 4096):
+        names = [('%i name.with-[%i] invalid chars ' % (i, i) * length)[:length]
+                 for i in range(number)]
+
+        field.create_lua_var.cache_clear()
+        cold = timeit.timeit(lambda: [field.create_lua_var(i) for i in names],
+                             number=1)
+        warm = timeit.timeit(lambda: [field.create_lua_var(i) for i in names],
+                             number=1)
+        results.append((length, cold * 1e6 / number, warm * 1e6 / number))
+    field.create_lua_var.cache_clear()
+    return results
+
+
+def make_headers(folder, structs=200, files=10, depth=4,
+                 array_size=16, typedefs=3):
+    """Write a tree of synthetic header files to 'folder'.
+
+    'structs' is the number of structs, spread evenly over 'files' files
+    'depth' is how many structs deep they are nested in each other
+    'array_size' is the number of elements in the array members
+    'typedefs' is the length of the chain of typedefs of an int
+    Every header includes the header before it, and the one halfway
+    to the first, and all include a header with the typedefs and an enum.
+    Returns a list of the filenames of the headers with structs.
+    """
+    lines = ['#ifndef BENCH_TYPES_H', '#define BENCH_TYPES_H', '',
+             'typedef unsigned int bench_t0;']
+    lines.extend('typedef bench_t%i bench_t%i;' % (i, i + 1)
+                 for i in range(typedefs))
+    lines.extend(['enum bench_color { RED, GREEN = 3, BLUE };', '#endif', ''])
+    with open(os.path.join(folder, 'bench_types.h'), 'w') as f:
+        f.write('\n'.join(lines))
+
+    headers = []
+    per_file = -(-structs // files) # Rounded up
+    for i in range(files):
+        name = 'bench_%i.h' % i
+        lines = ['#ifndef BENCH_%i_H' % i, '#define BENCH_%i_H' % i, '',
+                 '#include "bench_types.h"']
+        lines.extend('#include "bench_%i.h"' % j
+                     for j in sorted({i - 1, i // 2} - {i}) if j >= 0)
+        for j in range(i * per_file, min(structs, (i + 1) * per_file)):
+            lines.extend(['', 'struct bench%i {' % j,
+                    '\tint id;',
+                    '\tchar name[%i];' % array_size,
+                    '\tbench_t%i value;' % typedefs,
+                    '\tbench_t%i values[%i];' % (typedefs, array_size),
+                    '\tshort matrix[2][%i];' % array_size,
+                    '\tenum bench_color color;',
+                    '\tdouble *next;'])
+            if j % depth:
+                lines.append('\tstruct bench%i inner[2];' % (j - 1))
+            lines.append('};')
+        lines.extend(['', '#endif', ''])
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('\n'.join(lines))
+        headers.append(os.path.join(folder, name))
+    return headers
+
+
+def run_pipeline(headers, platforms, output):
+    """Generate dissectors for 'headers', timing each stage.
+
+    'platforms' is a list of platforms to generate dissectors for
+    'output' is the folder to write the dissectors to
+    Returns a dict mapping each stage to its time in seconds and calls.
+    """
+    options = Options.create()
+    options.platforms = set(platforms)
+    session = Session(options)
+    folders = {os.path.dirname(i) for i in headers}
+    stages = {i: {'seconds': 0.0, 'calls': 0} for i in STAGES}
+
+    def timed(stage, func, *args, **kwargs):
+        """Call 'func', adding the time it took to 'stage'."""
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        stages[stage]['seconds'] += time.perf_counter() - start
+        stages[stage]['calls'] += 1
+        return result
+
+    for filename in headers:
+        for platform in platforms:
+            text = timed('cpp', cpp.parse_file, filename,
+                         platform, folders, session=session)
+            ast = timed('parse', cparser.parse, text,
+                        filename, session=session)
+            timed('find_structs', cparser.find_structs,
+                  ast, platform, session)
+
+    for name, proto in session.protocols.items():
+        code = timed('generate', proto.generate)
+        def write():
+            with open(os.path.join(output, '%s.lua' % name), 'w') as f:
+                f.write(code)
+        timed('write', write)
+    return stages
+
+
+def bench_pipeline(repeat=3, platforms=('default', 'Win32', 'Linux-x86'),
+                   **sizes):
+    """Time the generator pipeline on a tree of synthetic headers.
+
+    'repeat' is how many times to run the pipeline, the fastest time of
+    each stage is kept.
+    'platforms' is the names of the platforms to generate dissectors for
+    'sizes' is given to make_headers() to decide the size of the tree.
+    Returns a dict with the time and calls of each stage, the total
+    time, and the peak memory use in bytes.
+    """
+    platforms = [Platform.mappings[i] for i in platforms]
+    folder = tempfile.mkdtemp()
+    try:
+        source = os.path.join(folder, 'headers')
+        output = os.path.join(folder, 'output')
+        os.mkdir(source)
+        os.mkdir(output)
+        headers = make_headers(source, **sizes)
+
+        stages = None
+        for i in range(repeat):
+            run = run_pipeline(headers, platforms, output)
+            if stages is None:
+                stages = run
+            for stage, result in run.items():
+                stages[stage]['seconds'] = min(
+                        stages[stage]['seconds'], result['seconds'])
+
+        tracemalloc.start()
+        try:
+            run_pipeline(headers, platforms, output)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        shutil.rmtree(folder)
+
+    total = sum(i['seconds'] for i in stages.values())
+    return {'stages': stages, 'seconds': total, 'peak_memory': peak}
+
+
+def _commit():
+    """Get the git commit of the working tree, None if unknown."""
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.strip()
+
+
+def compare(old, new):
+    """Print the change in time of each stage from 'old' to 'new' results."""
+    print('%-14s %10s %10s %8s' % ('stage', 'old', 'new', 'change'))
+    rows = [(i, old['pipeline']['stages'].get(i, {}).get('seconds'),
+             new['pipeline']['stages'][i]['seconds']) for i in STAGES]
+    rows.append(('total', old['pipeline']['seconds'],
+                 new['pipeline']['seconds']))
+    for stage, before, after in rows:
+        if not before:
+            print('%-14s %10s %10.4f' % (stage, '-', after))
+        else:
+            print('%-14s %10.4f %10.4f %+7.1f%%' % (
+                    stage, before, after, (after / before - 1) * 100))
+    before = old['pipeline']['peak_memory']
+    after = new['pipeline']['peak_memory']
+    print('%-14s %10i %10i %+7.1f%%' % ('peak memory', before, after,
+                                        (after / before - 1) * 100))
+
+
+def main(args=None):
+    """Run all benchmarks and print the results."""
+    parser = argparse.ArgumentParser(prog='python -m test.benchmark',
+            description='Benchmark generating dissectors.')
+    parser.add_argument('--structs', type=int, default=200,
+            help='number of structs in the synthetic headers')
+    parser.add_argument('--files', type=int, default=10,
+            help='number of header files to spread the structs over')
+    parser.add_argument('--depth', type=int, default=4,
+            help='how deep structs are nested in each other')
+    parser.add_argument('--array-size', type=int, default=16,
+            help='number of elements in array members')
+    parser.add_argument('--typedefs', type=int, default=3,
+            help='length of the chain of typedefs')
+    parser.add_argument('--platforms', nargs='+', metavar='platform',
+            default=['default', 'Win32', 'Linux-x86'],
+            help='platforms to generate dissectors for')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='number of runs, the fastest of each stage is kept')
+    parser.add_argument('--output', metavar='file',
+            help='write the results to file as JSON')
+    parser.add_argument('--compare', metavar='file',
+            help='print the changes from results in file')
+    namespace = parser.parse_args(args)
+
+    print('create_lua_var (microseconds per call)')
+    print('%8s %10s %10s' % ('length', 'cold', 'warm'))
+    lua_vars = bench_create_lua_var()
+    for length, cold, warm in lua_vars:
+        print('%8i %10.2f %10.2f' % (length, cold, warm))
+
+    sizes = {'structs': namespace.structs, 'files': namespace.files,
+             'depth': namespace.depth, 'array_size': namespace.array_size,
+             'typedefs': namespace.typedefs}
+    pipeline = bench_pipeline(namespace.repeat, namespace.platforms, **sizes)
+    print()
+    print('pipeline (%i structs in %i files, %i platforms)' % (
+            namespace.structs, namespace.files, len(namespace.platforms)))
+    print('%-14s %10s %8s' % ('stage', 'seconds', 'calls'))
+    for stage in STAGES:
+        result = pipeline['stages'][stage]
+        print('%-14s %10.4f %8i' % (stage, result['seconds'], result['calls']))
+    print('%-14s %10.4f' % ('total', pipeline['seconds']))
+    print('peak memory %.1f MB' % (pipeline['peak_memory'] / 2**20))
+
+    results = {
+        'commit': _commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'parameters': dict(sizes, platforms=namespace.platforms,
+                           repeat=namespace.repeat),
+        'create_lua_var': [{'length': length, 'cold': cold, 'warm': warm}
+                           for length, cold, warm in lua_vars],
+        'pipeline': pipeline,
+    }
+    if namespace.compare:
+        with open(namespace.compare) as f:
+            old = json.load(f)
+        print()
+        if old.get('parameters') != results['parameters']:
+            print('Warning: results in %s used other parameters' %
+                  namespace.compare)
+        compare(old, results)
+    if namespace.output:
+        with open(namespace.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
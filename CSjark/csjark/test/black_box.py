@@ -26,9 +26,8 @@ import sys, os
 from attest import Tests, assert_hook, contexts
 
 import csjark
-import cparser
 import config
-import dissector
+from session import Session
 
 from .test_dissector import compare_lua
 
@@ -57,7 +56,7 @@ def create_protocols(headers, yml, args=None, cleanup=True):
 
     # Sort the protocols on name
     structs = {}
-    for key, proto in cparser.StructVisitor.all_protocols.items():
+    for key, proto in Session.default().protocols.items():
         structs[proto.name] = proto.generate()
 
     if cleanup:
@@ -68,9 +67,8 @@ def create_protocols(headers, yml, args=None, cleanup=True):
 
 def perform_cleanup(defaults):
     """Clean up after running create_protocols."""
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     config.Options.platforms = set()
-    cparser.StructVisitor.all_protocols = {}
     config.Options.configs = {}
     (config.Options.verbose, config.Options.debug,
             config.Options.strict, config.Options.use_cpp,
@@ -114,9 +112,11 @@ def cenums(structs):
     else
     pinfo.cols.info:append("(C Enum test)")
     end
+    local range
     subtree:add(f.id, buffer(0, 4))
-    local mnd_node = subtree:add(f.mnd, buffer(4, 4))
-    local mnd_value = buffer(4, 4):uint()
+    range = buffer(4, 4)
+    local mnd_node = subtree:add(f.mnd, range)
+    local mnd_value = range:uint()
     if mnd_valuestring[mnd_value] == nil then
     mnd_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 20]")
     end
@@ -260,20 +260,24 @@ def bitstrings(structs):
     else
     pinfo.cols.info:append("(Bit string test)")
     end
+    local range
     subtree:add(f.id, buffer(0, 4))
-    local bittree = subtree:add(f.flags, buffer(4, 4))
-    bittree:add(f.flags_inuse, buffer(4, 4))
-    bittree:add(f.flags_endian, buffer(4, 4))
-    bittree:add(f.flags_platform, buffer(4, 4))
-    bittree:add(f.flags_test, buffer(4, 4))
-    local bittree = subtree:add(f.color1, buffer(8, 2))
-    bittree:add(f.color1_red, buffer(8, 2))
-    bittree:add(f.color1_blue, buffer(8, 2))
-    bittree:add(f.color1_green, buffer(8, 2))
-    local bittree = subtree:add(f.color2, buffer(10, 2))
-    bittree:add(f.color2_red, buffer(10, 2))
-    bittree:add(f.color2_blue, buffer(10, 2))
-    bittree:add(f.color2_green, buffer(10, 2))
+    range = buffer(4, 4)
+    local bittree = subtree:add(f.flags, range)
+    bittree:add(f.flags_inuse, range)
+    bittree:add(f.flags_endian, range)
+    bittree:add(f.flags_platform, range)
+    bittree:add(f.flags_test, range)
+    range = buffer(8, 2)
+    local bittree = subtree:add(f.color1, range)
+    bittree:add(f.color1_red, range)
+    bittree:add(f.color1_blue, range)
+    bittree:add(f.color1_green, range)
+    range = buffer(10, 2)
+    local bittree = subtree:add(f.color2, range)
+    bittree:add(f.color2_red, range)
+    bittree:add(f.color2_blue, range)
+    bittree:add(f.color2_green, range)
     end
     delegator_register_proto(proto_bitstring_test, "bitstring_test", 13, {[0]=12})
     ''')
@@ -331,14 +335,16 @@ def custom(structs):
     else
     pinfo.cols.info:append("(struct custom_lua)")
     end
+    local range
     subtree:add(f.normal, buffer(0, 2))
     subtree:add(f.special, buffer(8, 8))
     subtree:add(f.abs, buffer(16, 4))
     subtree:add(f.rel, buffer(20, 4))
     subtree:add(f.abool, buffer(24, 4))
     subtree:add(f.something, buffer(28, 4))
-    local truth_node = subtree:add(f.truth, buffer(32, 4))
-    local truth_value = buffer(32, 4):uint()
+    range = buffer(32, 4)
+    local truth_node = subtree:add(f.truth, range)
+    local truth_value = range:uint()
     if truth_valuestring[truth_value] == nil then
     truth_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1]")
     end
@@ -399,19 +405,23 @@ def enums(structs):
     else
     pinfo.cols.info:append("(Enum config test)")
     end
-    local id_node = subtree:add(f.id, buffer(0, 4))
-    local id_value = buffer(0, 4):int()
+    local range
+    range = buffer(0, 4)
+    local id_node = subtree:add(f.id, range)
+    local id_value = range:int()
     if id_valuestring[id_value] == nil then
     id_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1, 2, 3, 4, 5]")
     end
     subtree:add(f.name, buffer(4, 10))
-    local weekday_node = subtree:add(f.weekday, buffer(16, 4))
-    local weekday_value = buffer(16, 4):int()
+    range = buffer(16, 4)
+    local weekday_node = subtree:add(f.weekday, range)
+    local weekday_value = range:int()
     if weekday_valuestring[weekday_value] == nil then
     weekday_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1, 2, 3, 4, 5]")
     end
-    local number_node = subtree:add(f.number, buffer(20, 4))
-    local number_value = buffer(20, 4):int()
+    range = buffer(20, 4)
+    local number_node = subtree:add(f.number, range)
+    local number_value = range:int()
     if number_valuestring[number_value] == nil then
     number_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1, 2, 3, 4, 5]")
     end
@@ -442,9 +452,11 @@ def ranges(structs):
     else
     pinfo.cols.info:append("(Range rules test)")
     end
+    local range
     subtree:add(f.name, buffer(0, 10))
-    local age_node = subtree:add(f.age, buffer(12, 4))
-    local age_value = buffer(12, 4):int()
+    range = buffer(12, 4)
+    local age_node = subtree:add(f.age, range)
+    local age_value = range:int()
     if age_value < 0.0 then
     age_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be larger than 0.0")
     end
@@ -466,6 +478,10 @@ def struct_within_struct(structs):
     local proto_struct_within_struct_test = Proto("struct_within_struct_test", "Struct in struct test")
     -- ProtoField defintions for: struct_within_struct_test
     local f = proto_struct_within_struct_test.fields
+    local dissectors = setmetatable({}, {__index = function(t, name)
+    t[name] = Dissector.get(name)
+    return t[name]
+    end})
     f.prime = ProtoField.int32("struct_within_struct_test.prime", "prime")
     -- Dissector function for: struct_within_struct_test
     function proto_struct_within_struct_test.dissector(buffer, pinfo, tree)
@@ -479,7 +495,7 @@ def struct_within_struct(structs):
     end
     subtree:add(f.prime, buffer(0, 4))
     pinfo.private.field_name = "astruct"
-    Dissector.get("cenum_test"):call(buffer(4, 8):tvb(), pinfo, subtree)
+    dissectors["cenum_test"]:call(buffer(4, 8):tvb(), pinfo, subtree)
     end
     delegator_register_proto(proto_struct_within_struct_test, "struct_within_struct_test", 12, {[0]=12})
     ''')
@@ -495,6 +511,10 @@ def trailers(structs):
     local proto_trailer_test = Proto("trailer_test", "struct trailer_test")
     -- ProtoField defintions for: trailer_test
     local f = proto_trailer_test.fields
+    local dissectors = setmetatable({}, {__index = function(t, name)
+    t[name] = Dissector.get(name)
+    return t[name]
+    end})
     f.tmp = ProtoField.bytes("trailer_test.tmp", "tmp")
     f.tmp_0 = ProtoField.float("trailer_test.tmp.0", "tmp[0]")
     f.tmp_1 = ProtoField.float("trailer_test.tmp.1", "tmp[1]")
@@ -524,20 +544,16 @@ def trailers(structs):
     local trail_offset = 24
     local trail_count = buffer(20, 4):int()
     for i = 1, trail_count do
-    local trailer = Dissector.get("ber")
-    trailer:call(buffer(trail_offset, 6):tvb(), pinfo, tree)
+    dissectors["ber"]:call(buffer(trail_offset, 6):tvb(), pinfo, tree)
     trail_offset = trail_offset + 6
     end
-    local trailer = Dissector.get("ber")
-    trailer:call(buffer(trail_offset, 5):tvb(), pinfo, tree)
+    dissectors["ber"]:call(buffer(trail_offset, 5):tvb(), pinfo, tree)
     trail_offset = trail_offset + 5
     for i = 1, 2 do
-    local trailer = Dissector.get("ber")
-    trailer:call(buffer(trail_offset, 6):tvb(), pinfo, tree)
+    dissectors["ber"]:call(buffer(trail_offset, 6):tvb(), pinfo, tree)
     trail_offset = trail_offset + 6
     end
-    local trailer = Dissector.get("ber")
-    trailer:call(buffer(trail_offset):tvb(), pinfo, tree)
+    dissectors["ber"]:call(buffer(trail_offset):tvb(), pinfo, tree)
     end
     delegator_register_proto(proto_trailer_test, "trailer_test", 66, {[0]=24})
     ''')
@@ -566,6 +582,10 @@ def keywords(structs):
     local proto_keyword_test = Proto("keyword_test", "testing lua keywords")
     -- ProtoField defintions for: keyword_test
     local f = proto_keyword_test.fields
+    local dissectors = setmetatable({}, {__index = function(t, name)
+    t[name] = Dissector.get(name)
+    return t[name]
+    end})
     f._in = ProtoField.int32("keyword_test.in", "in")
     f._until = ProtoField.bytes("keyword_test.until", "until")
     f._until_0 = ProtoField.bytes("keyword_test.until.0", "until[0]")
@@ -591,8 +611,10 @@ def keywords(structs):
     else
     pinfo.cols.info:append("(testing lua keywords)")
     end
-    local in_node = subtree:add_le(f._in, buffer(0, 4))
-    local in_value = buffer(0, 4):le_int()
+    local range
+    range = buffer(0, 4)
+    local in_node = subtree:add_le(f._in, range)
+    local in_value = range:le_int()
     if in_value < 0.0 then
     in_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be larger than 0.0")
     end
@@ -609,15 +631,17 @@ def keywords(structs):
     subarray:set_text("until[1] (2 x int32)")
     subarray:add_le(f._until_1_0, buffer(12, 4))
     subarray:add_le(f._until_1_1, buffer(16, 4))
-    local bittree = subtree:add_le(f._version, buffer(20, 4))
-    bittree:add_le(f._version_g1, buffer(20, 4))
-    local function_node = subtree:add_le(f._function, buffer(24, 4))
-    local function_value = buffer(24, 4):le_uint()
+    range = buffer(20, 4)
+    local bittree = subtree:add_le(f._version, range)
+    bittree:add_le(f._version_g1, range)
+    range = buffer(24, 4)
+    local function_node = subtree:add_le(f._function, range)
+    local function_value = range:le_uint()
     if function_valuestring[function_value] == nil then
     function_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [1, 2, 412]")
     end
     pinfo.private.field_name = "or"
-    Dissector.get("local"):call(buffer(28, 4):tvb(), pinfo, subtree)
+    dissectors["local"]:call(buffer(28, 4):tvb(), pinfo, subtree)
     subtree:add_le(f._and, buffer(32, 4))
     subtree:add_le(f._and, buffer(36, 4))
     subtree:add_le(f._not, buffer(40, 4))
@@ -625,8 +649,7 @@ def keywords(structs):
     local trail_offset = 44
     local trail_count = buffer(40, 4):le_int()
     for i = 1, trail_count do
-    local trailer = Dissector.get("ber")
-    trailer:call(buffer(trail_offset, 5):tvb(), pinfo, tree)
+    dissectors["ber"]:call(buffer(trail_offset, 5):tvb(), pinfo, tree)
     end
     end
     delegator_register_proto(proto_keyword_test, "keyword_test", 255, {[1]=44})
@@ -643,6 +666,10 @@ def platforms(structs):
     local proto_platform_test = Proto("platform_test", "struct platform_test")
     -- ProtoField defintions for: platform_test
     local f = proto_platform_test.fields
+    local dissectors = setmetatable({}, {__index = function(t, name)
+    t[name] = Dissector.get(name)
+    return t[name]
+    end})
     f.bytes = ProtoField.bytes("platform_test.bytes", "bytes")
     f.a = ProtoField.int32("platform_test.a", "a")
     f.win_float = ProtoField.float("platform_test.win_float", "win_float")
@@ -664,7 +691,7 @@ def platforms(structs):
     subtree:add_le(f.win_float, buffer(12, 4))
     subtree:add_le(f.b, buffer(16, 1))
     pinfo.private.field_name = "anom"
-    Dissector.get("anom"):call(buffer(20, 4):tvb(), pinfo, subtree)
+    dissectors["anom"]:call(buffer(20, 4):tvb(), pinfo, subtree)
     subtree:add_le(f.deff, buffer(24, 4))
     subtree:add_le(f.intel, buffer(28, 4))
     end
@@ -759,6 +786,7 @@ def conformance_files(structs):
     else
     pinfo.cols.info:append("(struct custom_lua)")
     end
+    local range
     subtree:add_le(f.normal, buffer(0, 2))
     subtree:add_le(f.special, buffer(8, 8))
     subtree:add_le(f.abs, buffer(16, 4))
@@ -766,8 +794,9 @@ def conformance_files(structs):
     subtree:add_le(f.abool, buffer(24, 4))
     subtree:add_le(f.something, buffer(28, 4))
     -- This is above 'truth' inside the dissector function.
-    local truth_node = subtree:add_le(f.truth, buffer(32, 4))
-    local truth_value = buffer(32, 4):le_uint()
+    range = buffer(32, 4)
+    local truth_node = subtree:add_le(f.truth, range)
+    local truth_value = range:le_uint()
     if truth_valuestring[truth_value] == nil then
     truth_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1]")
     end
@@ -850,25 +879,30 @@ def enum_arrays(structs):
     else
     pinfo.cols.info:append("(struct enum_arrays)")
     end
+    local range
     local array = subtree:add_le(f.month_array, buffer(0, 16))
     array:set_text("month_array (4 x uint32)")
-    local month_array_node = array:add_le(f.month_array_0, buffer(0, 4))
-    local month_array_value = buffer(0, 4):le_uint()
+    range = buffer(0, 4)
+    local month_array_node = array:add_le(f.month_array_0, range)
+    local month_array_value = range:le_uint()
     if month_array_valuestring[month_array_value] == nil then
     month_array_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [1, 2, 3, 4, 5, 20]")
     end
-    local month_array_node = array:add_le(f.month_array_1, buffer(4, 4))
-    local month_array_value = buffer(4, 4):le_uint()
+    range = buffer(4, 4)
+    local month_array_node = array:add_le(f.month_array_1, range)
+    local month_array_value = range:le_uint()
     if month_array_valuestring[month_array_value] == nil then
     month_array_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [1, 2, 3, 4, 5, 20]")
     end
-    local month_array_node = array:add_le(f.month_array_2, buffer(8, 4))
-    local month_array_value = buffer(8, 4):le_uint()
+    range = buffer(8, 4)
+    local month_array_node = array:add_le(f.month_array_2, range)
+    local month_array_value = range:le_uint()
     if month_array_valuestring[month_array_value] == nil then
     month_array_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [1, 2, 3, 4, 5, 20]")
     end
-    local month_array_node = array:add_le(f.month_array_3, buffer(12, 4))
-    local month_array_value = buffer(12, 4):le_uint()
+    range = buffer(12, 4)
+    local month_array_node = array:add_le(f.month_array_3, range)
+    local month_array_value = range:le_uint()
     if month_array_valuestring[month_array_value] == nil then
     month_array_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [1, 2, 3, 4, 5, 20]")
     end
@@ -930,7 +964,7 @@ def cpp_arguments(structs):
 @sprint4.test
 def placeholder_configs(structs):
     """Test that it works to generate placeholder configs."""
-    protocols = cparser.StructVisitor.all_protocols
+    protocols = Session.default().protocols
     assert protocols
     text, count = config.generate_placeholders(protocols)
     assert text and count
@@ -261,3 +261,31 @@ def trailers_rule(conf):
     assert two.member == 'asn1_count' and one.member is None
     assert one.size == 8 and two.size == 12 and three.size is None
 
+
+
+# Test that configuration support lazy array thresholds
+arrays = Tests()
+
+@arrays.context
+def create_arrays():
+    """Create struct config with array thresholds."""
+    text = '''
+    Structs:
+      - name: test
+        array_threshold: 256
+        arrays:
+          - member: samples
+            threshold: 16
+      - name: test2
+    '''
+    config.parse_file('test', only_text=text)
+    yield Options.configs['test'], Options.configs['test2']
+    Options.configs = {}
+
+@arrays.test
+def arrays_rule(conf, conf2):
+    """Test that config support thresholds for arrays."""
+    assert conf.array_threshold == 256
+    assert conf.get_array_threshold('samples') == 16
+    assert conf.get_array_threshold('values') == 256
+    assert conf2.get_array_threshold('samples') is None
@@ -23,12 +23,18 @@ Module for testing the cparser module.
 Tests the C parser, the C preprocessor, and finding structs.
 """
 import sys, os
+import threading
 from attest import Tests, assert_hook, contexts
-from pycparser import c_ast
+from pycparser import c_ast, plyparser
 
 import cpp
+import cache
 import cparser
+from config import Options
+from session import Session
 from platform import Platform
+from layout import Layout
+from . import tempdir
 
 
 def _child(node, depth=1):
@@ -42,6 +48,7 @@ def _child(node, depth=1):
 
 # Tests for cparser.parse()
 parse = Tests()
+parse.context(tempdir)
 
 @parse.test
 def parse_basic_types():
@@ -97,6 +104,50 @@ def parse_array_type():
     assert _child(b, 2).declname == 'b'
     assert _child(b, 3).names[0] == 'char'
 
+@parse.test
+def parse_cache(folder):
+    """Test that the AST is cached on disk when asked to."""
+    Options.cache_dir, Options.cache_ast = folder, True
+    try:
+        code = 'struct cached { int a; float b; };'
+        ast = cparser.parse(code, 'test')
+        assert len(os.listdir(folder)) == 1
+        hits = cache.hits.get('ast', 0)
+        cached = cparser.parse(code, 'test')
+        assert cache.hits['ast'] == hits + 1
+        assert _child(cached, 2).name == 'cached'
+        assert _child(cached, 2).coord.file == 'test'
+        assert len(_child(cached, 2).children()) == 2
+    finally:
+        Options.cache_dir, Options.cache_ast = None, False
+
+@parse.test
+def parse_many_texts():
+    """Test parsing a batch of code, in this and in other processes."""
+    texts = ['struct many%i { int a[%i]; };' % (i, i + 1) for i in range(6)]
+    for jobs in (1, 3):
+        asts = cparser.parse_many(texts, ['many.h'] * 6, jobs=jobs)
+        assert [_child(i, 2).name for i in asts] == [
+                'many%i' % i for i in range(6)]
+        assert _child(asts[5], 2).coord.file == 'many.h'
+    with contexts.raises(plyparser.ParseError):
+        cparser.parse_many(['struct ok { int a; };', 'struct { int'], jobs=1)
+
+@parse.test
+def parser_per_thread():
+    """Test that each thread parses with a parser of its own."""
+    found = []
+    def run():
+        found.append(cparser.parsers.parser)
+        found.append(cparser.parsers.parser)
+    threads = [threading.Thread(target=run) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert found[0] is found[1] and found[2] is found[3]
+    assert len({id(i) for i in found}) == 3
+
 
 # Tests for cparser.find_structs()
 find_structs = Tests()
@@ -125,7 +176,7 @@ def create_structs():
     ast = cparser.parse(code, 'test')
     structs = {i.name: i for i in cparser.find_structs(ast)}
     yield list(structs['find'].dissectors.values())[0].children
-    cparser.StructVisitor.all_protocols = {}
+    Session.default().reset()
 
 @find_structs.test
 def find_basic_types(fields):
@@ -196,6 +247,33 @@ def parse_error():
         cparser.find_structs(ast)
     assert str(error).startswith('Two structs with same name a')
 
+@find_structs.test
+def layout_declarations_for_platforms(fields):
+    """Test that structs are described once and laid out per platform."""
+    code = 'struct ptrs { char c; int *p; char s[2][8]; };'
+    declarations = cparser.describe(cparser.parse(code, 'test'))
+    struct, = declarations.structs
+    assert struct.name == 'ptrs'
+    assert [(i.name, i.kind, i.ctype, i.depth) for i in struct.members] == [
+            ('c', 'field', 'char', None), ('p', 'field', 'pointer', None),
+            ('s', 'string', 'char', [2])]
+
+    session = Session(Options.create())
+    sizes = {}
+    for name in ('Win32', 'Win64'):
+        platform = Platform.mappings[name]
+        Layout(platform, session).create(declarations)
+        dissector = session.protocols['ptrs'].get_dissector(platform)
+        sizes[name] = [i.size for i in dissector.children], dissector.size
+    assert sizes['Win32'] == ([1, 4, 16], 24)
+    assert sizes['Win64'] == ([1, 8, 16], 32)
+
+    # Structs declared inside another struct are not its members
+    code = 'struct outer { int d; struct inner { int e; }; int f; };'
+    struct, = cparser.describe(cparser.parse(code, 'test')).structs
+    assert [i.name for i in struct.members] == ['d', 'f']
+    assert [i.name for i in struct.nested] == ['inner']
+
 
 # Tests for the C preprocessor
 cpps = Tests()
@@ -209,6 +287,8 @@ def create_ast():
     text = cpp.parse_file(cpp_h)
     yield cparser.parse(text)
 
+cpps.context(tempdir)
+
 @cpps.test
 def cpp_define(ast):
     """Test that our C preprocessor support #define."""
@@ -233,3 +313,101 @@ def cpp_macros(ast):
     """Test that our C preprocessor support _WIN32 and other macros."""
     pass # Meh, how do we solve this?
 
+@cpps.test
+def cpp_cache(ast, folder):
+    """Test that output from the C preprocessor is cached on disk."""
+    cpp_h = os.path.join(os.path.dirname(__file__), 'cpp.h')
+    Options.cache_dir = folder
+    with open(os.path.join(folder, 'notes.txt'), 'w') as f:
+        f.write('Not a cache entry')
+    try:
+        text = cpp.parse_file(cpp_h)
+        assert len(os.listdir(folder)) == 2
+        assert cpp.parse_file(cpp_h) == text
+        assert len(os.listdir(folder)) == 2
+        cpp.parse_file(cpp_h, Platform.mappings['Win32'])
+        assert len(os.listdir(folder)) == 3
+        Options.cache_size = 0 # Least recently used entries are removed
+        cpp.parse_file(cpp_h, Platform.mappings['Win64'])
+        assert os.listdir(folder) == ['notes.txt']
+    finally:
+        Options.cache_dir = None
+        Options.cache_size = 64
+
+@cpps.test
+def cpp_dependencies(ast):
+    """Test that headers are scanned for the includes they are missing."""
+    declared, used = cpp.scan_declarations(
+            '#define SIZE 2\ntypedef int myint;\n'
+            'struct a { struct b x; myint y[SIZE]; BOOL z; };')
+    assert declared == {'SIZE', 'myint', 'a'}
+    assert used == {'b', 'BOOL'}
+
+    # Names tested by the preprocessor are not used
+    declared, used = cpp.scan_declarations(
+            'struct c {\n#ifdef FEATURE\nint y;\n#endif\n};')
+    assert declared == {'c'}
+    assert used == set()
+
+    folder = os.path.dirname(__file__)
+    a_h = os.path.join(folder, 'a.h')
+    b_h = os.path.join(folder, 'b.h')
+    options = Options.create()
+    options.files = {} # Not the includes found by other tests
+    dependencies = cpp.find_dependencies([a_h, b_h], [folder],
+                                         Session(options))
+    assert dependencies == {a_h: [b_h], b_h: []}
+
+    # Types of headers parsed earlier are known by the session
+    session = Session(options)
+    session.known_types['STRUCT_B'] = b_h
+    dependencies = cpp.find_dependencies([a_h], [folder], session)
+    assert dependencies == {a_h: [b_h]}
+
+@cpps.test
+def preprocess_headers_in_batch(ast, folder):
+    """Test that a batch is split into the output of each header."""
+    files = {'shared.h': '#ifndef SHARED\n#define SHARED\n'
+                         'struct shared { int a; };\n#endif\n',
+             'one.h': '#include "shared.h"\n\nstruct one { int b; };\n',
+             'two.h': '#include "shared.h"\n#define VALUE 2\n\n'
+                      'struct two { int c[VALUE]; };\n'}
+    for name, content in files.items():
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(content)
+    headers = [os.path.join(folder, i) for i in ('one.h', 'two.h')]
+    texts = cpp.parse_files(headers)
+    assert sorted(texts) == sorted(headers)
+
+    # Both get the shared struct, but only their own, on the same lines
+    for header, name, line in zip(headers, ('one', 'two'), (3, 4)):
+        ast = cparser.parse(texts[header], header)
+        structs = {i.type.name: i.coord for i in ast.ext}
+        assert sorted(structs) == sorted(['shared', name])
+        assert structs['shared'].file.endswith('shared.h')
+        assert structs['shared'].line == 3
+        assert structs[name].file == header
+        assert structs[name].line == line
+
+@cpps.test
+def preprocess_batch_isolates_macros(ast, folder):
+    """Test that macros of a header in a batch don't leak into the next."""
+    files = {'a.h': '#include "c.h"\n#define WIDE 1\nstruct a { int x; };\n',
+             'b.h': '#include "c.h"\n#ifdef WIDE\n'
+                    'struct b { long long y[8]; };\n'
+                    '#else\nstruct b { char y; };\n#endif\n',
+             'c.h': 'struct c { int z; };\n'} # No include guard
+    for name, content in files.items():
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(content)
+    headers = [os.path.join(folder, i) for i in ('a.h', 'b.h')]
+    texts = cpp.parse_files(headers)
+    ast = cparser.parse(texts[headers[0]], headers[0])
+    assert [i.type.name for i in ast.ext] == ['c', 'a']
+
+    # The same structs as when b.h is preprocessed on its own
+    for text in (texts[headers[1]], cpp.parse_file(headers[1])):
+        c, b = cparser.parse(text, headers[1]).ext
+        field, = b.type.decls
+        assert c.type.name == 'c'
+        assert field.type.type.names == ['char']
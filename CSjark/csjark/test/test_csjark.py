@@ -28,6 +28,10 @@ import csjark
 import config
 import cparser
 import dissector
+import stats
+from platform import Platform
+from session import Session
+from . import tempdir
 
 
 # Tests for the command line interface.
@@ -37,9 +41,11 @@ cli = Tests()
 def create_cli():
     """Create Cli as a context to reset it afterwards."""
     c = config.Options
-    defaults = c.verbose, c.debug, c.use_cpp, c.output_dir, c.output_file
+    defaults = (c.verbose, c.debug, c.use_cpp,
+                c.output_dir, c.output_file, c.jobs)
     yield c
-    c.verbose, c.debug, c.use_cpp, c.output_dir, c.output_file = defaults
+    (c.verbose, c.debug, c.use_cpp,
+            c.output_dir, c.output_file, c.jobs) = defaults
 
 @cli.test
 def cli_headerfile1(cli):
@@ -100,6 +106,51 @@ def cli_flag_nocpp(cli):
     csjark.parse_args(['--nocpp', header])
     assert cli.use_cpp == False
 
+@cli.test
+def cli_flag_jobs(cli):
+    """Test that the number of processes to parse with can be given."""
+    assert cli.jobs == 1
+    header = os.path.join(os.path.dirname(__file__), 'cpp.h')
+    csjark.parse_args(['--jobs', '4', header])
+    assert cli.jobs == 4
+
+@cli.test
+def cli_flag_batch_cpp(cli):
+    """Test that headers can be preprocessed in batches."""
+    assert cli.batch_cpp == False
+    header = os.path.join(os.path.dirname(__file__), 'cpp.h')
+    csjark.parse_args(['--batch-cpp', header])
+    assert cli.batch_cpp == True
+    cli.batch_cpp = False
+
+@cli.test
+def cli_flag_incremental(cli):
+    """Test that incremental regeneration can be enabled."""
+    assert cli.incremental == False
+    header = os.path.join(os.path.dirname(__file__), 'cpp.h')
+    csjark.parse_args(['--incremental', header])
+    assert cli.incremental == True
+    cli.incremental = False
+
+@cli.test
+def cli_flag_loop_arrays(cli):
+    """Test that arrays can be dissected in loops."""
+    assert cli.loop_arrays == False
+    header = os.path.join(os.path.dirname(__file__), 'cpp.h')
+    csjark.parse_args(['--loop-arrays', header])
+    assert cli.loop_arrays == True
+    cli.loop_arrays = False
+
+@cli.test
+def cli_flag_stats(cli):
+    """Test that statistics can be written to a file."""
+    assert cli.stats is None and not stats.enabled
+    header = os.path.join(os.path.dirname(__file__), 'cpp.h')
+    csjark.parse_args(['--stats', 'stats.json', header])
+    assert cli.stats == 'stats.json' and stats.enabled
+    cli.stats = None
+    stats.enabled = False
+
 @cli.test
 def cli_file_dont_existing(cli):
     """Test if a file is missing"""
@@ -170,6 +221,85 @@ def parse_headers(cli):
     failed = csjark.parse_headers(headers)
     assert failed == 0
     # Cleanup
-    cparser.StructVisitor.all_protocols = {}
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
+
+@cli.test
+def parse_headers_in_parallel(cli):
+    """Test that parsing with several processes gives the same result."""
+    headers = [os.path.join(os.path.dirname(__file__), i)
+                for i in ('sprint2.h', 'sprint3.h', 'cpp.h')]
+    tmp, configs = csjark.parse_args([headers[0]])
+    code = {}
+    for jobs in (1, 2):
+        config.Options.jobs = jobs
+        failed = csjark.parse_headers(headers)
+        assert failed == 0
+        protocols = Session.default().protocols
+        code[jobs] = [(name, proto.generate())
+                      for name, proto in protocols.items()]
+        # Cleanup
+        Session.default().reset()
+    assert code[1] == code[2]
+
+@cli.test
+def parse_headers_in_sessions(cli):
+    """Test that sessions do not share the protocols they find."""
+    headers = [os.path.join(os.path.dirname(__file__), i)
+                for i in ('sprint2.h', 'cpp.h')]
+    sessions = []
+    for header in headers:
+        options = config.Options.create()
+        options.platforms = {Platform.mappings['default']}
+        session = Session(options)
+        assert csjark.parse_headers([header], session=session) == 0
+        sessions.append(session)
+    first, second = [set(i.protocols) for i in sessions]
+    assert first and second and not first & second
+    assert not Session.default().protocols
+    assert not config.Options.platforms & options.platforms
+
+# Tests for parsing headers into a session
+parsing = Tests()
+parsing.context(tempdir)
+
+@parsing.test
+def failed_header_leaves_nothing(folder):
+    """Test that a header which fails to parse is rolled back."""
+    header = os.path.join(folder, 'fails.h')
+    with open(header, 'w') as f:
+        f.write('struct good { int a; };\n'
+                'struct bad { int b; enum missing c; };\n')
+    options = config.Options.create()
+    options.use_cpp = False
+    session = Session(options)
+    platform = Platform.mappings['default']
+    error = csjark.create_dissector(header, platform, session=session)
+    assert 'Unknown enum' in str(error)
+    assert not session.protocols and not session.known_types
 
+@parsing.test
+def share_ast_between_platforms(folder):
+    """Test that platforms with the same cpp output share one AST."""
+    header = os.path.join(folder, 'shared.h')
+    with open(header, 'w') as f:
+        f.write('struct common { long a; };\n#ifdef _WIN64\n'
+                'struct only64 { int b; };\n#endif\n')
+    options = config.Options.create()
+    options.platforms = {Platform.mappings[i]
+                         for i in ('Win32', 'Win64', 'Linux-x86')}
+    session = Session(options)
+    calls = []
+    parse = cparser.parse
+    def counting_parse(text, *args, **kwargs):
+        calls.append(text)
+        return parse(text, *args, **kwargs)
+    cparser.parse = counting_parse
+    try:
+        assert csjark.parse_headers([header], session=session) == 0
+    finally:
+        cparser.parse = parse
+    assert len(calls) == 2
+    protocols = session.protocols
+    assert sorted(protocols['common'].dissectors) == [
+            'Linux-x86', 'Win32', 'Win64']
+    assert sorted(protocols['only64'].dissectors) == ['Win64']
@@ -22,13 +22,15 @@ Module for testing the dissector module.
 
 Tests the output of generating dissectors.
 """
-import sys, os
+import sys, os, io
 from attest import Tests, assert_hook, contexts
 
 import dissector
-from field import Field, ArrayField, ProtocolField, BitField
+import cache
+from field import Field, ArrayField, ProtocolField, BitField, create_lua_var
 from config import Config, Trailer
 from platform import Platform
+from session import Session
 
 
 def compare_lua(code, template, write_to_file=''):
@@ -53,7 +55,7 @@ def create_enum_field():
     diss.add_field(field)
     diss.push_modifiers()
     yield diss.children[0]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @enums.test
@@ -70,8 +72,9 @@ def enum_code(field):
     """Test that EnumField generates correct code."""
     assert isinstance(field, Field)
     assert compare_lua(field.get_code(0), '''
-    local enum_node = subtree:add(f.enum, buffer(0, 4))
-    local enum_value = buffer(0, 4):int()
+    range = buffer(0, 4)
+    local enum_node = subtree:add(f.enum, range)
+    local enum_value = range:int()
     if enum_valuestring[enum_value] == nil then
     enum_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1, 2, 3, 4]")
     end
@@ -91,7 +94,7 @@ def create_lua_keywords_field():
     diss.add_field(Field('in', 'float', 4, 0, Platform.big))
     diss.push_modifiers()
     yield diss.children[0], diss.children[1]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @lua_keywords.test
@@ -110,14 +113,26 @@ def lua_keywords_def(field1, field2):
 def lua_keywords_code(field1, field2):
     """Test that the Lua keywords are handled."""
     assert compare_lua(field1.get_code(0), '''
-    local elseif_node = subtree:add(f._elseif, buffer(0, 4))
-    local elseif_value = buffer(0, 4):int()
+    range = buffer(0, 4)
+    local elseif_node = subtree:add(f._elseif, range)
+    local elseif_value = range:int()
     if elseif_valuestring[elseif_value] == nil then
     elseif_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1, 2, 3, 4]")
     end
     ''')
     assert compare_lua(field2.get_code(0), 'subtree:add(f._in, buffer(0, 4))')
 
+@lua_keywords.test
+def lua_variable_names(field1, field2):
+    """Test that names are converted to valid Lua variable names."""
+    assert create_lua_var('Two words') == 'twowords'
+    assert create_lua_var('12 3abc[4].d-e') == 'abc4de'
+    assert create_lua_var('end') == '_end'
+    assert create_lua_var('END') == 'end'
+    assert create_lua_var('1end') == '_end'
+    assert create_lua_var('a b.c d', 2) == 'ab.c d'
+    assert create_lua_var('1 2', 0) == '1 2'
+
 @lua_keywords.test
 def fields_not_equal(field1, field2):
     """Test that two different fields are not equal."""
@@ -140,7 +155,7 @@ def create_array_field():
     diss.add_field(ArrayField.create([2], field))
     diss.push_modifiers()
     yield diss.children[0], diss.children[1]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @arrays.test
@@ -201,6 +216,123 @@ def subtrees_not_equal(field1, field2):
     assert field1 == field1
     assert field1 != field2
 
+@arrays.test
+def arrays_share_modifiers(one, two):
+    """Test that pushed modifiers are shared with, not copied to, children."""
+    sub = one.children[1]
+    leaf = sub.children[2]
+    assert leaf._parent is sub and sub._parent is one
+    assert leaf.var_prefix == [] and leaf.var_postfix == ['2']
+    assert sub.var_postfix == ['1']
+    assert (leaf.name, leaf.abbr, leaf.variable) == (
+            'arr[1][2]', 'test.arr.1.2', 'f.arr_1_2')
+    assert not hasattr(leaf, '__dict__')
+
+    # Names are frozen when pushed, and thawed if the name is changed
+    sub.var_postfix.append('x')
+    assert leaf.variable == 'f.arr_1_2'
+    leaf.name = 'renamed'
+    assert leaf.variable == 'f.renamed_1_x_2'
+
+@arrays.test
+def arrays_elements_on_demand(one, two):
+    """Test that array elements are created from a shared template."""
+    assert len(one.children) == 2 and len(one.children[0].children) == 3
+    assert one.children[0].element is one.element.element
+    assert one.children[-1].children[-1].abbr == 'test.arr.1.2'
+    assert one.children[1] is not one.children[1]
+    assert one.children == ArrayField.create([2, 3], one.element.element).children
+    with contexts.raises(IndexError):
+        one.children[2]
+
+# Test ArrayField dissected in a loop
+loop_arrays = Tests()
+
+@loop_arrays.context
+def create_loop_array_field():
+    """Create a Protocol instance with some arrays dissected in loops."""
+    proto, diss = dissector.Protocol.create_dissector('test')
+    field = Field('arr', 'float', 4, 0, Platform.big)
+    diss.add_field(ArrayField.create([2, 3], field, loop=True))
+    fake = ProtocolField.Fake('inner', 8, 4, Platform.big)
+    field = ProtocolField('ins', fake)
+    diss.add_field(ArrayField.create([5], field, loop=True))
+    diss.push_modifiers()
+    yield diss.children[0], diss.children[1]
+    Session.default().reset()
+    del proto, diss
+
+@loop_arrays.test
+def loop_arrays_def(one, two):
+    """Test that a looped ArrayField defines one field per element type."""
+    assert one.loop and len(one.children) == 1
+    assert one.size == 24 and two.size == 40
+    assert compare_lua(one.get_definition(), '''
+    f.arr = ProtoField.bytes("test.arr", "arr")
+    f.arr_element = ProtoField.bytes("test.arr.element", "")
+    f.arr_element_element = ProtoField.float("test.arr.element.element", "")
+    ''')
+
+@loop_arrays.test
+def loop_arrays_code(one, two):
+    """Test that a looped ArrayField generates a Lua for loop."""
+    assert compare_lua(one.get_code(0), '''
+    local array = subtree:add(f.arr, buffer(0, 24))
+    array:set_text("arr (6 x float)")
+    for array_index = 0, 1 do
+        local subarray = array:add(f.arr_element,
+                buffer(0 + array_index * 12, 12))
+        subarray:set_text("arr[" .. array_index .. "] (3 x float)")
+        for subarray_index = 0, 2 do
+            local arr_node = subarray:add(f.arr_element_element,
+                    buffer(0 + array_index * 12 + subarray_index * 4, 4))
+            arr_node:prepend_text("arr[" .. array_index .. "]["
+                    .. subarray_index .. "]")
+        end
+    end
+    ''')
+    assert compare_lua(two.get_code(0), '''
+    local array = subtree:add(f.ins, buffer(0, 40))
+    array:set_text("ins (5 x inner)")
+    for array_index = 0, 4 do
+        pinfo.private.field_name = "ins[" .. array_index .. "]"
+        dissectors["inner"]:call(buffer(0 + array_index * 8, 8):tvb(),
+                pinfo, array)
+    end
+    ''')
+
+@loop_arrays.test
+def lazy_arrays_code(one, two):
+    """Test that elements of arrays above the threshold are lazy."""
+    assert not one.lazy
+    one.threshold = 5
+    assert one.lazy and one.elements == (6, 'float')
+    assert compare_lua(one.get_code(0), '''
+    local array = subtree:add(f.arr, buffer(0, 24))
+    array:set_text("arr (6 x float)")
+    if tree.visible ~= false or prefs.decode_arrays then
+        for array_index = 0, 1 do
+            local subarray = array:add(f.arr_element,
+                    buffer(0 + array_index * 12, 12))
+            subarray:set_text("arr[" .. array_index .. "] (3 x float)")
+            for subarray_index = 0, 2 do
+                local arr_node = subarray:add(f.arr_element_element,
+                        buffer(0 + array_index * 12 + subarray_index * 4, 4))
+                arr_node:prepend_text("arr[" .. array_index .. "]["
+                        .. subarray_index .. "]")
+            end
+        end
+    end
+    ''')
+
+@loop_arrays.test
+def lazy_arrays_prefs(one, two):
+    """Test that lazy arrays inside other fields are found."""
+    assert not dissector._has_lazy_arrays([one, two])
+    one.element.threshold = 2
+    assert one.element.lazy and not one.lazy
+    assert dissector._has_lazy_arrays([one, two])
+
 # Test ProtocolField
 protofields = Tests()
 
@@ -214,7 +346,7 @@ def create_protocol_field():
     diss.add_field(ProtocolField('test2', diss_two))
     diss.push_modifiers()
     yield diss.children[0], diss.children[1]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @protofields.test
@@ -231,11 +363,11 @@ def proto_field_code(one, two):
     assert isinstance(two, ProtocolField)
     assert compare_lua(one.get_code(0), '''
     pinfo.private.field_name = "test"
-    Dissector.get("one"):call(buffer(0, 0):tvb(), pinfo, subtree)
+    dissectors["one"]:call(buffer(0, 0):tvb(), pinfo, subtree)
     ''')
     assert compare_lua(two.get_code(32), '''
     pinfo.private.field_name = "test2"
-    Dissector.get("two"):call(buffer(32,0):tvb(), pinfo, subtree)
+    dissectors["two"]:call(buffer(32,0):tvb(), pinfo, subtree)
     ''')
 
 # Test ProtocolField
@@ -251,7 +383,7 @@ def create_union_protocol_field():
     diss.add_field(ProtocolField('test2', two))
     diss.push_modifiers()
     yield diss.children[0], diss.children[1]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @union_protofields.test
@@ -268,13 +400,51 @@ def union_proto_field_code(one, two):
     assert isinstance(two, ProtocolField)
     assert compare_lua(one.get_code(0), '''
     pinfo.private.field_name = "test1"
-    Dissector.get("union_one"):call(buffer(0,0):tvb(), pinfo, subtree)
+    dissectors["union_one"]:call(buffer(0,0):tvb(), pinfo, subtree)
     ''')
     assert compare_lua(two.get_code(32), '''
     pinfo.private.field_name = "test2"
-    Dissector.get("union_two"):call(buffer(32,0):tvb(), pinfo, subtree)
+    dissectors["union_two"]:call(buffer(32,0):tvb(), pinfo, subtree)
     ''')
 
+# Test the layout of the fields in a Dissector
+layouts = Tests()
+
+@layouts.context
+def create_layout():
+    """Create a struct and a union with fields of different alignment."""
+    platform = Platform.mappings['default']
+    endian = platform.endian
+    tmp, struct = dissector.Protocol.create_dissector('layout', platform)
+    tmp, union = dissector.Protocol.create_dissector(
+            'layout_union', platform, union=True)
+    for diss in (struct, union):
+        diss.add_field(Field('a', 'int8', 1, 1, endian))
+        diss.add_field(Field('b', 'int32', 4, 4, endian))
+    yield struct, union
+    Session.default().reset()
+
+@layouts.test
+def layout_offsets(struct, union):
+    """Test that fields are padded to their alignment."""
+    assert struct.get_offsets() == [0, 4, 8]
+    assert struct.get_offsets(1) == [1, 4, 8]
+    assert union.get_offsets() == [0, 0, 0]
+    assert (struct.size, struct.alignment) == (8, 4)
+    assert (union.size, union.alignment) == (4, 4)
+
+@layouts.test
+def layout_updated_by_add_field(struct, union):
+    """Test that the layout is found again when a field is added."""
+    assert struct.get_offsets() is struct.get_offsets()
+    offsets, size = struct.get_offsets(), struct.size
+    struct.add_field(Field('c', 'double', 8, 8, struct.endian))
+    union.add_field(Field('c', 'double', 8, 8, union.endian))
+    assert offsets == [0, 4, 8] and size == 8
+    assert struct.get_offsets() == [0, 4, 8, 16]
+    assert (struct.size, struct.alignment) == (16, 8)
+    assert (union.size, union.alignment) == (8, 8)
+
 # Test BitField
 bits = Tests()
 
@@ -289,7 +459,7 @@ def create_bit_field():
     diss.add_field(BitField(bits, 'bit2', 'uint16', 2, 0, Platform.big))
     diss.push_modifiers()
     yield diss.children[0], diss.children[1]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @bits.test
@@ -313,16 +483,18 @@ def bitfield_def(one, two):
 def bitfield_code(one, two):
     """Test that BitField generates valid code."""
     assert compare_lua(one.get_code(0), '''
-    local bittree = subtree:add(f.bit1, buffer(0, 4))
-    bittree:add(f.bit1_r, buffer(0, 4))
-    bittree:add(f.bit1_b, buffer(0, 4))
-    bittree:add(f.bit1_g, buffer(0, 4))
+    range = buffer(0, 4)
+    local bittree = subtree:add(f.bit1, range)
+    bittree:add(f.bit1_r, range)
+    bittree:add(f.bit1_b, range)
+    bittree:add(f.bit1_g, range)
     ''')
     assert compare_lua(two.get_code(4), '''
-    local bittree = subtree:add(f.bit2, buffer(4, 2))
-    bittree:add(f.bit2_r, buffer(4, 2))
-    bittree:add(f.bit2_b, buffer(4, 2))
-    bittree:add(f.bit2_g, buffer(4, 2))
+    range = buffer(4, 2)
+    local bittree = subtree:add(f.bit2, range)
+    bittree:add(f.bit2_r, range)
+    bittree:add(f.bit2_b, range)
+    bittree:add(f.bit2_g, range)
     ''')
 
 
@@ -337,7 +509,7 @@ def create_range_field():
     diss.children[-1].set_range_validation(0, 10)
     diss.push_modifiers()
     yield diss.children[0]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @ranges.test
@@ -352,8 +524,9 @@ def ranges_def(field):
 def ranges_code(field):
     """Test that RangeField generates valid code."""
     assert compare_lua(field.get_code(0), '''
-    local range_node = subtree:add(f.range, buffer(0, 4))
-    local range_value = buffer(0, 4):float()
+    range = buffer(0, 4)
+    local range_node = subtree:add(f.range, range)
+    local range_value = range:float()
     if range_value < 0 then
     range_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be larger than 0")
     end
@@ -374,7 +547,7 @@ def create_field():
     diss.add_field(Field('two', 'string', 12, 0, Platform.big))
     diss.push_modifiers()
     yield diss.children[0], diss.children[1]
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @fields.test
@@ -401,7 +574,7 @@ protos = Tests()
 @protos.context
 def create_protos():
     """Create a Protocol instance with some fields."""
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     conf = Config('tester')
     conf.id = [25,]
     conf.description = 'This is a test'
@@ -422,7 +595,7 @@ def create_protos():
     diss.add_field(Field('count', 'int32', 4, 0, Platform.big))
     diss.push_modifiers()
     yield proto
-    dissector.Protocol.protocols = {}
+    Session.default().reset()
     del proto, diss
 
 @protos.test
@@ -455,6 +628,10 @@ def protos_create_dissector(proto):
     local proto_tester = Proto("tester", "This is a test")
     -- ProtoField defintions for: tester
     local f = proto_tester.fields
+    local dissectors = setmetatable({}, {__index = function(t, name)
+    t[name] = Dissector.get(name)
+    return t[name]
+    end})
     f.one = ProtoField.float("tester.one", "one")
     f.range = ProtoField.float("tester.range", "range")
     f.array = ProtoField.bytes("tester.array", "array")
@@ -481,9 +658,11 @@ def protos_create_dissector(proto):
     else
     pinfo.cols.info:append("(This is a test)")
     end
+    local range
     subtree:add(f.one, buffer(0, 4))
-    local range_node = subtree:add(f.range, buffer(4, 4))
-    local range_value = buffer(4, 4):float()
+    range = buffer(4, 4)
+    local range_node = subtree:add(f.range, range)
+    local range_value = range:float()
     if range_value < 0 then
     range_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be larger than 0")
     end
@@ -510,23 +689,30 @@ def protos_create_dissector(proto):
     subtree:add(f.count, buffer(92, 4))
     -- Trailers handling for struct: tester
     local trail_offset = 96
-    local trailer = Dissector.get("simple")
-    trailer:call(buffer(trail_offset, 4):tvb(), pinfo, tree)
+    dissectors["simple"]:call(buffer(trail_offset, 4):tvb(), pinfo, tree)
     trail_offset = trail_offset + 4
     for i = 1, 3 do
-    local trailer = Dissector.get("bur")
-    trailer:call(buffer(trail_offset, 8):tvb(), pinfo, tree)
+    dissectors["bur"]:call(buffer(trail_offset, 8):tvb(), pinfo, tree)
     trail_offset = trail_offset + 8
     end
     local trail_count = buffer(92, 4):int()
     for i = 1, trail_count do
-    local trailer = Dissector.get("ber")
-    trailer:call(buffer(trail_offset):tvb(), pinfo, tree)
+    dissectors["ber"]:call(buffer(trail_offset):tvb(), pinfo, tree)
     end
     end
     delegator_register_proto(proto_tester, "tester", 25, {[0]=96})
     ''')
 
+@protos.test
+def protos_write_dissector(proto):
+    """Test that the streamed dissector code equals the generated code."""
+    out = io.StringIO()
+    writer = cache.KeyWriter(out)
+    proto.write(writer)
+    code = proto.generate()
+    assert out.getvalue() == code
+    assert writer.key == cache.create_key(code)
+
 
 # Test Delegator
 delegator = Tests()
@@ -554,7 +740,8 @@ def delegator_generate(delegator):
     local dissector_table = DissectorTable.new("luastructs", "Lua Structs", ftypes.STRING)
     local delegator = Proto("luastructs", "Lua C Structs")
     local message_ids = {}
-    local dissector_sizes = {}
+    local dissector_funcs = {}
+    local dissector_guesses = {}
     -- ProtoField defintions for: luastructs
     local f = delegator.fields
     f.version = ProtoField.uint8("luastructs.Version", "Version")
@@ -565,16 +752,20 @@ def delegator_generate(delegator):
     -- Register struct dissectors
     function delegator_register_proto(proto, name, id, sizes)
     dissector_table:add(name, proto)
-    if id ~= nil then message_ids[id] = name end
+    local entry = {name = name, id = id, dissector = proto.dissector}
+    if id ~= nil then message_ids[id] = entry end
     if sizes ~= nil then
     for flag, size in pairs(sizes) do
-    if dissector_sizes[flag] == nil then
-    dissector_sizes[flag] = {}
+    if id ~= nil then
+    dissector_funcs[flag * 65536 + id] = entry
     end
-    if dissector_sizes[flag][size] == nil then
-    dissector_sizes[flag][size] = {}
+    -- Guess the dissector without id, then by name, for unknown ids
+    local key = flag * 4294967296 + size
+    local guess = dissector_guesses[key]
+    if guess == nil or (guess.id ~= nil and id == nil) or
+    ((guess.id == nil) == (id == nil) and name < guess.name) then
+    dissector_guesses[key] = entry
     end
-    table.insert(dissector_sizes[flag][size], name)
     end
     end
     end
@@ -583,28 +774,30 @@ def delegator_generate(delegator):
     local subtree = tree:add(delegator, buffer())
     pinfo.cols.protocol = delegator.name
     pinfo.cols.info = delegator.description
+    local range
     subtree:add(f.version, buffer(0, 1))
-    local flags_node = subtree:add(f.flags, buffer(1, 1))
-    local flags_value = buffer(1, 1):uint()
+    range = buffer(1, 1)
+    local flags_node = subtree:add(f.flags, range)
+    local flags_value = range:uint()
     if flags_valuestring[flags_value] == nil then
     flags_node:add_expert_info(PI_MALFORMED, PI_WARN, "Should be in [0, 1, 2, 3, 4, 5, 6, 7]")
     end
     pinfo.private.platform_flag = flags_value
-    local msg_node = subtree:add(f.message, buffer(2, 2))
+    local message_range = buffer(2, 2)
+    local msg_node = subtree:add(f.message, message_range)
     subtree:add(f.messagelength, buffer(4):len()):set_generated()
-    local id_value = buffer(2, 2):uint()
+    local id_value = message_range:uint()
     local length_value = buffer(4, 4):uint()
-    -- Call the correct dissector, or try and guess which
-    if message_ids[id_value] then
-    msg_node:append_text(" (" .. message_ids[id_value] ..")")
-    dissector_table:try(message_ids[id_value], buffer(4):tvb(), pinfo, tree)
+    -- Call the correct dissector, or guess which
+    local entry = dissector_funcs[flags_value * 65536 + id_value] or message_ids[id_value]
+    if entry then
+    msg_node:append_text(" (" .. entry.name ..")")
     else
     msg_node:add_expert_info(PI_MALFORMED, PI_WARN, "Unknown message id")
-    if dissector_sizes[flags_value] and dissector_sizes[flags_value][length_value] then
-    for key, value in pairs(dissector_sizes[flags_value][length_value]) do
-    dissector_table:try(value, buffer(4):tvb(), pinfo, tree)
-    end
+    entry = dissector_guesses[flags_value * 4294967296 + length_value]
     end
+    if entry then
+    entry.dissector:call(buffer(4):tvb(), pinfo, tree)
     end
     end
     ''')
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module for testing the manifest module.
+"""
+import os
+from attest import Tests, assert_hook
+
+import config
+from manifest import Manifest
+from session import Session
+from . import tempdir
+
+
+# Tests for the manifest of incremental runs
+manifest = Tests()
+manifest.context(tempdir)
+
+@manifest.test
+def manifest_changed_headers(folder):
+    """Test that the manifest finds which headers changed."""
+    header = os.path.join(folder, 'manifest.h')
+    with open(os.path.join(folder, 'include.h'), 'w') as f:
+        f.write('struct included { int a; };\n')
+    with open(header, 'w') as f:
+        f.write('#include "include.h"\nstruct man { int b; };\n')
+
+    options = config.Options.create()
+    options.output_dir = folder
+    session = Session(options)
+    manifest = Manifest(session)
+    assert manifest.is_new
+    assert manifest.changed_headers([header], set()) == [header]
+    manifest.update_headers([header], set())
+    manifest.save()
+
+    manifest = Manifest(session)
+    assert not manifest.is_new
+    assert manifest.changed_headers([header], set()) == []
+
+    # Changing an included file changes the header
+    with open(os.path.join(folder, 'include.h'), 'w') as f:
+        f.write('struct included { int a; int c; };\n')
+    assert manifest.changed_headers([header], set()) == [header]
+
+    # And every header which includes a changed header
+    include = os.path.join(folder, 'include.h')
+    manifest.changed_headers([include, header], set())
+    manifest.update_headers([include, header], set())
+    with open(include, 'w') as f:
+        f.write('struct included { int a; };\n')
+    changed = manifest.changed_headers([include, header], set())
+    assert changed == [include, header]
+
+@manifest.test
+def manifest_restore(folder):
+    """Test that the manifest restores includes and types of headers."""
+    a, b = os.path.join(folder, 'a.h'), os.path.join(folder, 'b.h')
+    with open(a, 'w') as f:
+        f.write('struct a { STRUCT_B b; };\n')
+    with open(b, 'w') as f:
+        f.write('#define STRUCT_B struct b\nstruct b { int x; };\n')
+
+    options = config.Options.create()
+    options.output_dir = folder
+    session = Session(options)
+    manifest = Manifest(session)
+    manifest.changed_headers([a, b], set())
+    session.known_types['b'] = b # As if found by parsing the headers
+    session.known_types[None] = b # Anonymous types are not recorded
+    config.FileConfig.add_include(a, b, options)
+    manifest.update_headers([a, b], set())
+    manifest.save()
+
+    # Unchanged headers are not parsed again, but still declare types
+    options = config.Options.create()
+    options.output_dir = folder
+    session = Session(options)
+    manifest = Manifest(session)
+    manifest.restore([a, b])
+    assert options.match_file(a).includes == [b]
+    assert session.known_types == {'b': b}
+    assert manifest.changed_headers([a, b], set()) == []
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module for testing the scanner module.
+"""
+import os
+from attest import Tests, assert_hook
+
+import config
+import cache
+from scanner import Excludes, find_files
+from . import tempdir
+
+
+# Tests for searching folders for files
+scanner = Tests()
+scanner.context(tempdir)
+
+@scanner.test
+def find_files_with_excludes(folder):
+    """Test that excluded files and folders are skipped when searching."""
+    for path in ('a/one.h', 'a/two.c', 'b/three.h', 'c/gen/four.h',
+                 'c/five.hpp', 'bc/six.h'):
+        path = os.path.join(folder, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+    excludes = Excludes([os.path.join(folder, 'b'), '*/gen'])
+    assert excludes.match(os.path.join(folder, 'b', 'three.h'))
+    assert not excludes.match(os.path.join(folder, 'bc', 'six.h'))
+    headers = find_files([folder], ('.h', '.hpp'), excludes)
+    assert sorted(os.path.relpath(i, folder) for i in headers) == [
+            os.path.join('a', 'one.h'), os.path.join('bc', 'six.h'),
+            os.path.join('c', 'five.hpp')]
+
+    # Listings are reused from the cache while a folder is unchanged
+    options = config.Options.create()
+    options.cache_dir = os.path.join(folder, 'cache')
+    hits = cache.hits.get('dirs', 0)
+    old = os.path.getmtime(folder) - 10
+    for path in [folder] + [os.path.join(folder, i) for i in 'abc']:
+        os.utime(path, (old, old))
+    assert find_files([folder], ('.h', ), excludes, options) == \
+            find_files([folder], ('.h', ), excludes, options)
+    assert cache.hits['dirs'] == hits + 1
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module for testing the server module.
+"""
+import os
+import io
+import json
+from attest import Tests, assert_hook
+
+import config
+from platform import Platform
+from session import Session
+from server import Server, SERVER_ERROR, METHOD_NOT_FOUND, INVALID_PARAMS
+from server import PARSE_ERROR, INVALID_REQUEST
+from . import tempdir
+
+
+# Tests for the JSON-RPC server
+server = Tests()
+server.context(tempdir)
+
+@server.test
+def serve_requests(folder):
+    """Test that the server regenerates dissectors for changed headers."""
+    header = os.path.join(folder, 'served.h')
+    with open(header, 'w') as f:
+        f.write('struct served { int a; };\n')
+    options = config.Options.create()
+    options.use_cpp = False
+    options.output_dir = folder
+    options.platforms = {Platform.mappings['default']}
+    server = Server([header], session=Session(options))
+    assert server.parse() == []
+    assert server.structs() == {'served': header}
+
+    requests = io.StringIO(
+            '{"jsonrpc": "2.0", "id": 1, "method": "generate",'
+            ' "params": {"structs": ["served"]}}\n'
+            '{"jsonrpc": "2.0", "id": 2, "method": "generate",'
+            ' "params": {"structs": ["unknown"]}}\n'
+            '{"jsonrpc": "2.0", "id": 3, "method": "unknown"}\n'
+            '{"jsonrpc": "2.0", "id": 4, "method": "parse",'
+            ' "params": ["served.h"]}\n'
+            '{"jsonrpc": "2.0", "method": "unknown"}\n'
+            '{"jsonrpc": "2.0", "method": "parse", "params": [1]}\n'
+            '{"jsonrpc": "2.0", "method": "shutdown"}\n'
+            '{"jsonrpc": "2.0", "id": 5, "method": "structs"}\n')
+    responses = io.StringIO()
+    server.serve(requests, responses)
+    # Notifications are not answered, even when they fail
+    first, second, third, fourth = [
+            json.loads(i) for i in responses.getvalue().splitlines()]
+    assert first['result'] == {'written': 1, 'failed': []}
+    assert second['error']['code'] == SERVER_ERROR
+    assert third['error']['code'] == METHOD_NOT_FOUND
+    assert fourth['error']['code'] == INVALID_PARAMS
+    path = os.path.join(folder, 'served.lua')
+    assert 'served.b' not in open(path).read()
+
+    # Only changed headers are parsed again
+    with open(header, 'w') as f:
+        f.write('struct served { int a; int b; };\n')
+    assert server.generate(['served'])['written'] == 1
+    assert 'served.b' in open(path).read()
+    assert server.parse() == []
+
+@server.test
+def serve_hashes_includes(folder):
+    """Test that headers are hashed with the includes found for them."""
+    a, b = os.path.join(folder, 'a.h'), os.path.join(folder, 'b.h')
+    with open(a, 'w') as f:
+        f.write('struct a { STRUCT_B b; };\n')
+    with open(b, 'w') as f:
+        f.write('#define STRUCT_B struct b\nstruct b { int x; };\n')
+    options = config.Options.create()
+    options.platforms = {Platform.mappings['default']}
+    server = Server([a, b], session=Session(options))
+    assert server.parse() == []
+    assert b in server._files[a]
+
+    # Nothing changed, so nothing is parsed again
+    hashes = dict(server._hashes)
+    assert server.parse() == []
+    assert server._hashes == hashes
+    assert all(server._hash(i)[1] == hashes[i] for i in (a, b))
+
+@server.test
+def serve_notifications(folder):
+    """Test that notifications are never answered, except unreadable ones."""
+    options = config.Options.create()
+    options.use_cpp = False
+    server = Server([], {folder}, Session(options))
+    assert server.handle('{"jsonrpc": "2.0", "method": "unknown"}') is None
+    assert server.handle('{"jsonrpc": "2.0", "method": "parse",'
+                         ' "params": {"missing": []}}') is None
+    assert server.handle('{"jsonrpc": "2.0", "method": "parse",'
+                         ' "params": [["missing.h"]]}') is None
+    assert server.handle('{"jsonrpc": "2.0", "id": null,'
+                         ' "method": "unknown"}')['id'] is None
+    assert server.handle('{"jsonrpc"')['error']['code'] == PARSE_ERROR
+    assert server.handle('[]')['error']['code'] == INVALID_REQUEST
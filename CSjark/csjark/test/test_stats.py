@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module for testing the stats module.
+"""
+import os
+import json
+from attest import Tests, assert_hook
+
+import csjark
+import config
+import stats
+from platform import Platform
+from session import Session
+from . import tempdir
+
+
+# Tests for measuring the stages of parsing headers
+measure = Tests()
+measure.context(tempdir)
+
+@measure.test
+def stats_per_header_and_platform(folder):
+    """Test that the stages are measured for each header and platform."""
+    headers = []
+    for name in ('one', 'two'):
+        headers.append(os.path.join(folder, '%s.h' % name))
+        with open(headers[-1], 'w') as f:
+            f.write('struct %s { int a; long b[4]; };\n' % name)
+    options = config.Options.create()
+    options.platforms = {Platform.mappings[i] for i in ('Win32', 'Win64')}
+    session = Session(options)
+    stats.records.clear()
+    stats.enabled = True
+    try:
+        assert csjark.parse_headers(headers, session=session) == 0
+        report = stats.report(top=1)
+    finally:
+        stats.enabled = False
+        stats.records.clear()
+
+    for stage in ('cpp', 'post_cpp', 'layout'):
+        assert report['stages'][stage]['calls'] == 4
+        assert report['platforms']['Win64'][stage]['calls'] == 2
+    assert report['stages']['parse']['calls'] == 2
+    assert report['stages']['generate']['calls'] == 0
+    assert report['stages']['cpp']['bytes'] > 0
+    assert sorted(report['headers']) == sorted(headers)
+    platforms = report['headers'][headers[0]]['platforms']
+    assert sorted(platforms) == [stats.ALL, 'Win32', 'Win64']
+    assert platforms[stats.ALL]['parse']['calls'] == 1
+    assert len(report['slowest']) == 1
+    assert report['slowest'][0]['header'] in headers
+    json.dumps(report)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module for testing the watcher module.
+"""
+import os
+from attest import Tests, assert_hook
+
+import config
+from watcher import Watcher
+from . import tempdir
+
+
+# Tests for regenerating dissectors when files change
+watcher = Tests()
+watcher.context(tempdir)
+
+@watcher.test
+def watch_regenerates_changed(folder):
+    """Test that the watcher only writes dissectors which changed."""
+    first = os.path.join(folder, 'first.h')
+    with open(first, 'w') as f:
+        f.write('struct first { int a; };\n')
+    with open(os.path.join(folder, 'second.h'), 'w') as f:
+        f.write('struct second { int b; };\n')
+    yml = os.path.join(folder, 'first.yml')
+    with open(yml, 'w') as f:
+        f.write('Structs:\n  - name: first\n    id: 10\n')
+    options = config.Options.create()
+    options.use_cpp = False
+    options.output_dir = folder
+    watcher = Watcher([folder], [yml], options)
+    assert watcher.regenerate(reload=True) == 2
+    assert watcher.regenerate() == 0
+    assert os.path.isfile(os.path.join(folder, 'luastructs.lua'))
+
+    with open(first, 'w') as f:
+        f.write('struct first { int a; int c; };\n')
+    assert watcher.regenerate() == 1
+
+    # New headers in the folders are found, deleted ones removed
+    third = os.path.join(folder, 'sub', 'third.h')
+    os.mkdir(os.path.dirname(third))
+    with open(third, 'w') as f:
+        f.write('struct third { int d; };\n')
+    assert watcher.regenerate() == 1
+    os.remove(third)
+    assert watcher.regenerate() == 0
+    assert not os.path.isfile(os.path.join(folder, 'third.lua'))
+
+    # Changed configuration is read again
+    with open(yml, 'w') as f:
+        f.write('Structs:\n  - name: first\n    id: 11\n')
+    assert watcher.regenerate(reload=True) == 1
+    assert not options.configs
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011 Even Wiik Thomassen, Erik Bergersen,
+# Sondre Johan Mannsverk, Terje Snarby, Lars Solvoll Tønder,
+# Sigurd Wien and Jaroslav Fibichr.
+#
+# This file is part of CSjark.
+#
+# CSjark is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSjark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CSjark.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A module for regenerating dissectors when their input changes.
+
+The Watcher class generates all dissectors once, and then looks for
+changes to the header files, the files they include, the configuration
+files and the conformance files, every Watcher.interval seconds. When
+files change it waits until they stop changing, before it parses the
+headers which changed and writes the dissectors whose code changed.
+When a configuration or conformance file changes, all configuration is
+read again and all headers are parsed again, but still only the changed
+dissectors are written.
+"""
+import os
+import time
+
+import config
+import csjark
+from config import Options
+from session import Session
+from server import Server
+from scanner import Excludes, find_files
+
+
+class Watcher:
+    """Regenerates the dissectors built from files which changed."""
+
+    interval = 1.0 # Seconds between each look for changed files
+
+    def __init__(self, paths, configs, options=None):
+        """Create a watcher for the headers in 'paths' and 'configs'.
+
+        'paths' is a list of header files and folders, which are searched
+        recursively for headers every time the files are looked at.
+        'options' is the Options before any config file is parsed, which
+        new options are created from when a config file changes, a copy
+        of Options if None.
+        """
+        if options is None:
+            options = Options.create()
+        self.paths = list(paths)
+        self.headers = []
+        self.configs = list(configs)
+        self.options = options
+        self.server = None # Holds the session with the parsed headers
+
+        self._code = {} # Map protocol name to the hash of its code
+        self._paths = {} # Map protocol name to the file it was written to
+
+    def run(self):
+        """Generate all dissectors, then regenerate them until interrupted."""
+        self.regenerate(reload=True)
+        stamps = self._stamps()
+        print('Watching %i files for changes' % len(stamps))
+        try:
+            while True:
+                time.sleep(self.interval)
+                new = self._stamps()
+                if new == stamps:
+                    continue
+
+                # Wait until the files stop changing, as editors often
+                # write a file several times when saving it
+                stable = None
+                while stable != new:
+                    time.sleep(self.interval)
+                    stable, new = new, self._stamps()
+
+                changed = {i for i in set(stamps) | set(new)
+                           if stamps.get(i, None) != new.get(i, None)}
+                try:
+                    self.regenerate(
+                            reload=bool(changed & self._config_files()))
+                except Exception as err:
+                    # Keep watching, the file may be fixed by the next save
+                    print('Failed to regenerate dissectors: %s' % repr(err))
+                stamps = self._stamps()
+        except KeyboardInterrupt:
+            print('Stopped watching for changes')
+
+    def load(self):
+        """Read all config files, and parse all headers with new options.
+
+        Returns the headers which failed to parse.
+        """
+        options = self.options.create()
+        for filename in self.configs:
+            config.parse_file(filename, options=options)
+        options.prepare_for_parsing()
+        headers = self._find_headers(options)
+        folders = {os.path.dirname(i) for i in headers}
+        self.server = Server(headers, folders, Session(options))
+        return self.server.parse()
+
+    def regenerate(self, reload=False):
+        """Parse changed headers and write the dissectors which changed.
+
+        'reload' is True if the config files must be read again.
+        Returns the number of dissectors written.
+        """
+        if reload or self.server is None:
+            failed = self.load()
+            names = None
+        else:
+            protocols = self.server.session.protocols
+            before = dict(protocols)
+            new = [i for i in self._find_headers()
+                   if i not in self.server.headers]
+            failed = self.server.parse(new) if new else []
+            failed += self.server.parse()
+
+            # Only write the protocols which were parsed again
+            names = {name for name, proto in protocols.items()
+                     if before.get(name, None) is not proto}
+            for name in set(before) - set(protocols):
+                self._remove(name)
+        self.headers = list(self.server.headers)
+
+        session = self.server.session
+        if session.options.output_file:
+            wrote = csjark.write_dissectors_to_file(
+                    session.protocols, session=session)
+        else:
+            wrote = csjark.write_dissectors_to_file(
+                    session.protocols, self, session, names)
+        if names is None:
+            csjark.write_delegator_to_file(session)
+
+        print('Wrote %i changed dissectors, %i header files failed' % (
+                wrote, len(set(failed))))
+        return wrote
+
+    def update_protocol(self, proto, path, code_hash):
+        """Record the code written for a protocol, True if it changed.
+
+        Called by csjark.write_dissectors_to_file, in place of a manifest.
+        """
+        old = self._code.get(proto.name, None)
+        self._code[proto.name] = code_hash
+        self._paths[proto.name] = path
+        return old != code_hash or not os.path.isfile(path)
+
+    def _remove(self, name):
+        """Remove the dissector of a struct which no longer exists."""
+        self._code.pop(name, None)
+        path = self._paths.pop(name, None)
+        if path is not None and os.path.isfile(path):
+            os.remove(path)
+            print("Removed '%s' as its struct no longer exists" % path)
+
+    def _find_headers(self, options=None):
+        """Find all headers in the files and folders watched.
+
+        'options' is the Options with the excludes, the options of the
+        parsed headers if None.
+        """
+        if options is None:
+            options = self.server.session.options
+        excludes = Excludes(options.excludes)
+        headers = find_files(self.paths, ('.h', '.hpp'), excludes, options)
+        return sorted(excludes.filter(os.path.normpath(i) for i in headers))
+
+    def _config_files(self):
+        """Find the config and conformance files used."""
+        files = {os.path.normpath(i) for i in self.configs}
+        for conf in self.server.session.options.configs.values():
+            if conf.cnf is not None:
+                files.add(os.path.normpath(conf.cnf.file))
+        return files
+
+    def _stamps(self):
+        """Map every file watched to its modification time and size."""
+        files = set(self._find_headers()) | self.server.files
+        files |= self._config_files()
+        stamps = {}
+        for path in files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stamps[path] = None
+            else:
+                stamps[path] = (stat.st_mtime_ns, stat.st_size)
+        return stamps